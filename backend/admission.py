@@ -0,0 +1,178 @@
+from collections import OrderedDict
+import math
+import threading
+import time
+
+from flask import abort, g, request
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+EXEMPT_ENDPOINTS = ("health", "get_metrics", "static")
+
+"""
+Admission control
+
+Requests are admitted in three steps, cheapest first, before any other
+work is done for them:
+
+1. Rate limit: each client (its remote address) has a token bucket that
+   refills at `rate` tokens a second up to `burst`. A request takes one
+   token; without one it gets 429 and a Retry-After of the time until
+   the next token. Buckets live in this process (MemoryBucketStore) or,
+   with a redis:// URL, in Redis so every worker shares them.
+2. Load shedding: at most `max_in_flight` requests run in the worker at
+   once; requests beyond that get 503 straight away.
+3. Route caps: expensive endpoints (search, quiz draws) run at most
+   `limit` at a time per worker. Up to `max_queue` more wait for a slot
+   for at most `timeout` seconds; a full queue or a timeout gets 503.
+
+Rejections are cheap and say when to retry, so a burst is turned away at
+the door instead of piling up as slow queries, and the requests that are
+admitted keep their latency.
+"""
+
+
+class MemoryBucketStore:
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, cost=1):
+        """takes cost tokens from key's bucket; returns 0 when they were
+        there, otherwise the seconds until they will be"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+class RedisBucketStore:
+    # KEYS[1] bucket; ARGV rate, burst, cost, now
+    TAKE = """
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local cost, now = tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens),
+           "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, url, rate, burst, prefix="trivia:rate:"):
+        if redis is None:
+            raise RuntimeError("RedisBucketStore requires the redis package")
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self._take = redis.Redis.from_url(url).register_script(self.TAKE)
+
+    def take(self, key, cost=1):
+        return float(self._take(keys=[self.prefix + key],
+                                args=[self.rate, self.burst, cost,
+                                      time.time()]))
+
+
+def create_bucket_store(url=None, rate=10, burst=20):
+    if url:
+        return RedisBucketStore(url, rate, burst)
+    return MemoryBucketStore(rate, burst)
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit, max_queue=0, timeout=1):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """takes a slot, waiting in the queue if there is room in it;
+        returns False when the request should be shed"""
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                return False
+            self.waiting += 1
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self.active < self.limit, self.timeout)
+            finally:
+                self.waiting -= 1
+            if admitted:
+                self.active += 1
+            return admitted
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class AdmissionControl:
+    def __init__(self, buckets=None, route_limits=None, max_in_flight=0,
+                 max_queue=0, queue_timeout=1):
+        """route_limits maps endpoint names to their concurrency cap"""
+        self.buckets = buckets
+        self.in_flight = ConcurrencyLimiter(max_in_flight) \
+            if max_in_flight else None
+        self.routes = {endpoint: ConcurrencyLimiter(limit, max_queue,
+                                                    queue_timeout)
+                       for endpoint, limit in (route_limits or {}).items()
+                       if limit}
+
+    def client_key(self):
+        return request.remote_addr or "unknown"
+
+    def admit(self):
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return
+        if self.buckets is not None:
+            wait = self.buckets.take(self.client_key())
+            if wait:
+                g.retry_after = max(1, math.ceil(wait))
+                abort(429)
+        g.admission_slots = []
+        for limiter in (self.in_flight, self.routes.get(request.endpoint)):
+            if limiter is None:
+                continue
+            if not limiter.acquire():
+                g.retry_after = 1
+                abort(503)
+            g.admission_slots.append(limiter)
+
+    def release(self, error=None):
+        for limiter in g.pop("admission_slots", ()):
+            limiter.release()
+
+    def init_app(self, app):
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+        app.extensions["admission"] = self
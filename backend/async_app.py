@@ -0,0 +1,568 @@
+import random
+from types import SimpleNamespace
+
+from quart import Quart, request, abort, jsonify
+
+import invalidation
+from async_change_log import AsyncDatabaseChannel
+from async_db import connect_database, placeholders
+from cache import create_cache
+from category_registry import CategoryRegistry
+from fieldsets import QUESTION_FIELDS, requested_fields, query_columns, \
+    wants_categories
+from pagination import decode_cursor, encode_cursor
+from question_index import QuestionIndex
+from quiz_sessions import QuizSessionStore, DEFAULT_QUESTIONS, \
+    MAX_QUESTIONS, DEFAULT_DIFFICULTY
+from search_index import SearchIndex
+from settings import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, \
+    INVALIDATION_DIR, INVALIDATION_INTERVAL, CACHE_URL, QUIZ_SESSION_MAX, \
+    QUIZ_SESSION_TTL, QUIZ_BATCH_MAX
+
+QUESTIONS_PER_PAGE = 10
+# routes of flaskr.create_app this app does not serve
+WSGI_ONLY_ROUTES = {
+    ("/health", "GET"), ("/metrics", "GET"), ("/questions", "DELETE"),
+    ("/questions", "PATCH"), ("/questions/import", "POST"),
+    ("/questions/export", "GET")}
+QUIZ_QUESTION_COLUMNS = ("id", "question", "category", "difficulty")
+ADJUST_CATEGORY_STATS = (
+    "INSERT INTO category_stats (category_id, difficulty, count) "
+    "VALUES ($1, $2, $3) ON CONFLICT (category_id, difficulty) "
+    "DO UPDATE SET count = category_stats.count + excluded.count")
+
+"""
+create_async_app(database_url)
+    ASGI variant of the trivia API with the same JSON contracts as
+    flaskr.create_app, built on Quart with asyncpg (or aiosqlite for
+    SQLite URLs), so a worker process keeps serving other requests while
+    one waits on the database. It serves every route of the WSGI app but
+    WSGI_ONLY_ROUTES, and does not stream large listings or fall back to
+    a snapshot. Run it with an ASGI server from backend/:
+
+        uvicorn --factory async_app:create_async_app
+
+    It installs the same invalidation channel as the WSGI app: the
+    database change log (async_change_log.py), or the FileChannel in
+    INVALIDATION_DIR. Its question, search and category indexes load
+    when the server starts; before each request they patch in the rows
+    other workers wrote, and writes here are recorded in their own
+    transaction for the other workers to see.
+"""
+
+
+def format_rows(rows, fields=QUESTION_FIELDS):
+    return [{field: row[field] for field in fields} for row in rows]
+
+
+def select_columns(fields):
+    return ", ".join(query_columns(fields))
+
+
+def create_async_app(database_url=None):
+    app = Quart(__name__)
+    database = connect_database(database_url or DATABASE_URL,
+                                DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    question_index = QuestionIndex()
+    search_index = SearchIndex()
+    category_registry = CategoryRegistry()
+    database_channel = None
+    if INVALIDATION_DIR:
+        invalidation.use_channel(invalidation.FileChannel(INVALIDATION_DIR))
+    else:
+        database_channel = AsyncDatabaseChannel(database,
+                                                INVALIDATION_INTERVAL)
+        invalidation.use_channel(database_channel)
+
+    def rows_by_ids(columns):
+        async def fetch(ids):
+            return await database.fetch(
+                "SELECT {} FROM questions WHERE id IN ({})".format(
+                    columns, placeholders(ids)), *ids)
+        return fetch
+
+    async def refresh():
+        if database_channel is not None:
+            await database_channel.poll()
+        changes = database_channel.changes if database_channel else None
+        await category_registry.refresh_async(lambda: database.fetch(
+            "SELECT id, type FROM categories"))
+        await question_index.refresh_async(
+            lambda: database.fetch(
+                "SELECT id, category_id, difficulty FROM questions"),
+            rows_by_ids("id, category_id, difficulty"), changes)
+        await search_index.refresh_async(
+            lambda: database.fetch(
+                "SELECT id, question, answer FROM questions"),
+            rows_by_ids("id, question, answer"), changes)
+
+    @app.before_serving
+    async def connect():
+        await database.connect()
+        await refresh()
+
+    @app.after_serving
+    async def disconnect():
+        await database.close()
+
+    @app.before_request
+    async def refresh_indexes():
+        await refresh()
+
+    @app.after_request
+    async def after_request(response):
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.headers["Access-Control-Allow-Headers"] = \
+            "Content-Type,Authorization,true"
+        response.headers["Access-Control-Allow-Methods"] = \
+            "GET,PUT,POST,DELETE,OPTIONS"
+        return response
+
+    async def record_write(question, connection):
+        """logs a write inside its transaction (see models.record_write)"""
+        if database_channel is None:
+            return None
+        return await database_channel.record("questions", [question.id],
+                                             connection)
+
+    def notify_write(action, question, version):
+        version = invalidation.committed("questions", [question.id],
+                                         version)
+        question_index.on_write(action, question, version)
+        search_index.on_write(action, question, version)
+
+    async def questions_by_ids(ids, fields=QUESTION_FIELDS):
+        """the query_columns(fields) of these questions, in the order of
+        ids; deleted questions are left out"""
+        if not ids:
+            return []
+        rows = await database.fetch(
+            "SELECT {} FROM questions WHERE id IN ({})".format(
+                select_columns(fields), placeholders(ids)), *ids)
+        rank = {question_id: position for position, question_id
+                in enumerate(ids)}
+        return sorted(rows, key=lambda row: rank[row["id"]])
+
+    async def quiz_questions(ids):
+        return format_rows(await questions_by_ids(ids, QUIZ_QUESTION_COLUMNS),
+                           QUIZ_QUESTION_COLUMNS)
+
+    def listing_fields():
+        """the fields a GET request asks for; 422 for an unknown one"""
+        try:
+            return requested_fields(request.args.get("fields"))
+        except ValueError:
+            abort(422)
+
+    def with_categories(body):
+        """adds the category map to a listing unless the client already
+        holds this version of it"""
+        version = category_registry.version()
+        body["categoriesVersion"] = version
+        if wants_categories(request.args, version):
+            body["categories"] = category_registry.as_dict()
+        return body
+
+    async def paginated_questions(fields):
+        page = request.args.get("page", 1, type=int)
+        cursor = request.args.get("cursor")
+        ids = question_index.ids()
+        if cursor:
+            rows = await database.fetch(
+                "SELECT {} FROM questions WHERE id > $1 ORDER BY id "
+                "LIMIT $2".format(select_columns(fields)),
+                decode_cursor(cursor), QUESTIONS_PER_PAGE)
+        else:
+            offset = (max(page, 1) - 1) * QUESTIONS_PER_PAGE
+            if offset >= len(ids):
+                abort(404)
+            rows = await database.fetch(
+                "SELECT {} FROM questions WHERE id >= $1 ORDER BY id "
+                "LIMIT $2".format(select_columns(fields)),
+                ids[offset], QUESTIONS_PER_PAGE)
+        if not rows:
+            abort(404)
+        next_cursor = None
+        if len(rows) == QUESTIONS_PER_PAGE:
+            next_cursor = encode_cursor(rows[-1]["id"])
+        return jsonify(with_categories({
+            "questions": format_rows(rows, fields),
+            "totalQuestions": len(ids),
+            "currentCategory": category_registry.get(rows[0]["category"]),
+            "nextCursor": next_cursor
+            }))
+
+    @app.route("/categories", methods=["GET"])
+    async def get_categories():
+        try:
+            return jsonify({
+                "categories": category_registry.as_dict()
+                })
+        except Exception:
+            abort(405)
+
+    @app.route("/categories/stats", methods=["GET"])
+    async def get_category_stats():
+        try:
+            rows = await database.fetch(
+                "SELECT category_id, difficulty, count FROM category_stats "
+                "WHERE count > 0 ORDER BY category_id, difficulty")
+            stats = {}
+            for row in rows:
+                stats.setdefault(row["category_id"], {})[
+                    str(row["difficulty"])] = row["count"]
+            categories = {}
+            for category_id, category_type in \
+                    category_registry.as_dict().items():
+                difficulties = stats.get(int(category_id), {})
+                categories[category_id] = {
+                    "type": category_type,
+                    "totalQuestions": sum(difficulties.values()),
+                    "difficulties": difficulties
+                    }
+            return jsonify({
+                "success": True,
+                "categories": categories,
+                "totalQuestions": sum(category["totalQuestions"] for
+                                      category in categories.values())
+                })
+        except Exception:
+            abort(422)
+
+    @app.route("/questions", methods=["GET"])
+    async def questions_endpoint():
+        fields = listing_fields()
+        try:
+            return await paginated_questions(fields)
+        except Exception:
+            abort(404)
+
+    @app.route("/questions/<int:id>", methods=["GET"])
+    async def get_question(id):
+        fields = listing_fields()
+        try:
+            rows = await database.fetch(
+                "SELECT {} FROM questions WHERE id = $1".format(
+                    ", ".join(fields)), id)
+            if not rows:
+                abort(404)
+            return jsonify({
+                "success": True,
+                "question": format_rows(rows, fields)[0]
+                })
+        except Exception:
+            abort(404)
+
+    @app.route("/questions/<int:id>", methods=["DELETE"])
+    async def delete_question(id):
+        question = None
+        try:
+            async with database.transaction() as connection:
+                rows = await connection.fetch(
+                    "SELECT id, category_id, difficulty FROM questions "
+                    "WHERE id = $1", id)
+                question = rows[0] if rows else None
+                await connection.execute(
+                    "DELETE FROM questions WHERE id = $1", id)
+                await connection.execute(
+                    ADJUST_CATEGORY_STATS, question["category_id"],
+                    question["difficulty"], -1)
+                deleted = SimpleNamespace(**dict(question))
+                version = await record_write(deleted, connection)
+            notify_write("delete", deleted, version)
+            return jsonify({
+                "id": id
+                })
+        except Exception:
+            if question is None:
+                abort(404)
+            abort(422)
+
+    @app.route("/questions", methods=["POST"])
+    async def post_question():
+        error = None
+        try:
+            body = await request.get_json()
+            if body.get("searchTerm", 1) == 1:
+                question_ = body.get("question")
+                answer_ = body.get("answer")
+                difficulty_ = body.get("difficulty")
+                category_ = body.get("category")
+                if answer_ is None or difficulty_ is None:
+                    abort(422)
+                if category_ is None or question_ is None:
+                    abort(422)
+                async with database.transaction() as connection:
+                    question_id = await connection.fetchval(
+                        "INSERT INTO questions (question, answer, category, "
+                        "category_id, difficulty) VALUES ($1, $2, "
+                        "$3::integer, $3::integer, $4::integer) "
+                        "RETURNING id",
+                        question_, answer_, int(category_), int(difficulty_))
+                    await connection.execute(
+                        ADJUST_CATEGORY_STATS, int(category_),
+                        int(difficulty_), 1)
+                    inserted = SimpleNamespace(
+                        id=question_id, question=question_, answer=answer_,
+                        category_id=int(category_),
+                        difficulty=int(difficulty_))
+                    version = await record_write(inserted, connection)
+                notify_write("insert", inserted, version)
+                return jsonify({
+                    "success": True
+                    })
+            page = body.get("page", 1)
+            if type(page) is not int or page < 1:
+                abort(422)
+            fields = requested_fields(body.get("fields"))
+            matching_ids = search_index.search(
+                body.get("searchTerm"), body.get("searchAnswers", False))
+            if not len(matching_ids):
+                return jsonify({"no results": "question not found"})
+            start = (page - 1) * QUESTIONS_PER_PAGE
+            if start >= len(matching_ids):
+                error = 404
+                abort(404)
+            rows = await questions_by_ids(
+                matching_ids[start:start + QUESTIONS_PER_PAGE], fields)
+            return jsonify({
+                "questions": format_rows(rows, fields),
+                "totalQuestions": len(matching_ids),
+                "currentCategory": category_registry.get(rows[0]["category"])
+                })
+        except Exception:
+            if error == 404:
+                abort(404)
+            abort(422)
+
+    @app.route("/categories/<int:id>/questions", methods=["GET"])
+    async def get_question_by_category(id):
+        fields = listing_fields()
+        try:
+            if id == 0:
+                return await paginated_questions(fields)
+            currentCategory = category_registry.get(id)
+            if currentCategory is None:
+                abort(404)
+            totalQuestions = question_index.count(id)
+            if totalQuestions == 0:
+                abort(404)
+            rows = await database.fetch(
+                "SELECT {} FROM questions WHERE category_id = $1 "
+                "ORDER BY id".format(", ".join(fields)), id)
+            return jsonify({
+                "questions": format_rows(rows, fields),
+                "totalQuestions": totalQuestions,
+                "currentCategory": currentCategory
+                })
+        except Exception:
+            abort(404)
+
+    def quiz_batch(body, questions):
+        """the /quizzes response: the next question, and with "count"
+        the whole batch"""
+        response = {"question": questions[0] if questions else None}
+        if body.get("count") is not None:
+            response["questions"] = questions
+        return jsonify(response)
+
+    @app.route("/quizzes", methods=["POST"])
+    async def get_next_question():
+        cat = None
+        error = None
+        try:
+            body = await request.get_json()
+            previous_questions_list = body.get("previous_questions") or []
+            quiz_category = body.get("quiz_category")
+            difficulty = body.get("difficulty")
+            if difficulty is not None:
+                difficulty = int(difficulty)
+            count = body.get("count")
+            count = 1 if count is None else max(1, min(int(count),
+                                                       QUIZ_BATCH_MAX))
+            fields = requested_fields(body.get("fields"))
+            try:
+                cat = quiz_category.get("type")
+            except Exception:
+                pass
+            if cat is not None:
+                if cat == "click":
+                    cat = random.choice(category_registry.types())
+                quiz_category_id = category_registry.find(cat)
+                if quiz_category_id is None:
+                    error = 404
+                    abort(404)
+                sampled_ids = question_index.sample(
+                    quiz_category_id, previous_questions_list, count,
+                    difficulty)
+                return quiz_batch(body, format_rows(
+                    await questions_by_ids(sampled_ids, fields), fields))
+
+            quiz_category_id = category_registry.find(quiz_category)
+            if quiz_category_id is None or not previous_questions_list:
+                error = 404
+                abort(404)
+            sampled_ids = question_index.sample(quiz_category_id,
+                                                previous_questions_list,
+                                                count, difficulty)
+            if not sampled_ids:
+                error = 404
+                abort(404)
+            return quiz_batch(body, format_rows(
+                await questions_by_ids(sampled_ids, fields), fields))
+        except Exception:
+            if error == 404:
+                abort(404)
+            else:
+                abort(405)
+
+    quiz_sessions = QuizSessionStore(create_cache(
+        CACHE_URL, QUIZ_SESSION_MAX, QUIZ_SESSION_TTL, "trivia:quiz:"),
+        question_index)
+
+    async def prefetch_count(default=1):
+        """the "count" of upcoming questions a session request asks for,
+        capped at QUIZ_BATCH_MAX"""
+        body = await request.get_json(silent=True) or {}
+        return max(0, min(int(body.get("count", default)), QUIZ_BATCH_MAX))
+
+    def quiz_session_or_404(session_id):
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+        return session
+
+    @app.route("/quizzes/sessions", methods=["POST"])
+    async def start_quiz_session():
+        error = 422
+        try:
+            body = await request.get_json()
+            quiz_category = body.get("quiz_category")
+            number_of_questions = min(int(body.get(
+                "questions", DEFAULT_QUESTIONS)), MAX_QUESTIONS)
+            if isinstance(quiz_category, dict):
+                quiz_category = quiz_category.get("type")
+            quiz_category_id = None
+            if quiz_category not in (None, "click"):
+                quiz_category_id = category_registry.find(quiz_category)
+                if quiz_category_id is None:
+                    error = 404
+                    abort(404)
+            difficulty = body.get("difficulty")
+            if difficulty is not None:
+                difficulty = int(difficulty)
+            if body.get("adaptive"):
+                session = quiz_sessions.start_adaptive(
+                    quiz_category_id, number_of_questions,
+                    difficulty or DEFAULT_DIFFICULTY)
+            else:
+                question_ids = question_index.sample(
+                    quiz_category_id, (), number_of_questions, difficulty)
+                session = quiz_sessions.start(
+                    quiz_category_id, question_ids) if question_ids else None
+            if session is None:
+                error = 404
+                abort(404)
+            questions = await quiz_questions(quiz_sessions.upcoming(
+                session, max(1, await prefetch_count())))
+            return jsonify({
+                "success": True,
+                "sessionId": session["id"],
+                "question": questions[0] if questions else None,
+                "questions": questions,
+                "totalQuestions": session["total"],
+                "difficulty": session["difficulty"]
+                })
+        except Exception:
+            abort(error)
+
+    @app.route("/quizzes/sessions/<session_id>", methods=["GET"])
+    async def get_quiz_session(session_id):
+        session = quiz_session_or_404(session_id)
+        return jsonify({
+            "success": True,
+            "stats": quiz_sessions.stats(session)
+            })
+
+    @app.route("/quizzes/sessions/<session_id>/answers", methods=["POST"])
+    async def answer_quiz_question(session_id):
+        session = quiz_session_or_404(session_id)
+        question_id = quiz_sessions.current_id(session)
+        if question_id is None:
+            abort(404)
+        # a client that sends the question it shows is not scored against
+        # another one when its answer overtakes a /next
+        body = await request.get_json(silent=True) or {}
+        answered_id = body.get("questionId")
+        if answered_id is not None and answered_id != question_id:
+            abort(409)
+        try:
+            answer = await database.fetchval(
+                "SELECT answer FROM questions WHERE id = $1", question_id)
+            correct = quiz_sessions.answer(
+                session, answer, (await request.get_json()).get("answer"))
+            return jsonify({
+                "correct": correct,
+                "answer": answer,
+                "score": session["score"],
+                "stats": quiz_sessions.stats(session)
+                })
+        except Exception:
+            abort(422)
+
+    @app.route("/quizzes/sessions/<session_id>/next", methods=["POST"])
+    async def next_quiz_question(session_id):
+        session = quiz_session_or_404(session_id)
+        try:
+            count = await prefetch_count()
+        except (TypeError, ValueError):
+            abort(422)
+        questions = []
+        question_id = quiz_sessions.advance(session)
+        while question_id is not None and count:
+            questions = await quiz_questions(
+                quiz_sessions.upcoming(session, count))
+            if questions and questions[0]["id"] == question_id:
+                break
+            questions = []
+            question_id = quiz_sessions.advance(session)
+        return jsonify({
+            "questionId": question_id,
+            "question": questions[0] if questions else None,
+            "questions": questions,
+            "stats": quiz_sessions.stats(session)
+            })
+
+    @app.errorhandler(404)
+    async def page_not_found(error):
+        return (jsonify({
+            "success": False,
+            "error": 404,
+            "message": "resource not found"
+            }), 404)
+
+    @app.errorhandler(405)
+    async def bad_request(error):
+        return (jsonify({
+            "success": False,
+            "error": 405,
+            "message": "method not allowed"
+            }), 405)
+
+    @app.errorhandler(409)
+    async def conflict(error):
+        return (jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+            }), 409)
+
+    @app.errorhandler(422)
+    async def not_processable(error):
+        return (jsonify({
+            "success": False,
+            "error": 422,
+            "message": "request not processable"
+            }), 422)
+
+    return app
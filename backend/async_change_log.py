@@ -0,0 +1,85 @@
+import logging
+import time
+
+from invalidation import CHANGE_LOG_SIZE
+
+ENSURE = ("INSERT INTO topic_versions (topic, version) VALUES ($1, 0) "
+          "ON CONFLICT (topic) DO NOTHING")
+BUMP = "UPDATE topic_versions SET version = version + 1 WHERE topic = $1"
+
+logger = logging.getLogger("trivia.invalidation")
+
+"""
+Async database invalidation channel
+
+AsyncDatabaseChannel is DatabaseChannel (change_log.py) for the ASGI app:
+the same topic_versions and topic_changes tables, read and written
+through async_db, so ASGI and WSGI workers see each other's writes.
+record, changes and poll are coroutines; version(topic) returns the
+versions read by the last poll(), which re-reads them at most once every
+`interval` seconds.
+"""
+
+
+class AsyncDatabaseChannel:
+    shared = True
+
+    def __init__(self, database, interval=1, log_size=CHANGE_LOG_SIZE):
+        self.database = database
+        self.interval = interval
+        self.log_size = log_size
+        self._versions = {}
+        self._checked = 0
+
+    async def poll(self):
+        now = time.monotonic()
+        if now - self._checked < self.interval:
+            return
+        self._checked = now
+        try:
+            rows = await self.database.fetch(
+                "SELECT topic, version FROM topic_versions")
+        except Exception as error:
+            logger.warning("cannot read topic versions: %s",
+                           str(error).splitlines()[0])
+            return
+        self._versions = {row[0]: row[1] for row in rows}
+
+    def version(self, topic):
+        return self._versions.get(topic, 0)
+
+    def seen(self, topic, version):
+        self._versions[topic] = max(version, self._versions.get(topic, 0))
+
+    async def record(self, topic, items, connection):
+        """bumps topic inside the transaction of connection and logs the
+        ids the write touched, None meaning all of them; returns the new
+        version, visible once that commits"""
+        items = [None] if items is None else sorted(set(items))
+        await connection.execute(ENSURE, topic)
+        await connection.execute(BUMP, topic)
+        version = await connection.fetchval(
+            "SELECT version FROM topic_versions WHERE topic = $1", topic)
+        ids = [item for item in items if item is not None]
+        values = ["($1, $2, ${})".format(position)
+                  for position in range(3, 3 + len(ids))]
+        if None in items:
+            values.append("($1, $2, NULL)")
+        await connection.execute(
+            "INSERT INTO topic_changes (topic, version, item_id) VALUES "
+            + ", ".join(values), topic, version, *ids)
+        await connection.execute(
+            "DELETE FROM topic_changes WHERE topic = $1 AND version <= $2",
+            topic, version - self.log_size)
+        return version
+
+    async def changes(self, topic, since):
+        """(version, ids) for every write after since, or None when the
+        log no longer covers them or one of them touched everything"""
+        rows = await self.database.fetch(
+            "SELECT version, item_id FROM topic_changes WHERE topic = $1 "
+            "AND version > $2", topic, since)
+        if not rows or min(row[0] for row in rows) != since + 1 or \
+                any(row[1] is None for row in rows):
+            return None
+        return max(row[0] for row in rows), {row[1] for row in rows}
@@ -0,0 +1,134 @@
+import asyncio
+from contextlib import asynccontextmanager
+import re
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+PLACEHOLDER = re.compile(r"\$(\d+)(::\w+)?")
+
+"""
+Async database access for the ASGI app
+
+Queries are written once in PostgreSQL style ($1, $2::integer) and run
+through asyncpg, or through aiosqlite after the placeholders are rewritten
+to "?". Rows from both drivers unpack like tuples and index by column name.
+Statements run inside `async with database.transaction() as connection`
+commit or roll back together.
+"""
+
+
+class AsyncpgDatabase:
+    def __init__(self, url, min_size=1, max_size=10):
+        if asyncpg is None:
+            raise RuntimeError("AsyncpgDatabase requires the asyncpg package")
+        self.url = re.sub(r"^postgresql\+\w+://", "postgresql://", url)
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+
+    async def connect(self):
+        self._pool = await asyncpg.create_pool(
+            self.url, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self):
+        await self._pool.close()
+
+    async def fetch(self, sql, *args):
+        return await self._pool.fetch(sql, *args)
+
+    async def fetchval(self, sql, *args):
+        return await self._pool.fetchval(sql, *args)
+
+    async def execute(self, sql, *args):
+        await self._pool.execute(sql, *args)
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self._pool.acquire() as connection:
+            async with connection.transaction():
+                yield connection
+
+
+class AiosqliteDatabase:
+    def __init__(self, path):
+        if aiosqlite is None:
+            raise RuntimeError(
+                "AiosqliteDatabase requires the aiosqlite package")
+        self.path = path
+        self._connection = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        self._connection = await aiosqlite.connect(self.path)
+        self._connection.row_factory = aiosqlite.Row
+
+    async def close(self):
+        await self._connection.close()
+
+    def _translate(self, sql, args):
+        positions = [int(match.group(1)) - 1
+                     for match in PLACEHOLDER.finditer(sql)]
+        return PLACEHOLDER.sub("?", sql), [args[n] for n in positions]
+
+    async def _fetch(self, sql, args):
+        sql, args = self._translate(sql, args)
+        async with self._connection.execute(sql, args) as cursor:
+            return await cursor.fetchall()
+
+    async def fetch(self, sql, *args):
+        async with self._lock:
+            rows = await self._fetch(sql, args)
+            await self._connection.commit()
+        return rows
+
+    async def fetchval(self, sql, *args):
+        rows = await self.fetch(sql, *args)
+        return rows[0][0] if rows else None
+
+    async def execute(self, sql, *args):
+        await self.fetch(sql, *args)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """the shared connection is held until the transaction ends"""
+        async with self._lock:
+            try:
+                yield AiosqliteTransaction(self)
+            except BaseException:
+                await self._connection.rollback()
+                raise
+            await self._connection.commit()
+
+
+class AiosqliteTransaction:
+    def __init__(self, database):
+        self._database = database
+
+    async def fetch(self, sql, *args):
+        return await self._database._fetch(sql, args)
+
+    async def fetchval(self, sql, *args):
+        rows = await self.fetch(sql, *args)
+        return rows[0][0] if rows else None
+
+    async def execute(self, sql, *args):
+        await self.fetch(sql, *args)
+
+
+def connect_database(url, max_size=10):
+    if url.startswith("sqlite"):
+        return AiosqliteDatabase(url.split(":///", 1)[1] or ":memory:")
+    return AsyncpgDatabase(url, max_size=max_size)
+
+
+def placeholders(values, start=1):
+    return ", ".join("${}".format(n) for n in
+                     range(start, start + len(values)))
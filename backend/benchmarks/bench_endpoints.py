@@ -0,0 +1,492 @@
+import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from pagination import encode_cursor
+
+"""
+Endpoint benchmark
+
+Drives every route of flaskr.create_app with synthetic data, through the
+Flask test client ("client" mode, no network) and through a threaded WSGI
+server on localhost ("server" mode), at each requested concurrency level.
+For every scenario it reports p50/p95/p99 latency, throughput, errors, the
+peak Python allocation of one request and the process peak RSS.
+
+--save writes the results to a baseline JSON file. --compare reads one
+back and exits with status 1 when a scenario's p95 grew, or its
+throughput fell, by more than --tolerance. Run from backend/:
+
+    python -m benchmarks.bench_endpoints --database-url \\
+        sqlite:////tmp/bench.db --categories 6 --questions 1000 \\
+        --concurrency 1 8 --save baseline.json
+
+The app reads DATABASE_URL when it is imported, so the flaskr and models
+imports happen in main() after the URL is set. Set CACHE_MAX_ENTRIES=0 to
+measure the GET routes without the response cache.
+"""
+
+Scenario = namedtuple("Scenario", "name group build after share")
+Request = namedtuple("Request", "method path body content_type")
+Result = namedtuple("Result", "status body")
+
+BENCH_PREFIX = "Benchmark insert"
+SESSION_POOL = 64
+IMPORT_RECORDS = 50
+
+
+def get(path):
+    return Request("GET", path, None, None)
+
+
+def post(path, body=None):
+    return Request("POST", path, json.dumps(body or {}), "application/json")
+
+
+def search_term(rng, state):
+    return rng.choice(state["words"])
+
+
+def category(rng, state):
+    category_id = rng.choice(list(state["categories"]))
+    return {"type": state["categories"][category_id], "id": category_id}
+
+
+def question_page(rng, state):
+    pages = max(1, state["total"] // 10)
+    return get("/questions?page={}".format(rng.randint(1, pages)))
+
+
+def question_cursor(rng, state):
+    return get("/questions?cursor={}".format(rng.choice(state["cursors"])))
+
+
+def category_questions(rng, state):
+    return get("/categories/{}/questions".format(category(rng, state)["id"]))
+
+
+def search(rng, state):
+    return post("/questions", {"searchTerm": search_term(rng, state)})
+
+
+def search_page(rng, state):
+    return post("/questions", {"searchTerm": search_term(rng, state),
+                               "page": rng.randint(1, 5)})
+
+
+def quiz(rng, state):
+    return post("/quizzes", {
+        "quiz_category": category(rng, state),
+        "previous_questions": rng.sample(state["ids"],
+                                         min(4, len(state["ids"])))
+        })
+
+
+def quiz_at_difficulty(rng, state):
+    return post("/quizzes", {
+        "quiz_category": category(rng, state),
+        "previous_questions": rng.sample(state["ids"],
+                                         min(4, len(state["ids"]))),
+        "difficulty": rng.randint(1, 5)
+        })
+
+
+def start_adaptive_session(rng, state):
+    return post("/quizzes/sessions", {"quiz_category": category(rng, state),
+                                      "questions": 10, "adaptive": True,
+                                      "difficulty": rng.randint(1, 5)})
+
+
+def start_session(rng, state):
+    return post("/quizzes/sessions", {"quiz_category": category(rng, state),
+                                      "questions": 10})
+
+
+def keep_session(state, result):
+    with state["lock"]:
+        if len(state["sessions"]) < SESSION_POOL:
+            state["sessions"].append(json.loads(result.body)["sessionId"])
+
+
+def session_path(rng, state, suffix=""):
+    return "/quizzes/sessions/{}{}".format(rng.choice(state["sessions"]),
+                                           suffix)
+
+
+def session_stats(rng, state):
+    return get(session_path(rng, state))
+
+
+def session_answer(rng, state):
+    return post(session_path(rng, state, "/answers"),
+                {"answer": search_term(rng, state)})
+
+
+def session_next(rng, state):
+    return post(session_path(rng, state, "/next"))
+
+
+def create_question(rng, state):
+    return post("/questions", {
+        "question": "{} {}?".format(BENCH_PREFIX, search_term(rng, state)),
+        "answer": search_term(rng, state),
+        "category": str(category(rng, state)["id"]),
+        "difficulty": rng.randint(1, 5)
+        })
+
+
+def delete_question(rng, state):
+    with state["lock"]:
+        question_id = state["created"].pop() if state["created"] else 0
+    return Request("DELETE", "/questions/{}".format(question_id), None, None)
+
+
+def import_questions(rng, state):
+    lines = [json.dumps({
+        "question": "{} {}?".format(BENCH_PREFIX, search_term(rng, state)),
+        "answer": search_term(rng, state),
+        "category": str(category(rng, state)["id"]),
+        "difficulty": rng.randint(1, 5)
+        }) for _ in range(IMPORT_RECORDS)]
+    return Request("POST", "/questions/import", "\n".join(lines),
+                   "application/x-ndjson")
+
+
+"""
+share scales the request count for expensive scenarios; the write
+scenarios run last so the read scenarios see the generated data only.
+"""
+
+SCENARIOS = (
+    Scenario("health", "meta", lambda rng, state: get("/health"),
+             None, 1),
+    Scenario("categories", "categories",
+             lambda rng, state: get("/categories"), None, 1),
+    Scenario("category_stats", "categories",
+             lambda rng, state: get("/categories/stats"), None, 1),
+    Scenario("questions_page", "pagination", question_page, None, 1),
+    Scenario("questions_cursor", "pagination", question_cursor, None, 1),
+    Scenario("category_questions", "pagination", category_questions,
+             None, 0.1),
+    Scenario("search", "search", search, None, 1),
+    Scenario("search_page", "search", search_page, None, 1),
+    Scenario("quiz", "quiz", quiz, None, 1),
+    Scenario("quiz_difficulty", "quiz", quiz_at_difficulty, None, 1),
+    Scenario("quiz_adaptive_start", "quiz", start_adaptive_session,
+             keep_session, 1),
+    Scenario("quiz_session_start", "quiz", start_session, keep_session, 1),
+    Scenario("quiz_session_stats", "quiz", session_stats, None, 1),
+    Scenario("quiz_session_answer", "quiz", session_answer, None, 1),
+    Scenario("quiz_session_next", "quiz", session_next, None, 1),
+    Scenario("export", "bulk",
+             lambda rng, state: get("/questions/export"), None, 0.02),
+    Scenario("create_question", "writes", create_question, None, 1),
+    Scenario("delete_question", "writes", delete_question, None, 1),
+    Scenario("import", "bulk", import_questions, None, 0.1),
+    )
+
+
+class ClientTransport:
+    """calls the app in process through one test client per thread"""
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def __call__(self, request):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(request.path, method=request.method,
+                               data=request.body,
+                               content_type=request.content_type)
+        return Result(response.status_code, response.get_data())
+
+    def close(self):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ServerTransport:
+    """sends real HTTP requests to a WSGI server, started here if needed"""
+    def __init__(self, app=None, url=None):
+        self.server = None
+        if url is None:
+            self.server = make_server("127.0.0.1", 0, app, threaded=True,
+                                      request_handler=QuietRequestHandler)
+            threading.Thread(target=self.server.serve_forever,
+                             daemon=True).start()
+            url = "127.0.0.1:{}".format(self.server.server_port)
+        self.host = url.split("://")[-1].rstrip("/")
+
+    def __call__(self, request):
+        connection = http.client.HTTPConnection(self.host, timeout=60)
+        headers = {}
+        if request.content_type:
+            headers["Content-Type"] = request.content_type
+        try:
+            connection.request(request.method, request.path,
+                               body=request.body, headers=headers)
+            response = connection.getresponse()
+            return Result(response.status, response.read())
+        finally:
+            connection.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def peak_allocation(transport, request):
+    tracemalloc.start()
+    try:
+        transport(request)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_scenario(transport, scenario, state, requests, concurrency, seed):
+    count = max(concurrency, int(requests * scenario.share))
+    rng = random.Random(seed)
+    prepared = [scenario.build(rng, state) for _ in range(count)]
+    latencies = []
+    errors = []
+
+    def send(request):
+        started = time.perf_counter()
+        result = transport(request)
+        elapsed = time.perf_counter() - started
+        if result.status >= 400:
+            errors.append(result.status)
+        elif scenario.after is not None:
+            scenario.after(state, result)
+        return elapsed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(send, prepared))
+    wall = time.perf_counter() - started
+    return {
+        "group": scenario.group,
+        "requests": count,
+        "errors": len(errors),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput_rps": count / wall if wall else 0.0,
+        "peak_alloc_kb": peak_allocation(
+            transport, scenario.build(rng, state)) / 1024,
+        "peak_rss_mb": peak_rss_mb()
+        }
+
+
+def load_state(db, Question, Category, words):
+    ids = [row[0] for row in
+           db.session.query(Question.id).order_by(Question.id)]
+    return {
+        "categories": {row[0]: row[1] for row in
+                       db.session.query(Category.id, Category.type)},
+        "ids": ids,
+        "total": len(ids),
+        "cursors": [encode_cursor(question_id) for question_id in
+                    ids[::max(1, len(ids) // 100)]],
+        "words": words,
+        "sessions": [],
+        "created": [],
+        "lock": threading.Lock()
+        }
+
+
+def created_ids(db, Question):
+    return [row[0] for row in db.session.query(Question.id)
+            .filter(Question.question.like(BENCH_PREFIX + "%"))]
+
+
+def remove_created(db, Question, notify_write):
+    db.session.query(Question).filter(
+        Question.question.like(BENCH_PREFIX + "%"))\
+        .delete(synchronize_session=False)
+    db.session.commit()
+    notify_write("reload")
+
+
+def run(transport, state, args, refresh_created):
+    results = {}
+    for concurrency in args.concurrency:
+        level = results[str(concurrency)] = {}
+        for scenario in SCENARIOS:
+            if args.only and scenario.group not in args.only and \
+                    scenario.name not in args.only:
+                continue
+            if scenario.name == "delete_question":
+                state["created"] = refresh_created()
+            if scenario.name.startswith("quiz_session_") and \
+                    not state["sessions"] and \
+                    scenario.name != "quiz_session_start":
+                continue
+            level[scenario.name] = run_scenario(
+                transport, scenario, state, args.requests, concurrency,
+                args.seed)
+            print_result(concurrency, scenario.name, level[scenario.name])
+    return results
+
+
+def print_header(mode):
+    print("\n[{}]".format(mode))
+    print("{:>5} {:<22} {:>7} {:>6} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+        "conc", "scenario", "reqs", "errs", "p50 ms", "p95 ms", "p99 ms",
+        "req/s", "alloc kB"))
+
+
+def print_result(concurrency, name, result):
+    print("{:>5} {:<22} {:>7} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.1f} "
+          "{:>10.1f}".format(concurrency, name, result["requests"],
+                             result["errors"], result["p50_ms"],
+                             result["p95_ms"], result["p99_ms"],
+                             result["throughput_rps"],
+                             result["peak_alloc_kb"]))
+
+
+def compare(baseline, results, tolerance):
+    """returns a line for every scenario that regressed against baseline"""
+    regressions = []
+    for mode, levels in results.items():
+        for concurrency, scenarios in levels.items():
+            for name, result in scenarios.items():
+                try:
+                    base = baseline["results"][mode][concurrency][name]
+                except KeyError:
+                    continue
+                if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+                    regressions.append("{} c={} {}: p95 {:.2f} ms -> {:.2f} "
+                                       "ms".format(mode, concurrency, name,
+                                                   base["p95_ms"],
+                                                   result["p95_ms"]))
+                if result["throughput_rps"] < \
+                        base["throughput_rps"] * (1 - tolerance):
+                    regressions.append("{} c={} {}: {:.1f} req/s -> {:.1f} "
+                                       "req/s".format(
+                                           mode, concurrency, name,
+                                           base["throughput_rps"],
+                                           result["throughput_rps"]))
+                if result["errors"] > base["errors"]:
+                    regressions.append("{} c={} {}: {} errors -> {}".format(
+                        mode, concurrency, name, base["errors"],
+                        result["errors"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark every trivia API route.")
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--questions", type=int, default=1000,
+                        help="questions per category")
+    parser.add_argument("--no-seed", action="store_true",
+                        help="use the data already in the database")
+    parser.add_argument("--modes", nargs="+", default=["client", "server"],
+                        choices=["client", "server"])
+    parser.add_argument("--server-url",
+                        help="benchmark this running server in server mode "
+                             "instead of starting one")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per scenario and concurrency level")
+    parser.add_argument("--only", nargs="+",
+                        help="scenario names or groups to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = args.database_url
+    from flaskr import create_app
+    from models import db, notify_write, Question, Category
+    from benchmarks.datagen import generate, WORDS
+
+    app = create_app()
+    with app.app_context():
+        if not args.no_seed:
+            db.create_all()
+            generate(args.categories, args.questions, args.seed)
+            notify_write("reload")
+        state = load_state(db, Question, Category, WORDS)
+
+    def refresh_created():
+        with app.app_context():
+            return created_ids(db, Question)
+
+    results = {}
+    for mode in args.modes:
+        print_header(mode)
+        if mode == "client":
+            transport = ClientTransport(app)
+        else:
+            transport = ServerTransport(app, args.server_url)
+        try:
+            results[mode] = run(transport, state, args, refresh_created)
+        finally:
+            transport.close()
+            with app.app_context():
+                remove_created(db, Question, notify_write)
+            state["sessions"] = []
+
+    report = {
+        "meta": {
+            "database": args.database_url.split(":")[0],
+            "categories": len(state["categories"]),
+            "questions": state["total"],
+            "requests": args.requests,
+            "python": platform.python_version(),
+            "created": time.time()
+            },
+        "results": results
+        }
+    if args.save:
+        with open(args.save, "w") as target:
+            json.dump(report, target, indent=2, sort_keys=True)
+        print("\nsaved {}".format(args.save))
+    if args.compare:
+        with open(args.compare) as source:
+            regressions = compare(json.load(source), results,
+                                  args.tolerance)
+        if regressions:
+            print("\nregressions against {}:".format(args.compare))
+            for line in regressions:
+                print("  " + line)
+            sys.exit(1)
+        print("\nno regressions against {}".format(args.compare))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import time
+import tracemalloc
+
+from flask import Flask
+
+import encoding
+from models import setup_db, db, Question
+
+BACKENDS = ("json", "ujson", "orjson")
+
+"""
+Serialization benchmark
+
+Compares hydrating Question instances and calling format() with the
+Question.rows()/format_rows() tuple fast path, per row CPU time and peak
+allocations, on an in-memory SQLite database. Then encodes the same
+listing with every installed JSON backend (see encoding.py) and reports
+the time per row and the raw, gzip and brotli sizes. Run from backend/:
+
+    python -m benchmarks.bench_serialization --sizes 10 1000 100000
+"""
+
+
+def seed(count):
+    db.session.query(Question).delete()
+    db.session.execute(Question.__table__.insert(), [{
+        "question": "Synthetic question number {}?".format(n),
+        "answer": "answer {}".format(n),
+        "category": str(n % 6 + 1),
+        "difficulty": n % 5 + 1
+        } for n in range(count)])
+    db.session.commit()
+
+
+def orm_path(count):
+    return [item.format() for item in Question.query.limit(count)]
+
+
+def rows_path(count):
+    return Question.format_rows(Question.rows().limit(count))
+
+
+def measure(function, count, repeat):
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        started = time.perf_counter()
+        function(count)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    db.session.expunge_all()
+    tracemalloc.start()
+    function(count)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best / count * 1e6, peak / count
+
+
+def encode_time(encoder, payload, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        encoder.encode(payload)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def encoding_report(size, repeat):
+    payload = {"questions": rows_path(size), "totalQuestions": size}
+    baseline = None
+    for backend in BACKENDS:
+        try:
+            encoder = encoding.json_encoder(backend)(sort_keys=False)
+        except RuntimeError:
+            continue
+        elapsed = encode_time(encoder, payload, repeat)
+        baseline = baseline or elapsed
+        body = encoder.encode(payload).encode("utf-8")
+        brotli_size = "-"
+        if encoding.brotli is not None:
+            brotli_size = len(encoding.compress(body, "br"))
+        print("{:>8} {:>10} {:>14.2f} {:>10} {:>10} {:>10} {:>10.2f}".format(
+            size, backend, elapsed / size * 1e6, len(body),
+            len(encoding.compress(body, "gzip")), brotli_size,
+            baseline / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare ORM and tuple question serialization.")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10, 1000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, "sqlite://")
+    with app.app_context():
+        db.create_all()
+        seed(max(args.sizes))
+        print("{:>8} {:>10} {:>14} {:>14} {:>14} {:>14}".format(
+            "rows", "path", "us/row", "bytes/row", "cpu ratio",
+            "alloc ratio"))
+        for size in args.sizes:
+            orm = measure(orm_path, size, args.repeat)
+            rows = measure(rows_path, size, args.repeat)
+            print("{:>8} {:>10} {:>14.2f} {:>14.0f}".format(
+                size, "orm", *orm))
+            print("{:>8} {:>10} {:>14.2f} {:>14.0f} {:>14.2f} {:>14.2f}"
+                  .format(size, "rows", *rows, orm[0] / rows[0],
+                          orm[1] / rows[1]))
+        print()
+        print("{:>8} {:>10} {:>14} {:>10} {:>10} {:>10} {:>10}".format(
+            "rows", "encoder", "us/row", "bytes", "gzip", "brotli",
+            "speedup"))
+        for size in args.sizes:
+            encoding_report(size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
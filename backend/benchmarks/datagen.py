@@ -0,0 +1,84 @@
+import argparse
+import random
+
+from flask import Flask
+
+from models import setup_db, db, Question, Category
+
+BATCH_SIZE = 5000
+WORDS = ("river", "planet", "painter", "battle", "element", "mountain",
+         "novel", "empire", "ocean", "symphony", "engine", "island",
+         "theorem", "festival", "desert", "comet", "language", "bridge",
+         "harvest", "kingdom", "voltage", "glacier", "opera", "treaty")
+
+"""
+Synthetic data generator
+
+Fills a database with `categories` categories and `questions` questions in
+each of them, drawn from a small vocabulary so searches have matches. The
+same seed always produces the same rows. It works against SQLite or
+PostgreSQL; run from backend/:
+
+    python -m benchmarks.datagen --database-url sqlite:////tmp/bench.db \\
+        --categories 6 --questions 1000
+"""
+
+
+def sentence(rng, length):
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+
+def question_rows(categories, questions, seed=0):
+    rng = random.Random(seed)
+    for category_id in range(1, categories + 1):
+        for _ in range(questions):
+            yield {
+                "question": sentence(rng, 8).capitalize() + "?",
+                "answer": sentence(rng, 2),
+                "category": str(category_id),
+                "category_id": category_id,
+                "difficulty": rng.randint(1, 5)
+                }
+
+
+def generate(categories, questions, seed=0):
+    """replaces every category and question in the bound database"""
+    db.session.query(Question).delete()
+    db.session.query(Category).delete()
+    db.session.execute(Category.__table__.insert(), [{
+        "id": category_id,
+        "type": "Category {}".format(category_id)
+        } for category_id in range(1, categories + 1)])
+    batch = []
+    for row in question_rows(categories, questions, seed):
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(Question.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(Question.__table__.insert(), batch)
+    db.session.commit()
+    return categories * questions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill a database with synthetic trivia questions.")
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--questions", type=int, default=1000,
+                        help="questions per category")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    setup_db(app, args.database_url)
+    with app.app_context():
+        db.create_all()
+        count = generate(args.categories, args.questions, args.seed)
+    print("generated {} categories and {} questions".format(
+        args.categories, count))
+
+
+if __name__ == "__main__":
+    main()
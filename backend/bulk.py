@@ -0,0 +1,161 @@
+from collections import Counter
+import csv
+import io
+import json
+
+import click
+from flask.cli import AppGroup
+
+from category_registry import category_registry
+from models import db, notify_write, record_write, Question, \
+    CategoryStat
+
+DEFAULT_BATCH_SIZE = 1000
+COLUMNS = ("question", "answer", "category", "difficulty")
+FORMATS = ("ndjson", "csv")
+
+"""
+Bulk question import and export
+
+Imports read NDJSON or CSV records lazily, validate them against the
+category registry and write them batch_size rows at a time: COPY on
+PostgreSQL, executemany elsewhere. The whole import is one transaction,
+which also adds the imported counts to category_stats, and the question
+indexes are rebuilt once at the end. Exports stream rows from
+a server side cursor, so neither direction holds the table in memory.
+"""
+
+
+class BulkError(ValueError):
+    def __init__(self, line, message):
+        super().__init__("line {}: {}".format(line, message))
+        self.line = line
+
+
+def read_records(lines, fmt="ndjson"):
+    """yields (line_number, record) from an iterable of text lines"""
+    if fmt == "csv":
+        for line, record in enumerate(csv.DictReader(lines), start=2):
+            yield line, record
+        return
+    for line, text in enumerate(lines, start=1):
+        if text.strip():
+            try:
+                yield line, json.loads(text)
+            except ValueError:
+                raise BulkError(line, "invalid JSON")
+
+
+def validate(line, record):
+    try:
+        row = {column: record[column] for column in COLUMNS}
+        row["difficulty"] = int(row["difficulty"])
+    except (KeyError, TypeError, ValueError):
+        raise BulkError(line, "expected {}".format(", ".join(COLUMNS)))
+    if not row["question"] or not row["answer"]:
+        raise BulkError(line, "question and answer must not be empty")
+    if category_registry.get(row["category"]) is None:
+        raise BulkError(line, "unknown category {}".format(row["category"]))
+    row["category"] = str(row["category"])
+    row["category_id"] = int(row["category"])
+    return row
+
+
+def batches(records, batch_size):
+    batch = []
+    for line, record in records:
+        batch.append(validate(line, record))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_batch(connection, batch):
+    columns = COLUMNS + ("category_id",)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in batch:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert("COPY questions ({}) FROM STDIN WITH CSV"
+                       .format(", ".join(columns)), buffer)
+
+
+def import_questions(records, batch_size=DEFAULT_BATCH_SIZE):
+    """inserts validated records in one transaction; returns the count"""
+    imported = 0
+    buckets = Counter()
+    with db.engine.begin() as connection:
+        use_copy = connection.dialect.name == "postgresql"
+        for batch in batches(records, batch_size):
+            if use_copy:
+                copy_batch(connection, batch)
+            else:
+                connection.execute(Question.__table__.insert(), batch)
+            buckets.update((row["category_id"], row["difficulty"])
+                           for row in batch)
+            imported += len(batch)
+        CategoryStat.adjust_many(buckets, connection)
+        version = record_write("reload", connection=connection) \
+            if imported else None
+    if imported:
+        notify_write("reload", version=version)
+    return imported
+
+
+def export_questions(fmt="ndjson", batch_size=DEFAULT_BATCH_SIZE):
+    """yields the questions table as NDJSON or CSV text, in id order"""
+    columns = ("id",) + COLUMNS
+    rows = db.session.query(*[getattr(Question, column)
+                              for column in columns])\
+        .order_by(Question.id).yield_per(batch_size)
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+        return
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row))) + "\n"
+
+
+def format_of(filename, default="ndjson"):
+    return "csv" if filename.lower().endswith(".csv") else default
+
+
+questions_cli = AppGroup("questions", help="Bulk question import/export.")
+
+
+@questions_cli.command("import")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(FORMATS))
+@click.option("--batch-size", default=DEFAULT_BATCH_SIZE, show_default=True)
+def import_command(source, fmt, batch_size):
+    """Load questions from an NDJSON or CSV file ("-" for stdin)."""
+    fmt = fmt or format_of(source.name)
+    try:
+        imported = import_questions(read_records(source, fmt), batch_size)
+    except BulkError as error:
+        raise click.ClickException(str(error))
+    click.echo("imported {} questions".format(imported))
+
+
+@questions_cli.command("export")
+@click.argument("target", type=click.File("w", encoding="utf-8"),
+                default="-")
+@click.option("--format", "fmt", type=click.Choice(FORMATS))
+@click.option("--batch-size", default=DEFAULT_BATCH_SIZE, show_default=True)
+def export_command(target, fmt, batch_size):
+    """Write every question as NDJSON or CSV (stdout by default)."""
+    fmt = fmt or format_of(target.name)
+    for chunk in export_questions(fmt, batch_size):
+        target.write(chunk)
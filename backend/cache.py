@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import json
+import threading
+import time
+from urllib.parse import urlencode
+
+from flask import request, Response
+
+import invalidation
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+"""
+Response cache
+
+cached_response(cache) wraps a GET view and stores its body under a key
+made of the path, the sorted query string and the current version of
+every topic the view depends on. A committed question write bumps the
+"questions" version, so stale entries are never read again and simply age
+out. Responses carry a strong ETag and If-None-Match is answered with 304.
+
+A cache shared by several workers (RedisCache) needs versions that every
+worker shares too, or two workers at the same local version but with
+different data would write the same key. create_cache therefore refuses
+a shared backend for versioned keys unless the invalidation channel is
+shared, as the database channel is. A worker then moves to the new keys
+within the channel's polling interval after a write anywhere.
+
+Values stored in a cache backend must be JSON serializable so the shared
+backend can hold them too.
+"""
+
+
+class LRUCache:
+    def __init__(self, maxsize=512, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (ttl or self.ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache:
+    def __init__(self, url, ttl=60, prefix="trivia:"):
+        if redis is None:
+            raise RuntimeError("RedisCache requires the redis package")
+        self.ttl = ttl
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self._client.get(self.prefix + key)
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(self.prefix + key, json.dumps(value),
+                         ex=ttl or self.ttl)
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self._client.scan_iter(self.prefix + "*"):
+            self._client.delete(key)
+
+
+def create_cache(url=None, maxsize=512, ttl=60, prefix="trivia:",
+                 versioned=False):
+    """versioned: the keys embed topic versions (see cache_key)"""
+    if url:
+        if versioned and not invalidation.channel.shared:
+            raise RuntimeError("a shared response cache needs an "
+                               "invalidation channel every worker shares; "
+                               "unset INVALIDATION_DIR")
+        return RedisCache(url, ttl, prefix)
+    return LRUCache(maxsize, ttl)
+
+
+def cache_key(topics):
+    versions = ",".join(str(invalidation.version(topic))
+                        for topic in topics)
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return "{}?{}#{}".format(request.path, query, versions)
+
+
+def conditional_response(entry):
+    if request.if_none_match.contains_weak(entry["etag"]):
+        response = Response(status=304)
+    else:
+        response = Response(entry["body"], mimetype=entry["mimetype"])
+    response.set_etag(entry["etag"])
+    return response
+
+
+def cached_response(cache, topics=("questions",)):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = cache_key(topics)
+            entry = cache.get(key)
+            if entry is None:
+                response = view(*args, **kwargs)
+                if response.status_code != 200 or response.is_streamed \
+                        or "no-store" in response.cache_control:
+                    return response
+                body = response.get_data()
+                entry = {
+                    "body": body.decode("utf-8"),
+                    "etag": hashlib.sha1(body).hexdigest(),
+                    "mimetype": response.mimetype
+                    }
+                cache.set(key, entry)
+            return conditional_response(entry)
+        return wrapper
+    return decorator
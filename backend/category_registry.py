@@ -0,0 +1,111 @@
+import hashlib
+import json
+import time
+
+import invalidation
+from invalidation import VersionedIndex
+
+"""
+CategoryRegistry
+    categories keyed by id and by type, loaded once and shared by every
+    request
+
+    generation increases whenever the loaded categories change, and
+    version() is a digest of them that every worker agrees on. The
+    registry reloads when the "categories" topic is published (see
+    Category.insert) and, at most every few seconds, when a lookup misses,
+    so categories added behind the app's back still show up.
+"""
+
+
+def categories_version(categories):
+    """a short digest of an {id: type} map"""
+    encoded = json.dumps(sorted((str(category_id), category_type)
+                                for category_id, category_type
+                                in categories.items()))
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()[:12]
+
+
+class CategoryRegistry(VersionedIndex):
+    topic = "categories"
+    sync_rebuild = True
+    miss_refresh_interval = 5
+
+    def __init__(self):
+        super().__init__()
+        self._by_id = {}
+        self._by_type = {}
+        self._last_miss_refresh = 0
+        self._digest = categories_version({})
+        self.generation = 0
+
+    def _build(self, rows):
+        by_id = {int(category_id): category_type
+                 for category_id, category_type in rows}
+        if by_id == self._by_id:
+            return {}
+        return {
+            "_by_id": by_id,
+            "_by_type": {category_type: category_id
+                         for category_id, category_type in by_id.items()},
+            "_digest": categories_version(by_id),
+            "generation": self.generation + 1
+            }
+
+    def _apply(self, action, category):
+        return False
+
+    def refresh(self):
+        """reloads now; returns True when the categories changed"""
+        generation = self.generation
+        self.rebuild()
+        return self.generation != generation
+
+    def _refresh_on_miss(self):
+        now = time.monotonic()
+        if self._loader is None or \
+                now - self._last_miss_refresh < self.miss_refresh_interval:
+            return False
+        self._last_miss_refresh = now
+        if not self.refresh():
+            return False
+        with self._lock:
+            self._version = invalidation.publish(self.topic)
+        return True
+
+    def get(self, category_id):
+        """returns the type of category_id, or None"""
+        self.fresh()
+        try:
+            category_id = int(category_id)
+        except (TypeError, ValueError):
+            return None
+        category_type = self._by_id.get(category_id)
+        if category_type is None and self._refresh_on_miss():
+            category_type = self._by_id.get(category_id)
+        return category_type
+
+    def find(self, category_type):
+        """returns the id of the category named category_type, or None"""
+        self.fresh()
+        category_id = self._by_type.get(category_type)
+        if category_id is None and isinstance(category_type, str) and \
+                self._refresh_on_miss():
+            category_id = self._by_type.get(category_type)
+        return category_id
+
+    def types(self):
+        self.fresh()
+        return list(self._by_type)
+
+    def version(self):
+        self.fresh()
+        return self._digest
+
+    def as_dict(self):
+        self.fresh()
+        return {str(category_id): category_type
+                for category_id, category_type in self._by_id.items()}
+
+
+category_registry = CategoryRegistry()
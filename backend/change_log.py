@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import Column, Integer, Index, MetaData, String, Table, \
+    select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from invalidation import CHANGE_LOG_SIZE
+
+logger = logging.getLogger("trivia.invalidation")
+
+"""
+Database invalidation channel
+
+DatabaseChannel keeps each topic's version in the topic_versions table
+and the ids every write touched in topic_changes, so every worker on
+every host sees every write. Versions are re-read at most once every
+`interval` seconds, which bounds how stale a worker can be, and
+changes(topic, since) returns the ids written since a version, so
+readers patch just those rows instead of reloading. The log keeps the
+last CHANGE_LOG_SIZE versions of each topic; a reader further behind
+reloads.
+
+Writers record(topic, items, connection) in the transaction of the
+data they change, so the change log commits or rolls back with it and a
+committed write is never missed by other workers; a write whose change
+cannot be recorded fails. publish() records a change in a transaction of
+its own, for changes that are not database writes; it only logs a
+failure.
+"""
+
+
+metadata = MetaData()
+topic_versions = Table(
+    "topic_versions", metadata,
+    Column("topic", String(32), primary_key=True),
+    Column("version", Integer, nullable=False))
+topic_changes = Table(
+    "topic_changes", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("topic", String(32), nullable=False),
+    Column("version", Integer, nullable=False),
+    Column("item_id", Integer),
+    Index("ix_topic_changes_topic_version", "topic", "version"))
+
+
+class DatabaseChannel:
+    shared = True
+    ENSURE = text(
+        "INSERT INTO topic_versions (topic, version) VALUES (:topic, 0) "
+        "ON CONFLICT (topic) DO NOTHING")
+    # the row lock taken here is held until commit, so versions commit in
+    # order and a reader that sees version n also sees n's change rows
+    BUMP = text(
+        "UPDATE topic_versions SET version = version + 1 "
+        "WHERE topic = :topic")
+
+    def __init__(self, engine, interval=1, log_size=CHANGE_LOG_SIZE):
+        """engine is a callable returning the primary engine"""
+        self.engine = engine
+        self.interval = interval
+        self.log_size = log_size
+        self._versions = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _poll(self):
+        with self.engine().connect() as connection:
+            self._versions = dict(connection.execute(select([
+                topic_versions.c.topic, topic_versions.c.version]))
+                .fetchall())
+
+    def version(self, topic):
+        now = time.monotonic()
+        if now - self._checked >= self.interval:
+            with self._lock:
+                if now - self._checked >= self.interval:
+                    self._checked = now
+                    try:
+                        self._poll()
+                    except SQLAlchemyError as error:
+                        logger.warning("cannot read topic versions: %s",
+                                       str(error).splitlines()[0])
+        return self._versions.get(topic, 0)
+
+    def record(self, topic, items, connection):
+        """bumps topic in the transaction of connection (a connection or
+        session) and logs the ids the write touched, None meaning all of
+        them; returns the new version, visible once that commits"""
+        items = [None] if items is None else sorted(set(items))
+        connection.execute(self.ENSURE, {"topic": topic})
+        connection.execute(self.BUMP, {"topic": topic})
+        version = connection.execute(
+            select([topic_versions.c.version])
+            .where(topic_versions.c.topic == topic)).scalar()
+        if items:
+            connection.execute(topic_changes.insert(), [
+                {"topic": topic, "version": version, "item_id": item}
+                for item in items])
+        connection.execute(topic_changes.delete()
+                           .where(topic_changes.c.topic == topic)
+                           .where(topic_changes.c.version <=
+                                  version - self.log_size))
+        return version
+
+    def seen(self, topic, version):
+        """notes a version this worker committed, so it does not wait for
+        the next poll to see its own write"""
+        with self._lock:
+            self._versions[topic] = max(version,
+                                        self._versions.get(topic, 0))
+
+    def publish(self, topic, items=None):
+        try:
+            with self.engine().begin() as connection:
+                version = self.record(topic, items, connection)
+        except SQLAlchemyError as error:
+            logger.error("cannot publish a %s change; other workers will "
+                         "not see it: %s", topic,
+                         str(error).splitlines()[0])
+            return self._versions.get(topic, 0)
+        self.seen(topic, version)
+        return version
+
+    def changes(self, topic, since):
+        """(version, ids) for every write after since, or None when the
+        log no longer covers them or one of them touched everything"""
+        with self.engine().connect() as connection:
+            rows = connection.execute(
+                select([topic_changes.c.version, topic_changes.c.item_id])
+                .where(topic_changes.c.topic == topic)
+                .where(topic_changes.c.version > since)).fetchall()
+        if not rows or min(row[0] for row in rows) != since + 1 or \
+                any(row[1] is None for row in rows):
+            return None
+        return max(row[0] for row in rows), {row[1] for row in rows}
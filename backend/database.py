@@ -0,0 +1,179 @@
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import NullPool
+
+from settings import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, \
+    DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_PGBOUNCER, DB_STATEMENT_TIMEOUT_MS
+
+READ_METHODS = ("GET", "HEAD")
+
+"""
+Database configuration
+
+engine_options() turns the DB_* settings into create_engine arguments.
+With DB_PGBOUNCER=true the app keeps no pool of its own and leaves pooling
+to pgbouncer. Statement timeouts are set with SET LOCAL at the start of
+each transaction, which also works behind pgbouncer in transaction mode.
+
+When a replica is configured, GET and HEAD requests read from it. Writes,
+flushes and anything inside primary() go to the primary.
+"""
+
+_routing = threading.local()
+logger = logging.getLogger("trivia.database")
+
+
+def engine_options(uri):
+    if uri.startswith("sqlite"):
+        return {}
+    if DB_PGBOUNCER:
+        return {"poolclass": NullPool}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING
+        }
+
+
+@contextmanager
+def primary():
+    previous = getattr(_routing, "primary", False)
+    _routing.primary = True
+    try:
+        yield
+    finally:
+        _routing.primary = previous
+
+
+def on_primary(loader):
+    """wraps an index loader so its rows always come from the primary"""
+    def load(*args):
+        with primary():
+            return list(loader(*args))
+    return load
+
+
+def read_from_replica():
+    return has_request_context() and request.method in READ_METHODS and \
+        not getattr(_routing, "primary", False)
+
+
+def set_statement_timeout(milliseconds):
+    """overrides DB_STATEMENT_TIMEOUT_MS for the rest of this request"""
+    g.statement_timeout_ms = milliseconds
+
+
+def apply_statement_timeout(session, transaction, connection):
+    if not has_request_context() or connection.dialect.name != "postgresql":
+        return
+    timeout = g.get("statement_timeout_ms", DB_STATEMENT_TIMEOUT_MS)
+    if timeout:
+        connection.execute("SET LOCAL statement_timeout = {}"
+                           .format(int(timeout)))
+
+
+def pool_stats(db, app):
+    engines = {"primary": db.get_engine(app)}
+    if "replica" in (app.config.get("SQLALCHEMY_BINDS") or {}):
+        engines["replica"] = db.get_engine(app, bind="replica")
+    stats = {}
+    for name, engine in engines.items():
+        pool = engine.pool
+        stats[name] = {"class": type(pool).__name__}
+        if hasattr(pool, "checkedout"):
+            stats[name].update({
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow()
+                })
+    return stats
+
+
+class LazyInit:
+    """runs startup steps on first use instead of at import or
+    create_app time
+
+    ensure() runs the steps that have not succeeded yet and returns
+    whether all of them have. After a database error it waits
+    retry_after seconds, doubling up to max_retry_interval, before the
+    next attempt, so an unavailable database costs one quick failure per
+    interval instead of one per request. Given an app, ensure() runs the
+    steps in a thread with the app's context and waits at most `wait`
+    seconds for them, so a slow load holds requests for a bounded time;
+    requests are answered with retry_after until they are done.
+    """
+    def __init__(self, steps, retry_interval=1, max_retry_interval=30,
+                 app=None, wait=0):
+        self.steps = list(steps)
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.app = app
+        self.wait = wait
+        self.ready = False
+        self.retry_after = 0
+        self.last_error = None
+        self._done = 0
+        self._failures = 0
+        self._next_attempt = 0
+        self._running = False
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure(self, wait=None):
+        if self.ready:
+            return True
+        if self.app is None:
+            with self._lock:
+                return self.ready or self._attempt()
+        with self._lock:
+            finished = self._finished
+            if not self._running:
+                if time.monotonic() < self._next_attempt:
+                    return self.ready
+                self._running = True
+                self.retry_after = self.retry_after or self.retry_interval
+                finished = self._finished = threading.Event()
+                threading.Thread(target=self._run, args=(finished,),
+                                 name="startup", daemon=True).start()
+        wait = self.wait if wait is None else wait
+        if wait:
+            finished.wait(wait)
+        return self.ready
+
+    def _run(self, finished):
+        try:
+            with self.app.app_context():
+                self._attempt()
+        finally:
+            self._running = False
+            finished.set()
+
+    def _attempt(self):
+        if time.monotonic() < self._next_attempt:
+            return self.ready
+        try:
+            while self._done < len(self.steps):
+                self.steps[self._done]()
+                self._done += 1
+        except SQLAlchemyError as error:
+            self._failures += 1
+            self.retry_after = min(
+                self.max_retry_interval,
+                self.retry_interval * 2 ** (self._failures - 1))
+            self._next_attempt = time.monotonic() + self.retry_after
+            self.last_error = str(error).splitlines()[0]
+            logger.warning("startup failed, retrying in %ss: %s",
+                           self.retry_after, self.last_error)
+            return False
+        self.ready = True
+        self._failures = 0
+        self.last_error = None
+        return True
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+
+from flask import abort, g
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import HTTPException
+
+from database import set_statement_timeout
+from models import db
+
+STALE_HEADER = "X-Data-Stale"
+
+logger = logging.getLogger("trivia.degraded")
+
+"""
+Degraded reads
+
+Read endpoints call DegradedReads.read(primary, fallback). prepare()
+first brings the in-memory indexes up to date; catching up on other
+workers' writes is not the read itself, so it runs under the normal
+statement timeout and its time is not held against the budget. primary
+then runs the normal database read with the statement timeout lowered to
+the read budget. A database error, or a read that takes longer than the budget,
+counts as a failure for the circuit breaker; a database error is answered
+from the local snapshot (snapshot.py) right away.
+
+After `failures` failures in a row the breaker opens: for the next
+`reset_timeout` seconds reads go straight to the snapshot without touching
+the database, so a struggling database is not hit by every retry. Then
+one request is let through to probe it; success closes the breaker,
+failure opens it again.
+
+Responses built from the snapshot carry an X-Data-Stale header with the
+snapshot's age in seconds and Cache-Control: no-store, so neither the
+response cache nor clients keep them. Without a snapshot the request
+fails with 503 and a Retry-After of the time left until the next probe.
+"""
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failed = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """whether a request may try the database now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() - self._opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failed = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == self.HALF_OPEN or \
+                    self._failed >= self.failures:
+                self.trip()
+
+    def trip(self):
+        if self.state != self.OPEN:
+            logger.warning("circuit breaker opened for %ss",
+                           self.reset_timeout)
+        self.state = self.OPEN
+        self._opened = time.monotonic()
+
+    def retry_after(self):
+        if self.state == self.CLOSED:
+            return 0
+        return max(1, int(self.reset_timeout -
+                          (time.monotonic() - self._opened)))
+
+
+class DegradedReads:
+    def __init__(self, snapshots, breaker, budget_ms=500,
+                 ready=lambda: True, prepare=lambda: None):
+        self.snapshots = snapshots
+        self.breaker = breaker
+        self.budget_ms = budget_ms
+        self.ready = ready
+        self.prepare = prepare
+
+    def read(self, primary, fallback, error=404):
+        """primary() normally, fallback(snapshot) when the database fails
+        or the breaker is open; any other exception becomes abort(error)
+        """
+        if self.ready() and self.breaker.allow():
+            try:
+                self.prepare()
+                # primary's transaction starts under the read budget
+                db.session.rollback()
+            except SQLAlchemyError as database_error:
+                db.session.rollback()
+                self.breaker.record_failure()
+                logger.warning("refresh failed, serving the snapshot: %s",
+                               str(database_error).splitlines()[0])
+                return self.from_snapshot(fallback, error)
+            started = time.perf_counter()
+            try:
+                if self.budget_ms:
+                    set_statement_timeout(self.budget_ms)
+                response = primary()
+            except HTTPException:
+                self.breaker.record_success()
+                raise
+            except SQLAlchemyError as database_error:
+                db.session.rollback()
+                self.breaker.record_failure()
+                logger.warning("read failed, serving the snapshot: %s",
+                               str(database_error).splitlines()[0])
+            except Exception:
+                self.breaker.record_success()
+                abort(error)
+            else:
+                elapsed = (time.perf_counter() - started) * 1000
+                if self.budget_ms and elapsed > self.budget_ms:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                return response
+        return self.from_snapshot(fallback, error)
+
+    def from_snapshot(self, fallback, error=404):
+        snapshot = self.snapshots.current()
+        if snapshot is None:
+            g.retry_after = self.breaker.retry_after() or 1
+            abort(503)
+        try:
+            response = fallback(snapshot)
+        except HTTPException:
+            raise
+        except Exception:
+            abort(error)
+        response.headers[STALE_HEADER] = str(int(snapshot.age()))
+        response.headers["Cache-Control"] = "no-store"
+        return response
@@ -0,0 +1,157 @@
+import gzip
+import json
+
+from flask import request
+from flask.json import JSONEncoder
+
+from cache import LRUCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson",
+                          "text/csv", "text/plain")
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSED_CACHE_SIZE = 256
+
+"""
+Response encoding
+
+JSON: json_backend() picks orjson, then ujson, then the standard library,
+or the one named by JSON_BACKEND. FastJSONEncoder hands jsonify's
+payload to it and falls back to Flask's encoder for indented output and
+values the backend cannot encode (dates, decimals, ...), so every backend
+encodes the same data.
+
+Compression: compress_responses(app) gzips, or with the brotli package
+and a client that prefers it brotli-compresses, every JSON, NDJSON, CSV
+or text response of at least min_size bytes whose client sent a matching
+Accept-Encoding. Streamed responses are left alone. A response that
+carries an ETag, such as every response from the response cache, is
+compressed once per ETag and encoding and then served from an LRU of
+compressed bodies. Its ETag becomes weak, since the compressed bytes are
+a different representation of the same content.
+"""
+
+
+def json_backend(name="auto"):
+    """returns (name, dumps) for the JSON library to use; dumps(obj,
+    sort_keys) returns a str or raises TypeError/ValueError/OverflowError
+    for values the library cannot encode"""
+    if name in ("auto", "orjson") and orjson is not None:
+        def dumps(obj, sort_keys=False):
+            options = orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                options |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, option=options).decode("utf-8")
+        return "orjson", dumps
+    if name in ("auto", "ujson") and ujson is not None:
+        def dumps(obj, sort_keys=False):
+            return ujson.dumps(obj, sort_keys=sort_keys, ensure_ascii=False,
+                               escape_forward_slashes=False)
+        return "ujson", dumps
+    if name not in ("auto", "json"):
+        raise RuntimeError("JSON_BACKEND {} is not installed".format(name))
+
+    def dumps(obj, sort_keys=False):
+        return json.dumps(obj, sort_keys=sort_keys, separators=(",", ":"))
+    return "json", dumps
+
+
+def json_encoder(name="auto"):
+    """a FastJSONEncoder subclass bound to the backend called name"""
+    backend, dumps = json_backend(name)
+    return type("FastJSONEncoder", (FastJSONEncoder,), {
+        "backend": backend,
+        "dumps": staticmethod(dumps)
+        })
+
+
+class FastJSONEncoder(JSONEncoder):
+    backend = "json"
+    dumps = None
+
+    def encode(self, o):
+        if self.dumps is not None and self.indent is None:
+            try:
+                return self.dumps(o, self.sort_keys)
+            except (TypeError, ValueError, OverflowError):
+                pass
+        return super().encode(o)
+
+
+def accepted_encoding(accept_encodings):
+    """the content coding to use for this Accept-Encoding, or None"""
+    offers = ["gzip"]
+    if brotli is not None:
+        offers.insert(0, "br")
+    coding = accept_encodings.best_match(offers)
+    if coding is None or not accept_encodings[coding]:
+        return None
+    return coding
+
+
+def compress(body, coding):
+    if coding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, GZIP_LEVEL)
+
+
+class ResponseCompressor:
+    def __init__(self, min_size=1024, cache_size=COMPRESSED_CACHE_SIZE):
+        self.min_size = min_size
+        self.compressed = LRUCache(cache_size, ttl=3600)
+
+    def should_compress(self, response):
+        return request.method != "HEAD" and \
+            response.status_code == 200 and \
+            not response.direct_passthrough and \
+            not response.is_streamed and \
+            "Content-Encoding" not in response.headers and \
+            response.mimetype in COMPRESSIBLE_MIMETYPES
+
+    def __call__(self, response):
+        if not self.should_compress(response):
+            return response
+        response.vary.add("Accept-Encoding")
+        if response.content_length is not None and \
+                response.content_length < self.min_size:
+            return response
+        coding = accepted_encoding(request.accept_encodings)
+        if coding is None:
+            return response
+        etag, weak = response.get_etag()
+        key = "{}:{}".format(coding, etag) if etag else None
+        body = self.compressed.get(key) if key else None
+        if body is None:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            body = compress(data, coding)
+            if key:
+                self.compressed.set(key, body)
+        response.set_data(body)
+        response.headers["Content-Encoding"] = coding
+        if etag:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def compress_responses(app, min_size=1024):
+    """registers the compressor as an after_request hook of app"""
+    compressor = ResponseCompressor(min_size)
+    app.after_request(compressor)
+    return compressor
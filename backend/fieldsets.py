@@ -0,0 +1,55 @@
+QUESTION_FIELDS = ("id", "question", "answer", "category", "difficulty")
+
+"""
+Sparse fieldsets
+
+Listing, search and quiz requests may name the question fields they want,
+e.g. `fields=id,question,category`. Only those columns are selected and
+serialized; "id" is always included. Without `fields` every field is sent,
+as before.
+
+Listings also carry `categoriesVersion`, a digest of the category map
+that is the same in every worker (see categories_version in
+category_registry.py). A client that sends back the version it holds as
+`categoriesVersion=` only gets the map again when it changed.
+`include=categories`, or an `include` list without it, asks for it or
+not explicitly.
+"""
+
+
+def requested_fields(value, allowed=QUESTION_FIELDS):
+    """the fields named by a comma separated string or a list, in the
+    order of allowed; every field for None or an empty value. Raises
+    ValueError for a field that is not allowed."""
+    if not value:
+        return allowed
+    if isinstance(value, str):
+        value = value.split(",")
+    names = {str(name).strip() for name in value} - {""}
+    unknown = names - set(allowed)
+    if unknown:
+        raise ValueError("unknown fields: {}".format(
+            ", ".join(sorted(unknown))))
+    return tuple(field for field in allowed
+                 if field == "id" or field in names)
+
+
+def query_columns(fields):
+    """fields plus "category", which listings need for currentCategory;
+    it goes last so format_rows(rows, fields) drops it again"""
+    if "category" in fields:
+        return fields
+    return fields + ("category",)
+
+
+def project(rows, fields):
+    """rows (dicts with every field) narrowed to fields"""
+    return [{field: row[field] for field in fields} for row in rows]
+
+
+def wants_categories(args, version):
+    """whether a response should carry the category map"""
+    include = args.get("include")
+    if include is not None:
+        return "categories" in include.split(",")
+    return args.get("categoriesVersion") != version
@@ -1,19 +1,86 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, g, Response, \
+    stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import SQLAlchemyError
 from flask_cors import CORS
 import random
 
-from models import setup_db, Question, Category
+from admission import AdmissionControl, create_bucket_store
+from bulk import questions_cli, import_questions, export_questions, \
+    read_records, DEFAULT_BATCH_SIZE, FORMATS
+from cache import create_cache, cached_response
+from category_registry import category_registry, categories_version
+from change_log import DatabaseChannel
+from database import on_primary, pool_stats, LazyInit
+from degraded import CircuitBreaker, DegradedReads
+from encoding import json_encoder, compress_responses
+from fieldsets import requested_fields, query_columns, project, \
+    wants_categories, QUESTION_FIELDS
+from instrumentation import instrument, metrics
+from invalidation import use_channel, FileChannel
+from migrations import db_cli
+from models import setup_db, db, database_path, on_question_write, \
+    Question, Category, CategoryStat
+from sampling import sample_ids
+from partitions import partition_router
+from pagination import paginate, encode_cursor, decode_cursor
+from question_index import question_index
+from quiz_sessions import QuizSessionStore, DEFAULT_QUESTIONS, \
+    MAX_QUESTIONS, DEFAULT_DIFFICULTY
+from search_index import search_index
+from snapshot import SnapshotStore
+from streaming import wants_stream, stream_json_response, in_chunks, \
+    STREAM_BATCH_SIZE
+from settings import INVALIDATION_DIR, INVALIDATION_INTERVAL, CACHE_URL, \
+    CACHE_MAX_ENTRIES, CACHE_TTL, QUIZ_SESSION_MAX, QUIZ_SESSION_TTL, \
+    SLOW_REQUEST_MS, SERVER_TIMING, INIT_RETRY_SECONDS, \
+    INIT_RETRY_MAX_SECONDS, INIT_IN_BACKGROUND, INIT_WAIT_SECONDS, \
+    SNAPSHOT_PATH, SNAPSHOT_INTERVAL, READ_BUDGET_MS, BREAKER_FAILURES, \
+    BREAKER_RESET_SECONDS, QUIZ_BATCH_MAX, JSON_BACKEND, COMPRESSION, \
+    COMPRESS_MIN_BYTES, RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, \
+    RATE_LIMIT_URL, MAX_IN_FLIGHT, ROUTE_CONCURRENCY, ADMISSION_QUEUE, \
+    ADMISSION_QUEUE_TIMEOUT_MS
 
 QUESTIONS_PER_PAGE = 10
+QUIZ_QUESTION_COLUMNS = ("id", "question", "category", "difficulty")
+MAX_BATCH_IDS = 10000
+SNAPSHOT_COLUMNS = ("id", "question", "answer", "category", "category_id",
+                    "difficulty")
+# endpoints whose database work grows with the request, capped at
+# ROUTE_CONCURRENCY concurrent requests per worker
+EXPENSIVE_ENDPOINTS = ("post_question", "get_next_question",
+                       "start_quiz_session", "import_questions_endpoint",
+                       "export_questions_endpoint")
+# reads that fall back to the local snapshot when the database fails
+SNAPSHOT_ENDPOINTS = ("get_categories", "questions_endpoint",
+                      "get_question_by_category", "get_next_question")
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get("SQLALCHEMY_DATABASE_URI", database_path))
     CORS(app)
+    app.config.setdefault("JSONIFY_PRETTYPRINT_REGULAR", False)
+    app.json_encoder = json_encoder(app.config.get("JSON_BACKEND",
+                                                   JSON_BACKEND))
+    instrument(app, SLOW_REQUEST_MS, SERVER_TIMING)
+    if COMPRESSION:
+        compress_responses(app, app.config.get("COMPRESS_MIN_BYTES",
+                                               COMPRESS_MIN_BYTES))
+    # admission runs before every other before_request hook below
+    AdmissionControl(
+        create_bucket_store(RATE_LIMIT_URL, RATE_LIMIT_PER_SECOND,
+                            RATE_LIMIT_BURST)
+        if RATE_LIMIT_PER_SECOND else None,
+        {endpoint: ROUTE_CONCURRENCY for endpoint in EXPENSIVE_ENDPOINTS},
+        MAX_IN_FLIGHT, ADMISSION_QUEUE,
+        ADMISSION_QUEUE_TIMEOUT_MS / 1000).init_app(app)
+    app.cli.add_command(questions_cli)
+    app.cli.add_command(db_cli)
 
     @app.after_request
     def after_request(response):
@@ -21,53 +88,215 @@ def create_app(test_config=None):
             "Access-Control-Allow-Headers", "Content-Type,Authorization,true"
         )
         response.headers.add(
-            "Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS"
+            "Access-Control-Allow-Methods",
+            "GET,PUT,PATCH,POST,DELETE,OPTIONS"
         )
         return response
 
-    categories = Category.query.all()
-    dict_of_categories = {}
-    for item in categories:
-        dict_of_categories[str(item.id)] = item.type
+    if INVALIDATION_DIR:
+        use_channel(FileChannel(INVALIDATION_DIR))
+    else:
+        use_channel(DatabaseChannel(lambda: db.get_engine(app),
+                                    INVALIDATION_INTERVAL))
+    # the indexes load on the first request, not here, so the app starts
+    # without a database round trip and survives it being briefly down
+    index_columns = (Question.id, Question.category_id, Question.difficulty)
+    question_index.build(
+        on_primary(lambda: db.session.query(*index_columns)), lazy=True,
+        fetch=on_primary(lambda ids: db.session.query(*index_columns)
+                         .filter(Question.id.in_(ids))))
+    on_question_write(question_index.on_write)
+    search_columns = (Question.id, Question.question, Question.answer)
+    search_index.build(
+        on_primary(lambda: db.session.query(*search_columns)), lazy=True,
+        fetch=on_primary(lambda ids: db.session.query(*search_columns)
+                         .filter(Question.id.in_(ids))))
+    on_question_write(search_index.on_write)
+
+    response_cache = create_cache(CACHE_URL, CACHE_MAX_ENTRIES, CACHE_TTL,
+                                  versioned=True)
+
+    category_registry.build(on_primary(lambda: db.session.query(
+        Category.id, Category.type)), lazy=True)
+
+    startup = LazyInit([category_registry.fresh, question_index.fresh,
+                        search_index.fresh, partition_router.detect],
+                       INIT_RETRY_SECONDS, INIT_RETRY_MAX_SECONDS,
+                       app if app.config.get("INIT_IN_BACKGROUND",
+                                             INIT_IN_BACKGROUND) else None,
+                       app.config.get("INIT_WAIT_SECONDS", INIT_WAIT_SECONDS))
+
+    snapshots = SnapshotStore(
+        app.config.get("SNAPSHOT_PATH", SNAPSHOT_PATH),
+        lambda: db.session.query(Category.id, Category.type).all(),
+        lambda: Question.rows(*SNAPSHOT_COLUMNS).order_by(Question.id)
+        .yield_per(STREAM_BATCH_SIZE),
+        SNAPSHOT_INTERVAL)
+
+    def refresh_indexes():
+        category_registry.fresh()
+        question_index.fresh()
+
+    degraded = DegradedReads(
+        snapshots, CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET_SECONDS),
+        READ_BUDGET_MS, lambda: startup.ready, refresh_indexes)
+    app.extensions["degraded"] = degraded
+
+    @app.before_request
+    def ensure_started():
+        if request.endpoint in ("health", "get_metrics"):
+            return
+        if not startup.ensure():
+            if request.endpoint in SNAPSHOT_ENDPOINTS and \
+                    snapshots.current() is not None:
+                return
+            g.retry_after = startup.retry_after
+            abort(503)
+
+    @app.after_request
+    def refresh_snapshot(response):
+        if snapshots.path and startup.ready and \
+                degraded.breaker.state == CircuitBreaker.CLOSED and \
+                snapshots.stale():
+            snapshots.refresh_in_background(app)
+        return response
+
+    @app.route("/health", methods=["GET"])
+    def health():
+        return jsonify({
+            "success": True,
+            "ready": startup.ensure(wait=0),
+            "error": startup.last_error,
+            "breaker": degraded.breaker.state,
+            "pools": pool_stats(db, app)
+            })
+
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        return Response(metrics.render(pool_stats(db, app)),
+                        mimetype="text/plain; version=0.0.4")
 
     @app.route("/categories", methods=["GET"])
+    @cached_response(response_cache, topics=("categories",))
     def get_categories():
+        return degraded.read(
+            lambda: jsonify({
+                "categories": category_registry.as_dict()
+                }),
+            lambda snapshot: jsonify({
+                "categories": snapshot.category_dict()
+                }), 405)
+
+    @app.route("/categories/stats", methods=["GET"])
+    @cached_response(response_cache, topics=("questions", "categories"))
+    def get_category_stats():
         try:
+            stats = CategoryStat.summary()
+            categories = {}
+            for category_id, category_type in \
+                    category_registry.as_dict().items():
+                difficulties = stats.get(int(category_id), {})
+                categories[category_id] = {
+                    "type": category_type,
+                    "totalQuestions": sum(difficulties.values()),
+                    "difficulties": {str(difficulty): count for
+                                     difficulty, count in
+                                     sorted(difficulties.items())}
+                    }
             return jsonify({
-                "categories": dict_of_categories
+                "success": True,
+                "categories": categories,
+                "totalQuestions": sum(category["totalQuestions"] for
+                                      category in categories.values())
                 })
         except Exception:
-            abort(405)
+            abort(422)
+
+    def with_categories(body, categories, version):
+        """adds the category map to a listing unless the client already
+        holds this version of it"""
+        body["categoriesVersion"] = version
+        if wants_categories(request.args, version):
+            body["categories"] = categories()
+        return body
+
+    def listing_fields():
+        """the fields a GET request asks for; 422 for an unknown one, which
+        degraded.read would otherwise answer with its 404"""
+        try:
+            return requested_fields(request.args.get("fields"))
+        except ValueError:
+            abort(422)
+
+    def paginated_questions():
+        page = request.args.get("page", 1, type=int)
+        cursor = request.args.get("cursor")
+        fields = requested_fields(request.args.get("fields"))
+        questions, next_cursor = paginate(
+            Question.rows(*query_columns(fields)), Question.id, page, cursor,
+            QUESTIONS_PER_PAGE, question_index.ids())
+        if not questions:
+            abort(404)
+        list_of_formated_questions = Question.format_rows(questions, fields)
+        total_questions = question_index.count()
+        currentCategory = category_registry.get(questions[0].category)
+        return jsonify(with_categories({
+            "questions": list_of_formated_questions,
+            "totalQuestions": total_questions,
+            "currentCategory": currentCategory,
+            "nextCursor": next_cursor
+            }, category_registry.as_dict, category_registry.version()))
+
+    def snapshot_questions(snapshot, category_id=None):
+        ids = snapshot.ids(category_id)
+        cursor = request.args.get("cursor")
+        questions = snapshot.page(
+            ids, request.args.get("page", 1, type=int),
+            decode_cursor(cursor) if cursor else None, QUESTIONS_PER_PAGE)
+        if not questions:
+            abort(404)
+        next_cursor = None
+        if len(questions) == QUESTIONS_PER_PAGE:
+            next_cursor = encode_cursor(questions[-1]["id"])
+        return jsonify(with_categories({
+            "questions": project(questions, requested_fields(
+                request.args.get("fields"))),
+            "totalQuestions": len(ids),
+            "currentCategory": snapshot.category_type(
+                questions[0]["category"]),
+            "nextCursor": next_cursor
+            }, snapshot.category_dict,
+            categories_version(snapshot.categories)))
 
     @app.route("/questions", methods=["GET"])
+    @cached_response(response_cache, topics=("questions", "categories"))
     def questions_endpoint():
+        listing_fields()
+        return degraded.read(paginated_questions, snapshot_questions)
+
+    @app.route("/questions/<int:id>", methods=["GET"])
+    def get_question(id):
+        fields = listing_fields()
         try:
-            questions = Question.query.order_by(Question.id).all()
-            page = request.args.get("page", 1, type=int)
-            start = (page - 1) * QUESTIONS_PER_PAGE
-            end = start + QUESTIONS_PER_PAGE
-            slice_of_questions = questions[start:end]
-            list_of_formated_questions = [item.format() for item in
-                                          slice_of_questions]
-            total_questions = len(questions)
-            currentCategory_id = int(slice_of_questions[0].category)
-            currentCategory = Category.query.filter(Category.id ==
-                                                    currentCategory_id)\
-                .first().type
-            categories = dict_of_categories
+            questions = Question.format_rows(partition_router.lookup(
+                Question.rows(*fields).filter(Question.id == id), [id]),
+                fields)
+            if not questions:
+                abort(404)
             return jsonify({
-                "questions": list_of_formated_questions,
-                "totalQuestions": total_questions,
-                "categories": categories,
-                "currentCategory": currentCategory
+                "success": True,
+                "question": questions[0]
                 })
         except Exception:
             abort(404)
 
     @app.route("/questions/<int:id>", methods=["DELETE"])
     def delete_question(id):
+        question = None
         try:
-            question = Question.query.filter(Question.id == id).first()
+            questions = partition_router.lookup(
+                Question.query.filter(Question.id == id), [id])
+            question = questions[0] if questions else None
             question.delete()
             return jsonify({
                 "id": question.id
@@ -77,8 +306,85 @@ def create_app(test_config=None):
                 abort(404)
             abort(422)
 
+    def batch_criteria(body):
+        """the WHERE clause of a batch write: "ids" and/or a "filter" on
+        category, difficulty and searchTerm; never empty"""
+        criteria = []
+        ids = body.get("ids")
+        if ids is not None:
+            if not isinstance(ids, list) or len(ids) > MAX_BATCH_IDS:
+                abort(422)
+            ids = [int(item) for item in ids]
+            criteria.append(Question.id.in_(ids))
+        batch_filter = body.get("filter") or {}
+        if batch_filter.get("category") is not None:
+            criteria.append(
+                Question.category_id == int(batch_filter["category"]))
+        if batch_filter.get("difficulty") is not None:
+            criteria.append(
+                Question.difficulty == int(batch_filter["difficulty"]))
+        if batch_filter.get("searchTerm"):
+            criteria.append(Question.question.ilike(
+                "%{}%".format(batch_filter["searchTerm"])))
+        if not criteria:
+            abort(422)
+        return criteria
+
+    @app.route("/questions", methods=["DELETE"])
+    def delete_questions():
+        try:
+            deleted = Question.delete_where(
+                *batch_criteria(request.get_json()))
+            return jsonify({
+                "success": True,
+                "deleted": deleted
+                })
+        except Exception:
+            db.session.rollback()
+            abort(422)
+
+    @app.route("/questions", methods=["PATCH"])
+    def update_questions():
+        try:
+            body = request.get_json()
+            criteria = batch_criteria(body)
+            values = {}
+            changes = body.get("set") or {}
+            if changes.get("difficulty") is not None:
+                values["difficulty"] = int(changes["difficulty"])
+            if changes.get("category") is not None:
+                if category_registry.get(changes["category"]) is None:
+                    abort(422)
+                values["category"] = int(changes["category"])
+            if not values:
+                abort(422)
+            updated = Question.update_where(values, *criteria)
+            return jsonify({
+                "success": True,
+                "updated": updated
+                })
+        except Exception:
+            db.session.rollback()
+            abort(422)
+
+    def ranked_rows(ids, fields=QUESTION_FIELDS):
+        rank = {question_id: position for position, question_id
+                in enumerate(ids)}
+        questions = partition_router.lookup(
+            Question.rows(*query_columns(fields))
+            .filter(Question.id.in_(ids)), ids)
+        return sorted(questions, key=lambda item: rank[item.id])
+
+    def ranked_questions(ids, fields=QUESTION_FIELDS):
+        return Question.format_rows(ranked_rows(ids, fields), fields)
+
+    def ranked_question_stream(ids, fields=QUESTION_FIELDS):
+        for chunk in in_chunks(ids):
+            yield from ranked_questions(chunk, fields)
+
     @app.route("/questions", methods=["POST"])
     def post_question():
+        error = None
         try:
             if request.get_json().get("searchTerm", 1) == 1:
                 question_ = request.get_json().get("question")
@@ -99,110 +405,345 @@ def create_app(test_config=None):
                     })
             else:
                 searchTerm = request.get_json().get("searchTerm")
-                questions = Question.query.filter(Question.question.
-                                                  ilike(f"%{searchTerm}%"))\
-                    .all()
-                if not len(questions):
+                page = request.get_json().get("page", 1)
+                if type(page) is not int or page < 1:
+                    abort(422)
+                searchAnswers = request.get_json().get("searchAnswers", False)
+                fields = requested_fields(request.get_json().get("fields"))
+                matching_ids = search_index.search(searchTerm, searchAnswers)
+                if not len(matching_ids):
                     return jsonify({"no results": "question not found"})
-                category = Category.query.filter(Category.id == questions[0]
-                                                 .category).first().type
+                if wants_stream(len(matching_ids),
+                                request.get_json().get("stream")):
+                    # a stream carries every match, so page does not apply
+                    first = question_index.categories_of(matching_ids[:1])
+                    return stream_json_response(
+                        ranked_question_stream(matching_ids, fields),
+                        totalQuestions=len(matching_ids),
+                        currentCategory=category_registry.get(first.pop())
+                        if first else None)
+                start = (page - 1) * QUESTIONS_PER_PAGE
+                if start >= len(matching_ids):
+                    error = 404
+                    abort(404)
+                rows = ranked_rows(
+                    matching_ids[start:start + QUESTIONS_PER_PAGE], fields)
+                category = category_registry.get(rows[0].category)
                 return jsonify({
-                    "questions": [item.format() for item in questions],
-                    "totalQuestions": len(questions),
+                    "questions": Question.format_rows(rows, fields),
+                    "totalQuestions": len(matching_ids),
                     "currentCategory": category
                     })
         except Exception:
+            if error == 404:
+                abort(404)
+            abort(422)
+
+    @app.route("/questions/import", methods=["POST"])
+    def import_questions_endpoint():
+        try:
+            fmt = request.args.get("format", "ndjson")
+            batch_size = request.args.get("batch_size", DEFAULT_BATCH_SIZE,
+                                          type=int)
+            if fmt not in FORMATS or batch_size < 1:
+                abort(422)
+            lines = (line.decode("utf-8") for line in request.stream)
+            imported = import_questions(read_records(lines, fmt), batch_size)
+            return jsonify({
+                "success": True,
+                "imported": imported
+                })
+        except Exception:
+            abort(422)
+
+    @app.route("/questions/export", methods=["GET"])
+    def export_questions_endpoint():
+        fmt = request.args.get("format", "ndjson")
+        if fmt not in FORMATS:
             abort(422)
+        mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+        return Response(stream_with_context(export_questions(fmt)),
+                        mimetype=mimetype)
 
     @app.route("/categories/<int:id>/questions", methods=["GET"])
+    @cached_response(response_cache, topics=("questions", "categories"))
     def get_question_by_category(id):
+        listing_fields()
+        return degraded.read(lambda: questions_in_category(id),
+                             lambda snapshot: snapshot_category_questions(
+                                 snapshot, id))
+
+    def questions_in_category(id):
         try:
             if id == 0:
-                questions = Question.query.order_by(Question.id).all()
-                page = request.args.get("page", 1, type=int)
-                start = (page - 1) * QUESTIONS_PER_PAGE
-                end = start + QUESTIONS_PER_PAGE
-                slice_of_questions = questions[start:end]
-                list_of_formated_questions = [item.format() for item in
-                                              slice_of_questions]
-                total_questions = len(questions)
-                currentCategory_id = int(slice_of_questions[0].category)
-                currentCategory = Category.query.filter(Category.id ==
-                                                        currentCategory_id)\
-                    .first().type
-                categories = dict_of_categories
-                return jsonify({
-                    "questions": list_of_formated_questions,
-                    "totalQuestions": total_questions,
-                    "categories": categories,
-                    "currentCategory": currentCategory
-                    })
-            category = Category.query.filter(Category.id == id).first()
-            questions = Question.query.filter(Question.category ==
-                                              str(category.id)).all()
-            if len(questions) == 0:
+                return paginated_questions()
+            currentCategory = category_registry.get(id)
+            if currentCategory is None:
+                abort(404)
+            totalQuestions = question_index.count(id)
+            if totalQuestions == 0:
                 abort(404)
-            list_of_formated_questions = [item.format() for item in questions]
-            totalQuestions = len(questions)
-            currentCategory = category.type
+            fields = requested_fields(request.args.get("fields"))
+            questions = Question.rows(*fields)\
+                .filter(Question.category_id == id).order_by(Question.id)
+            if wants_stream(totalQuestions, request.args.get("stream")):
+                return stream_json_response(
+                    (dict(zip(fields, row)) for row in
+                     questions.yield_per(STREAM_BATCH_SIZE)),
+                    totalQuestions=totalQuestions,
+                    currentCategory=currentCategory)
+            list_of_formated_questions = Question.format_rows(questions,
+                                                              fields)
             return jsonify({
                 "questions": list_of_formated_questions,
                 "totalQuestions": totalQuestions,
                 "currentCategory": currentCategory
                 })
+        except SQLAlchemyError:
+            raise
         except Exception:
             abort(404)
 
+    def snapshot_category_questions(snapshot, id):
+        if id == 0:
+            return snapshot_questions(snapshot)
+        currentCategory = snapshot.category_type(id)
+        ids = snapshot.ids(id)
+        if currentCategory is None or not ids:
+            abort(404)
+        fields = requested_fields(request.args.get("fields"))
+        if wants_stream(len(ids), request.args.get("stream")):
+            return stream_json_response(
+                (row for chunk in in_chunks(ids)
+                 for row in project(snapshot.rows(chunk), fields)),
+                totalQuestions=len(ids), currentCategory=currentCategory)
+        return jsonify({
+            "questions": project(snapshot.rows(ids), fields),
+            "totalQuestions": len(ids),
+            "currentCategory": currentCategory
+            })
+
+    def quiz_batch_size():
+        """how many questions POST /quizzes should return: "count",
+        capped at QUIZ_BATCH_MAX, or one"""
+        count = request.get_json().get("count")
+        if count is None:
+            return 1
+        return max(1, min(int(count), QUIZ_BATCH_MAX))
+
+    def quiz_batch(questions):
+        """the /quizzes response: the next question, and with "count"
+        the whole batch"""
+        body = {"question": questions[0] if questions else None}
+        if request.get_json().get("count") is not None:
+            body["questions"] = questions
+        return jsonify(body)
+
     @app.route("/quizzes", methods=["POST"])
     def get_next_question():
+        return degraded.read(next_question, next_snapshot_question, 405)
+
+    def next_question():
         cat = None
+        error = None
         try:
             previous_questions_list = request.get_json()\
-                .get("previous_questions")
+                .get("previous_questions") or []
             quiz_category = request.get_json().get("quiz_category")
+            difficulty = request.get_json().get("difficulty")
+            if difficulty is not None:
+                difficulty = int(difficulty)
+            count = quiz_batch_size()
+            fields = requested_fields(request.get_json().get("fields"))
             try:
                 cat = quiz_category.get("type")
             except Exception:
                 pass
             if cat is not None:
                 if cat == "click":
-                    list_of_options = ["Science", "Geography", "History",
-                                       "Entertainment", "Sports", "Art"]
-                    random.shuffle(list_of_options)
-                    cat = list_of_options[0]
-                quiz_category = Category.query.filter(Category.type ==
-                                                      cat).first()
-                quiz_category_id = str(quiz_category.id)
-                list_of_questions_by_category = Question.query.\
-                    filter(Question.category == quiz_category_id).all()
-                random.shuffle(list_of_questions_by_category)
-                item = list_of_questions_by_category[0]
-                return jsonify({
-                        "question": item.format()
-                        })
+                    cat = random.choice(category_registry.types())
+                quiz_category_id = category_registry.find(cat)
+                if quiz_category_id is None:
+                    error = 404
+                    abort(404)
+                sampled_ids = question_index.sample(
+                    quiz_category_id, previous_questions_list, count,
+                    difficulty)
+                return quiz_batch(ranked_questions(sampled_ids, fields))
 
-            quiz_category = Category.query.filter(Category.type ==
-                                                  quiz_category).first()
-            if not quiz_category or not previous_questions_list:
+            quiz_category_id = category_registry.find(quiz_category)
+            if quiz_category_id is None or not previous_questions_list:
                 error = 404
                 abort(404)
-            quiz_category_id = str(quiz_category.id)
-            list_of_questions_by_category = Question.query.\
-                filter(Question.category == quiz_category_id).all()
-            random.shuffle(list_of_questions_by_category)
-
-            for item in list_of_questions_by_category:
-                if item.id not in previous_questions_list:
-                    return jsonify({
-                        "question": item.format()
-                        })
-            abort(404)
+            sampled_ids = question_index.sample(quiz_category_id,
+                                                previous_questions_list,
+                                                count, difficulty)
+            if not sampled_ids:
+                error = 404
+                abort(404)
+            return quiz_batch(ranked_questions(sampled_ids, fields))
+        except SQLAlchemyError:
+            raise
         except Exception:
             if error == 404:
                 abort(404)
             else:
                 abort(405)
 
+    def next_snapshot_question(snapshot):
+        previous_questions = set(request.get_json()
+                                 .get("previous_questions") or [])
+        quiz_category = request.get_json().get("quiz_category")
+        difficulty = request.get_json().get("difficulty")
+        if difficulty is not None:
+            difficulty = int(difficulty)
+        if isinstance(quiz_category, dict):
+            quiz_category = quiz_category.get("type")
+            if quiz_category == "click":
+                quiz_category = random.choice(
+                    list(snapshot.categories.values()))
+        elif not previous_questions:
+            abort(404)
+        quiz_category_id = snapshot.find_category(quiz_category)
+        if quiz_category_id is None:
+            abort(404)
+        sampled_ids = sample_ids(snapshot.ids(quiz_category_id, difficulty),
+                                 previous_questions, quiz_batch_size())
+        if not sampled_ids and not isinstance(
+                request.get_json().get("quiz_category"), dict):
+            abort(404)
+        return quiz_batch(project(snapshot.rows(sampled_ids),
+                                  requested_fields(
+                                      request.get_json().get("fields"))))
+
+    quiz_sessions = QuizSessionStore(create_cache(
+        CACHE_URL, QUIZ_SESSION_MAX, QUIZ_SESSION_TTL, "trivia:quiz:"),
+        question_index)
+
+    def quiz_questions(ids):
+        """the quiz view of these questions in one query, in the order of
+        ids; deleted questions are left out"""
+        rank = {question_id: position for position, question_id
+                in enumerate(ids)}
+        rows = partition_router.lookup(
+            Question.rows(*QUIZ_QUESTION_COLUMNS)
+            .filter(Question.id.in_(ids)), ids)
+        return Question.format_rows(
+            sorted(rows, key=lambda item: rank[item.id]),
+            QUIZ_QUESTION_COLUMNS)
+
+    def prefetch_count(default=1):
+        """the "count" of upcoming questions a session request asks for,
+        capped at QUIZ_BATCH_MAX"""
+        body = request.get_json(silent=True) or {}
+        return max(0, min(int(body.get("count", default)), QUIZ_BATCH_MAX))
+
+    def quiz_session_or_404(session_id):
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+        return session
+
+    @app.route("/quizzes/sessions", methods=["POST"])
+    def start_quiz_session():
+        error = 422
+        try:
+            quiz_category = request.get_json().get("quiz_category")
+            number_of_questions = min(int(request.get_json().get(
+                "questions", DEFAULT_QUESTIONS)), MAX_QUESTIONS)
+            if isinstance(quiz_category, dict):
+                quiz_category = quiz_category.get("type")
+            quiz_category_id = None
+            if quiz_category not in (None, "click"):
+                quiz_category_id = category_registry.find(quiz_category)
+                if quiz_category_id is None:
+                    error = 404
+                    abort(404)
+            difficulty = request.get_json().get("difficulty")
+            if difficulty is not None:
+                difficulty = int(difficulty)
+            if request.get_json().get("adaptive"):
+                session = quiz_sessions.start_adaptive(
+                    quiz_category_id, number_of_questions,
+                    difficulty or DEFAULT_DIFFICULTY)
+            else:
+                question_ids = question_index.sample(
+                    quiz_category_id, (), number_of_questions, difficulty)
+                session = quiz_sessions.start(
+                    quiz_category_id, question_ids) if question_ids else None
+            if session is None:
+                error = 404
+                abort(404)
+            questions = quiz_questions(quiz_sessions.upcoming(
+                session, max(1, prefetch_count())))
+            return jsonify({
+                "success": True,
+                "sessionId": session["id"],
+                "question": questions[0] if questions else None,
+                "questions": questions,
+                "totalQuestions": session["total"],
+                "difficulty": session["difficulty"]
+                })
+        except Exception:
+            abort(error)
+
+    @app.route("/quizzes/sessions/<session_id>", methods=["GET"])
+    def get_quiz_session(session_id):
+        session = quiz_session_or_404(session_id)
+        return jsonify({
+            "success": True,
+            "stats": quiz_sessions.stats(session)
+            })
+
+    @app.route("/quizzes/sessions/<session_id>/answers", methods=["POST"])
+    def answer_quiz_question(session_id):
+        session = quiz_session_or_404(session_id)
+        question_id = quiz_sessions.current_id(session)
+        if question_id is None:
+            abort(404)
+        # a client that sends the question it shows is not scored against
+        # another one when its answer overtakes a /next
+        answered_id = (request.get_json(silent=True) or {}).get("questionId")
+        if answered_id is not None and answered_id != question_id:
+            abort(409)
+        try:
+            rows = partition_router.lookup(
+                Question.rows("answer").filter(Question.id == question_id),
+                [question_id])
+            answer = rows[0].answer if rows else None
+            correct = quiz_sessions.answer(session, answer,
+                                           request.get_json().get("answer"))
+            return jsonify({
+                "correct": correct,
+                "answer": answer,
+                "score": session["score"],
+                "stats": quiz_sessions.stats(session)
+                })
+        except Exception:
+            abort(422)
+
+    @app.route("/quizzes/sessions/<session_id>/next", methods=["POST"])
+    def next_quiz_question(session_id):
+        session = quiz_session_or_404(session_id)
+        try:
+            count = prefetch_count()
+        except (TypeError, ValueError):
+            abort(422)
+        questions = []
+        question_id = quiz_sessions.advance(session)
+        while question_id is not None and count:
+            questions = quiz_questions(quiz_sessions.upcoming(session, count))
+            if questions and questions[0]["id"] == question_id:
+                break
+            questions = []
+            question_id = quiz_sessions.advance(session)
+        return jsonify({
+            "questionId": question_id,
+            "question": questions[0] if questions else None,
+            "questions": questions,
+            "stats": quiz_sessions.stats(session)
+            })
+
     @app.errorhandler(404)
     def page_not_found(error):
         return (jsonify({
@@ -219,6 +760,14 @@ def create_app(test_config=None):
             "message": "method not allowed"
             }), 405)
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return (jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+            }), 409)
+
     @app.errorhandler(422)
     def not_processable(error):
         return (jsonify({
@@ -227,4 +776,26 @@ def create_app(test_config=None):
             "message": "request not processable"
             }), 422)
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "too many requests"
+            })
+        if g.get("retry_after"):
+            response.headers["Retry-After"] = str(g.retry_after)
+        return response, 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+            })
+        if g.get("retry_after"):
+            response.headers["Retry-After"] = str(g.retry_after)
+        return response, 503
+
     return app
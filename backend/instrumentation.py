@@ -0,0 +1,247 @@
+from collections import Counter, defaultdict
+import logging
+import threading
+import time
+
+from flask import g, has_request_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+N_PLUS_ONE_THRESHOLD = 5
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+logger = logging.getLogger("trivia.instrumentation")
+
+"""
+Request instrumentation
+
+instrument(app) times every request and the SQL it runs. Cursor execute
+events on every engine record each statement with its duration, and
+TimingJSONEncoder, mixed into the app's JSON encoder, times jsonify. At
+the end of a request the totals go into the process wide `metrics`, a
+Server-Timing header is added, and requests slower than the slow log
+threshold are logged with their statements.
+
+A statement run N_PLUS_ONE_THRESHOLD or more times with different
+parameters in one request is counted as an N+1 pattern. The same
+statement run again with identical parameters is counted as a duplicate.
+
+Bodies streamed after the view returns are not included in the latency.
+Every worker process keeps its own metrics.
+"""
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = []
+        self.sql_time = 0.0
+        self.serialization_time = 0.0
+
+    def add_statement(self, statement, parameters, duration):
+        self.statements.append((statement, parameters, duration))
+        self.sql_time += duration
+
+    def n_plus_one(self):
+        by_statement = Counter(statement for statement, _ in
+                               {(statement, parameters) for statement,
+                                parameters, _ in self.statements})
+        return [statement for statement, count in by_statement.items()
+                if count >= N_PLUS_ONE_THRESHOLD]
+
+    def duplicates(self):
+        by_call = Counter((statement, parameters) for statement, parameters, _
+                          in self.statements)
+        return [statement for (statement, _), count in by_call.items()
+                if count > 1]
+
+
+def current_stats():
+    if not has_request_context():
+        return None
+    return g.get("request_stats")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(connection, cursor, statement, parameters,
+                          context, executemany):
+    if current_stats() is not None:
+        connection.info.setdefault("query_started", []).append(
+            time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(connection, cursor, statement, parameters,
+                         context, executemany):
+    stats = current_stats()
+    started = connection.info.get("query_started")
+    if stats is not None and started:
+        stats.add_statement(statement,
+                            "many" if executemany else repr(parameters),
+                            time.perf_counter() - started.pop())
+
+
+class TimingJSONEncoder(JSONEncoder):
+    """adds the time spent encoding to the current request's stats"""
+    def encode(self, o):
+        started = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.serialization_time += time.perf_counter() - started
+
+
+def timed_encoder(encoder):
+    """encoder with TimingJSONEncoder's timing around its encode()"""
+    if issubclass(encoder, TimingJSONEncoder):
+        return encoder
+    return type("Timing" + encoder.__name__, (TimingJSONEncoder, encoder),
+                {})
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.latency_buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.latency_sum = Counter()
+        self.latency_count = Counter()
+        self.queries = Counter()
+        self.sql_seconds = Counter()
+        self.serialization_seconds = Counter()
+        self.n_plus_one = Counter()
+        self.duplicates = Counter()
+
+    def record(self, route, method, status, stats, latency):
+        key = (route, method)
+        with self._lock:
+            self.requests[key + (str(status),)] += 1
+            buckets = self.latency_buckets[key]
+            for position, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    buckets[position] += 1
+            self.latency_sum[key] += latency
+            self.latency_count[key] += 1
+            self.queries[key] += len(stats.statements)
+            self.sql_seconds[key] += stats.sql_time
+            self.serialization_seconds[key] += stats.serialization_time
+            self.n_plus_one[key] += len(stats.n_plus_one())
+            self.duplicates[key] += len(stats.duplicates())
+
+    def render(self, pools=None):
+        """the metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for sample, labels, value in samples:
+                lines.append("{}{{{}}} {}".format(sample, ",".join(
+                    '{}="{}"'.format(label, escape(text))
+                    for label, text in labels), value))
+
+        def per_route(name, counter):
+            return [(name, (("route", route), ("method", method)), value)
+                    for (route, method), value in sorted(counter.items())]
+
+        with self._lock:
+            family("trivia_requests_total", "counter", "Requests served.",
+                   [("trivia_requests_total",
+                     (("route", route), ("method", method),
+                      ("status", status)), value)
+                    for (route, method, status), value
+                    in sorted(self.requests.items())])
+            name = "trivia_request_duration_seconds"
+            histogram = []
+            for key, buckets in sorted(self.latency_buckets.items()):
+                labels = (("route", key[0]), ("method", key[1]))
+                histogram.extend((name + "_bucket",
+                                  labels + (("le", str(bound)),), value)
+                                 for bound, value
+                                 in zip(LATENCY_BUCKETS, buckets))
+                histogram.append((name + "_bucket",
+                                  labels + (("le", "+Inf"),),
+                                  self.latency_count[key]))
+                histogram.append((name + "_sum", labels,
+                                  self.latency_sum[key]))
+                histogram.append((name + "_count", labels,
+                                  self.latency_count[key]))
+            family(name, "histogram",
+                   "Request latency until the view returned.", histogram)
+            for name, help_text, counter in (
+                    ("trivia_sql_queries_total", "SQL statements executed.",
+                     self.queries),
+                    ("trivia_sql_seconds_total", "Time spent executing SQL.",
+                     self.sql_seconds),
+                    ("trivia_serialization_seconds_total",
+                     "Time spent encoding JSON.",
+                     self.serialization_seconds),
+                    ("trivia_n_plus_one_total",
+                     "Statements repeated with different parameters in "
+                     "one request.", self.n_plus_one),
+                    ("trivia_duplicate_queries_total",
+                     "Statements repeated with identical parameters in "
+                     "one request.", self.duplicates)):
+                family(name, "counter", help_text,
+                       per_route(name, counter))
+        for field, help_text in (("checked_out", "Connections in use."),
+                                 ("checked_in", "Idle pooled connections."),
+                                 ("overflow", "Connections above pool size."),
+                                 ("size", "Configured pool size.")):
+            name = "trivia_db_pool_" + field
+            family(name, "gauge", help_text,
+                   [(name, (("pool", pool),), stats[field])
+                    for pool, stats in sorted((pools or {}).items())
+                    if field in stats])
+        return "\n".join(lines) + "\n"
+
+
+def escape(text):
+    return str(text).replace("\\", "\\\\").replace('"', '\\"')
+
+
+metrics = Metrics()
+
+
+def server_timing(stats, total):
+    return ('db;dur={:.2f};desc="{} queries", serialize;dur={:.2f}, '
+            'total;dur={:.2f}'.format(stats.sql_time * 1000,
+                                      len(stats.statements),
+                                      stats.serialization_time * 1000,
+                                      total * 1000))
+
+
+def instrument(app, slow_request_ms=0, server_timing_header=True):
+    app.json_encoder = timed_encoder(app.json_encoder)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = g.pop("request_stats", None)
+        if stats is None:
+            return response
+        total = time.perf_counter() - stats.started
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.record(route, request.method, response.status_code, stats,
+                       total)
+        if server_timing_header:
+            response.headers["Server-Timing"] = server_timing(stats, total)
+        for statement in stats.n_plus_one():
+            logger.warning("N+1 queries in %s %s: %s", request.method, route,
+                           statement)
+        if slow_request_ms and total * 1000 >= slow_request_ms:
+            logger.warning(
+                "slow request %s %s: %.1f ms, %d queries, %.1f ms SQL, "
+                "%.1f ms serialization\n%s", request.method, request.path,
+                total * 1000, len(stats.statements), stats.sql_time * 1000,
+                stats.serialization_time * 1000, "\n".join(
+                    "  {:.2f} ms {}".format(duration * 1000, statement)
+                    for statement, _, duration in sorted(
+                        stats.statements, key=lambda item: -item[2])[:10]))
+        return response
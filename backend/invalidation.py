@@ -0,0 +1,299 @@
+import asyncio
+import fcntl
+import logging
+import os
+import threading
+
+from flask import current_app, has_app_context
+
+# more changed ids than this are cheaper to reload than to re-read
+MAX_DELTA_ITEMS = 5000
+# versions of each topic a database channel keeps the changed ids of
+CHANGE_LOG_SIZE = 1000
+
+logger = logging.getLogger("trivia.invalidation")
+
+"""
+Invalidation channels
+
+In-process caches remember the version of a topic they were built from.
+Writers record(topic, items, connection) before committing, which a
+channel kept in the database writes into the same transaction, and
+publish(topic, items) after committing when record() returned None.
+Readers compare version(topic) with their own copy to decide whether to
+catch up.
+
+LocalChannel only sees writes made by this process and FileChannel keeps
+one counter file per topic, so every worker process on the host sees
+every write. Neither knows what changed, so a reader whose topic moved
+reloads it. DatabaseChannel (change_log.py), the app's default, is shared
+by every worker on every host and also says which ids each write
+touched, so readers patch just those.
+"""
+
+
+class LocalChannel:
+    # whether every worker sees the same versions (see create_cache)
+    shared = False
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, topic):
+        return self._versions.get(topic, 0)
+
+    def record(self, topic, items, connection):
+        return None
+
+    def seen(self, topic, version):
+        pass
+
+    def publish(self, topic, items=None):
+        with self._lock:
+            self._versions[topic] = self._versions.get(topic, 0) + 1
+            return self._versions[topic]
+
+    def changes(self, topic, since):
+        return None
+
+
+class FileChannel:
+    shared = False
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, topic):
+        return os.path.join(self.directory, "{}.version".format(topic))
+
+    def version(self, topic):
+        try:
+            with open(self._path(topic)) as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def record(self, topic, items, connection):
+        return None
+
+    def seen(self, topic, version):
+        pass
+
+    def publish(self, topic, items=None):
+        with open(self._path(topic), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            version = int(f.read() or 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(version))
+        return version
+
+    def changes(self, topic, since):
+        return None
+
+
+channel = LocalChannel()
+
+
+def use_channel(new_channel):
+    global channel
+    channel = new_channel
+
+
+def version(topic):
+    return channel.version(topic)
+
+
+def record(topic, items, connection):
+    return channel.record(topic, items, connection)
+
+
+def seen(topic, version):
+    channel.seen(topic, version)
+
+
+def publish(topic, items=None):
+    return channel.publish(topic, items)
+
+
+def committed(topic, items, version):
+    """after a write commits, given what record() returned for it: the
+    topic's new version, published now if record() did not log it"""
+    if version is None:
+        return publish(topic, items)
+    seen(topic, version)
+    return version
+
+
+def changes(topic, since):
+    return channel.changes(topic, since)
+
+
+"""
+VersionedIndex
+    base for in-memory indexes built from a loader and patched in place by
+    question write listeners. Subclasses implement _build(rows), returning
+    the attributes that hold the loaded state, plus _add(*row) and
+    _remove(item_id), and _apply(action, question), returning False from
+    _apply for writes they cannot patch.
+
+    A full load builds the new state without holding the lock and swaps
+    it in, so reads keep using the old state meanwhile. Writes published
+    by other workers are applied as deltas when the channel has them:
+    fetch(ids) re-reads those rows and the index patches them in.
+    Otherwise, once loaded, a large index reloads in the background and
+    serves its current state until the new one is in.
+"""
+
+
+class VersionedIndex:
+    topic = "questions"
+    # small indexes reload within the request that noticed the change
+    sync_rebuild = False
+
+    def __init__(self):
+        self._loader = None
+        self._fetch = None
+        self._version = None
+        self._rebuilding = False
+        self._lock = threading.RLock()
+
+    def build(self, loader, lazy=False, fetch=None):
+        """lazy=True only registers the loader; the first read loads"""
+        self._loader = loader
+        self._fetch = fetch
+        self._version = None
+        if not lazy:
+            self.rebuild()
+
+    def _install(self, state):
+        self.__dict__.update(state)
+
+    def _patch(self, ids, rows):
+        for item_id in ids:
+            self._remove(item_id)
+        for row in rows:
+            self._add(*row)
+
+    def rebuild(self):
+        current = version(self.topic)
+        state = self._build(self._loader())
+        with self._lock:
+            self._install(state)
+            self._version = current
+
+    def rebuild_in_background(self):
+        """starts rebuild() in a thread with this app's context, unless one
+        is already running; rebuilds right away outside of an app"""
+        if not has_app_context():
+            self.rebuild()
+            return
+        app = current_app._get_current_object()
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+
+        def run():
+            try:
+                with app.app_context():
+                    self.rebuild()
+            except Exception:
+                logger.exception("%s rebuild failed", type(self).__name__)
+            finally:
+                self._rebuilding = False
+
+        threading.Thread(target=run, name="index-rebuild",
+                         daemon=True).start()
+
+    def fresh(self):
+        if self._loader is None:
+            return
+        current = version(self.topic)
+        if current == self._version:
+            return
+        if self._version is None or self.sync_rebuild:
+            self.rebuild()
+            return
+        if self._rebuilding:
+            return
+        delta = changes(self.topic, self._version) \
+            if self._fetch is not None else None
+        if delta is None:
+            self.rebuild_in_background()
+            return
+        up_to, ids = delta
+        if len(ids) > MAX_DELTA_ITEMS:
+            self.rebuild_in_background()
+            return
+        rows = self._fetch(sorted(ids))
+        with self._lock:
+            if self._version is not None and self._version < up_to:
+                self._patch(ids, rows)
+                self._version = up_to
+
+    async def refresh_async(self, fetch, fetch_ids=None, changes=None):
+        """async counterpart of fresh() for an index built without a
+        loader: patches in the rows awaited from fetch_ids(ids) for the
+        writes changes(topic, since) reports, or loads every row from
+        fetch(), in the background once the index has been loaded"""
+        current = version(self.topic)
+        if current == self._version:
+            return
+        if self._version is None or self.sync_rebuild:
+            await self._reload_async(fetch, current)
+            return
+        if self._rebuilding:
+            return
+        delta = await changes(self.topic, self._version) \
+            if changes is not None and fetch_ids is not None else None
+        if delta is None or len(delta[1]) > MAX_DELTA_ITEMS:
+            self._rebuilding = True
+            asyncio.ensure_future(self._reload_async(fetch, current))
+            return
+        up_to, ids = delta
+        rows = await fetch_ids(sorted(ids))
+        with self._lock:
+            if self._version is not None and self._version < up_to:
+                self._patch(ids, rows)
+                self._version = up_to
+
+    async def _reload_async(self, fetch, current):
+        try:
+            state = self._build(await fetch())
+            with self._lock:
+                self._install(state)
+                self._version = current
+        except Exception:
+            logger.exception("%s rebuild failed", type(self).__name__)
+            if self._version is None:
+                raise
+        finally:
+            self._rebuilding = False
+
+    def _apply_write(self, action, question):
+        """batch writes ("delete_many", "update_many") carry a list of rows"""
+        if action.endswith("_many"):
+            return all([self._apply(action[:-len("_many")], row)
+                        for row in question])
+        return self._apply(action, question)
+
+    def on_write(self, action, question, new_version):
+        """patches in a write made by this process; when other writes were
+        published in between, the version stays behind so the next read
+        catches up on them (patches are idempotent). A write that cannot
+        be patched reloads the index here, so the writer sees it."""
+        with self._lock:
+            if self._version is None:
+                return
+            patched = self._apply_write(action, question)
+            if patched and new_version == self._version + 1:
+                self._version = new_version
+        if not patched:
+            if self._loader is None:
+                self._version = None
+            else:
+                self.rebuild()
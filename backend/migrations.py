@@ -0,0 +1,156 @@
+import time
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Column, Integer, Float, MetaData, Table, inspect, text
+
+import change_log
+from models import db, CategoryStat
+from partitions import partition_questions, DEFAULT_PARTITIONS
+
+BACKFILL_BATCH_SIZE = 5000
+
+"""
+Schema migrations
+
+Migrations are plain functions registered in order with @migration(n).
+Each one receives the engine and must be safe to run against a database
+that db.create_all() already brought up to date, because `flask db
+upgrade` creates missing tables with the current schema first. Applied
+versions are recorded in the schema_migrations table. On PostgreSQL
+indexes are built CONCURRENTLY and backfills commit in small batches, so
+the app keeps serving while a migration runs.
+"""
+
+metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations", metadata,
+    Column("version", Integer, primary_key=True),
+    Column("applied_at", Float, nullable=False))
+
+MIGRATIONS = []
+
+
+def migration(version):
+    def register(function):
+        MIGRATIONS.append((version, function))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return function
+    return register
+
+
+def applied_versions(engine):
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        return {row[0] for row in
+                connection.execute(schema_migrations.select())}
+
+
+def pending(engine):
+    applied = applied_versions(engine)
+    return [(version, function) for version, function in MIGRATIONS
+            if version not in applied]
+
+
+def upgrade(engine, echo=lambda message: None):
+    """applies every pending migration in order; returns their versions"""
+    done = []
+    for version, function in pending(engine):
+        echo("applying {} {}".format(version, function.__name__))
+        function(engine)
+        with engine.begin() as connection:
+            connection.execute(schema_migrations.insert(),
+                               version=version, applied_at=time.time())
+        done.append(version)
+    return done
+
+
+def has_column(engine, table, column):
+    return column in {item["name"] for item in
+                      inspect(engine).get_columns(table)}
+
+
+def create_index(engine, name, table, columns):
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT")\
+                .execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} "
+                         "({})".format(name, table, ", ".join(columns)))
+    else:
+        with engine.begin() as connection:
+            connection.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})"
+                               .format(name, table, ", ".join(columns)))
+
+
+def backfill(engine, statement, batch_size=BACKFILL_BATCH_SIZE):
+    """runs statement (limited by :batch_size) until it touches no rows"""
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            updated = connection.execute(text(statement),
+                                         batch_size=batch_size).rowcount
+        if not updated:
+            return total
+        total += updated
+
+
+@migration(1)
+def add_question_category_id(engine):
+    if not has_column(engine, "questions", "category_id"):
+        with engine.begin() as connection:
+            connection.execute("ALTER TABLE questions ADD COLUMN "
+                               "category_id INTEGER REFERENCES categories "
+                               "(id)")
+    create_index(engine, "ix_questions_category_id", "questions",
+                 ["category_id"])
+    create_index(engine, "ix_questions_category_id_id", "questions",
+                 ["category_id", "id"])
+    backfill(engine, "UPDATE questions SET category_id = "
+                     "CAST(category AS INTEGER) WHERE id IN ("
+                     "SELECT id FROM questions WHERE category_id IS NULL "
+                     "AND category IS NOT NULL LIMIT :batch_size)")
+
+
+@migration(2)
+def add_category_stats(engine):
+    CategoryStat.__table__.create(engine, checkfirst=True)
+    with engine.begin() as connection:
+        CategoryStat.rebuild(connection)
+
+
+@migration(3)
+def add_topic_change_log(engine):
+    change_log.metadata.create_all(engine)
+
+
+db_cli = AppGroup("db", help="Schema management.")
+
+
+@db_cli.command("upgrade")
+def upgrade_command():
+    """Create missing tables and apply pending schema migrations."""
+    db.create_all()
+    done = upgrade(db.engine, click.echo)
+    click.echo("applied {}".format(done) if done else "already up to date")
+
+
+@db_cli.command("partition")
+@click.option("--partitions", default=DEFAULT_PARTITIONS, show_default=True,
+              help="Number of hash partitions.")
+def partition_command(partitions):
+    """Hash-partition questions by category_id (PostgreSQL only)."""
+    try:
+        partition_questions(db.engine, partitions)
+    except RuntimeError as error:
+        raise click.ClickException(str(error))
+    click.echo("questions split into {} partitions".format(partitions))
+
+
+@db_cli.command("status")
+def status_command():
+    """List schema migrations and whether they are applied."""
+    applied = applied_versions(db.engine)
+    for version, function in MIGRATIONS:
+        click.echo("{} {:<40} {}".format(
+            version, function.__name__,
+            "applied" if version in applied else "pending"))
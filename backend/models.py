@@ -1,28 +1,121 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from types import SimpleNamespace
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, \
+    create_engine, event, func, inspect, orm, select, text
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
 import json
-from settings import DB_NAME, DB_USER, DB_PASSWORD
+from settings import DB_NAME, DATABASE_URL, DATABASE_REPLICA_URL
+from database import engine_options, read_from_replica, \
+    apply_statement_timeout
+import invalidation
+from fieldsets import QUESTION_FIELDS
 
 database_name = DB_NAME
-database_path = 'postgresql://{}:{}@localhost:5432/{}'.format(DB_USER,
-                                                              DB_PASSWORD,
-                                                              DB_NAME)
+database_path = DATABASE_URL
 
-db = SQLAlchemy()
+"""
+RoutingSession
+    sends reads made while serving GET requests to the "replica" bind,
+    when one is configured, and everything else to the primary
+"""
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        binds = self.app.config.get("SQLALCHEMY_BINDS") or {}
+        if "replica" in binds and not self._flushing and \
+                read_from_replica():
+            return get_state(self.app).db.get_engine(self.app,
+                                                     bind="replica")
+        return super().get_bind(mapper, clause)
+
+
+event.listen(RoutingSession, "after_begin", apply_statement_timeout)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service without touching
+    the database; the schema is created and migrated by `flask db upgrade`
 """
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
+    if DATABASE_REPLICA_URL:
+        app.config["SQLALCHEMY_BINDS"] = {"replica": DATABASE_REPLICA_URL}
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+"""
+on_question_write(listener)
+    registers listener(action, question, version), called after every
+    committed question write with the new "questions" topic version
+"""
+
+write_listeners = []
+
+
+def on_question_write(listener):
+    if listener not in write_listeners:
+        write_listeners.append(listener)
+    return listener
+
+
+def written_ids(action, question):
+    """the question ids a write notification touched, None for all"""
+    if question is None:
+        return None
+    if action.endswith("_many"):
+        return [row.id for row in question]
+    return [question.id]
+
+
+"""
+record_write(action, question=None, connection=None)
+    logs a question write in the invalidation channel inside the
+    transaction making it (the session's unless connection is given), so
+    other workers learn of it exactly when it commits; returns the version
+    to hand to notify_write after the commit
+"""
+
+
+def record_write(action, question=None, connection=None):
+    return invalidation.record("questions", written_ids(action, question),
+                               connection or db.session)
+
+
+def notify_write(action, question=None, version=None):
+    version = invalidation.committed("questions",
+                                     written_ids(action, question), version)
+    for listener in write_listeners:
+        listener(action, question, version)
+
+
+"""
+batch_write(action, questions)
+    the notification for a set-based write: ("delete_many"/"update_many",
+    the affected rows), or ("reload", None) when the batch is too large to
+    apply row by row
+"""
+
+BATCH_NOTIFY_LIMIT = 1000
+
+
+def batch_write(action, questions):
+    if len(questions) > BATCH_NOTIFY_LIMIT:
+        return "reload", None
+    return action + "_many", questions
 
 
 """
@@ -32,29 +125,119 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    columns = QUESTION_FIELDS
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
     category = Column(String)
+    category_id = Column(Integer, ForeignKey('categories.id'), index=True)
     difficulty = Column(Integer)
 
+    __table_args__ = (
+        Index('ix_questions_category_id_id', 'category_id', 'id'),
+        )
+
     def __init__(self, question, answer, category, difficulty):
         self.question = question
         self.answer = answer
         self.category = category
+        self.category_id = int(category)
         self.difficulty = difficulty
 
     def insert(self):
         db.session.add(self)
+        CategoryStat.adjust(self.category_id, self.difficulty, 1)
+        db.session.flush()
+        version = record_write("insert", self)
         db.session.commit()
+        notify_write("insert", self, version)
 
     def update(self):
+        self.category_id = int(self.category)
+        state = inspect(self)
+        previous = [
+            (state.attrs[name].history.deleted or [getattr(self, name)])[0]
+            for name in ("category_id", "difficulty")]
+        if previous != [self.category_id, self.difficulty]:
+            CategoryStat.adjust(*previous, -1)
+            CategoryStat.adjust(self.category_id, self.difficulty, 1)
+        version = record_write("update", self)
         db.session.commit()
+        notify_write("update", self, version)
 
     def delete(self):
         db.session.delete(self)
+        CategoryStat.adjust(self.category_id, self.difficulty, -1)
+        version = record_write("delete", self)
         db.session.commit()
+        notify_write("delete", self, version)
+
+    """
+    delete_where(*criteria) / update_where(values, *criteria)
+        set-based writes: one DELETE or UPDATE statement for every
+        matching question, committed in a single transaction together
+        with category_stats, then a single write notification; both
+        return the number of rows affected
+    """
+
+    @classmethod
+    def _locked_rows(cls, criteria):
+        """locks the matching rows, reading only what the write needs"""
+        return cls.rows('id', 'category_id', 'difficulty')\
+            .filter(*criteria).with_for_update().all()
+
+    @classmethod
+    def _updated_rows(cls, rows, values):
+        """rows as the update of values left them, with their text for the
+        search index; read only for batches applied row by row"""
+        texts = {row.id: row for row in cls.rows('id', 'question', 'answer')
+                 .filter(cls.id.in_([row.id for row in rows]))}
+        return [SimpleNamespace(**dict(
+            row._asdict(), question=texts[row.id].question,
+            answer=texts[row.id].answer,
+            **{column: values[column] for column in row._fields
+               if column in values})) for row in rows]
+
+    @classmethod
+    def delete_where(cls, *criteria):
+        rows = cls._locked_rows(criteria)
+        if not rows:
+            db.session.rollback()
+            return 0
+        deleted = cls.query.filter(*criteria)\
+            .delete(synchronize_session=False)
+        CategoryStat.rebuild(category_ids={row.category_id for row in rows})
+        action, written = batch_write("delete", rows) \
+            if deleted == len(rows) else ("reload", None)
+        version = record_write(action, written)
+        db.session.commit()
+        notify_write(action, written, version)
+        return deleted
+
+    @classmethod
+    def update_where(cls, values, *criteria):
+        values = dict(values)
+        if 'category' in values:
+            values['category'] = str(values['category'])
+            values['category_id'] = int(values['category'])
+        rows = cls._locked_rows(criteria)
+        if not rows:
+            db.session.rollback()
+            return 0
+        updated = cls.query.filter(*criteria)\
+            .update(values, synchronize_session=False)
+        category_ids = {row.category_id for row in rows}
+        category_ids.add(values.get('category_id'))
+        CategoryStat.rebuild(category_ids=category_ids - {None})
+        action, written = batch_write("update", rows) \
+            if updated == len(rows) else ("reload", None)
+        if written is not None:
+            written = cls._updated_rows(written, values)
+        version = record_write(action, written)
+        db.session.commit()
+        notify_write(action, written, version)
+        return updated
 
     def format(self):
         return {
@@ -65,6 +248,102 @@ class Question(db.Model):
             'difficulty': self.difficulty
             }
 
+    """
+    rows(*columns) / format_rows(rows, columns)
+        read-only fast path: selects plain tuples instead of hydrating
+        tracked Question instances, and turns them into the same dicts
+        format() returns
+    """
+
+    @classmethod
+    def rows(cls, *columns):
+        return db.session.query(*[getattr(cls, column)
+                                  for column in columns or cls.columns])
+
+    @classmethod
+    def format_rows(cls, rows, columns=None):
+        columns = columns or cls.columns
+        return [dict(zip(columns, row)) for row in rows]
+
+
+"""
+CategoryStat
+    question counts per (category, difficulty), kept in step with the
+    questions table inside the transaction of every write, so counts and
+    difficulty histograms are read without scanning questions
+"""
+
+
+class CategoryStat(db.Model):
+    __tablename__ = 'category_stats'
+
+    category_id = Column(Integer, ForeignKey('categories.id'),
+                         primary_key=True)
+    difficulty = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    ADJUST = text(
+        "INSERT INTO category_stats (category_id, difficulty, count) "
+        "VALUES (:category_id, :difficulty, :delta) "
+        "ON CONFLICT (category_id, difficulty) "
+        "DO UPDATE SET count = category_stats.count + excluded.count")
+
+    @classmethod
+    def adjust(cls, category_id, difficulty, delta, connection=None):
+        """adds delta to one bucket in the current transaction"""
+        if category_id is None or difficulty is None or not delta:
+            return
+        (connection or db.session).execute(cls.ADJUST, {
+            "category_id": category_id,
+            "difficulty": difficulty,
+            "delta": delta
+            })
+
+    @classmethod
+    def adjust_many(cls, deltas, connection=None):
+        """adds {(category_id, difficulty): delta} to their buckets in one
+        executemany"""
+        params = [{"category_id": category_id, "difficulty": difficulty,
+                   "delta": delta}
+                  for (category_id, difficulty), delta in deltas.items()
+                  if category_id is not None and difficulty is not None
+                  and delta]
+        if params:
+            (connection or db.session).execute(cls.ADJUST, params)
+
+    @classmethod
+    def rebuild(cls, connection=None, category_ids=None):
+        """recomputes the buckets of category_ids (default: all) from the
+        questions table"""
+        connection = connection or db.session
+        questions = Question.__table__
+        source = select([questions.c.category_id, questions.c.difficulty,
+                         func.count()])\
+            .where(questions.c.category_id.isnot(None))\
+            .where(questions.c.difficulty.isnot(None))\
+            .group_by(questions.c.category_id, questions.c.difficulty)
+        clear = cls.__table__.delete()
+        if category_ids is not None:
+            if not category_ids:
+                return
+            source = source.where(
+                questions.c.category_id.in_(list(category_ids)))
+            clear = clear.where(
+                cls.__table__.c.category_id.in_(list(category_ids)))
+        connection.execute(clear)
+        connection.execute(cls.__table__.insert().from_select(
+            ['category_id', 'difficulty', 'count'], source))
+
+    @classmethod
+    def summary(cls):
+        """{category_id: {difficulty: count}} for non-empty buckets"""
+        stats = {}
+        for category_id, difficulty, count in db.session.query(
+                cls.category_id, cls.difficulty, cls.count)\
+                .filter(cls.count > 0):
+            stats.setdefault(category_id, {})[difficulty] = count
+        return stats
+
 
 """
 Category
@@ -81,6 +360,12 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        version = invalidation.record("categories", None, db.session)
+        db.session.commit()
+        invalidation.committed("categories", None, version)
+
     def format(self):
         return {
             'id': self.id,
@@ -0,0 +1,44 @@
+import base64
+import json
+
+"""
+Pagination helpers
+
+Pages are resolved in SQL: either LIMIT/OFFSET for a page number, or a
+keyset predicate (id > last id) when the client sends back the opaque
+cursor returned with the previous page. Keyset pages cost the same no
+matter how deep they are.
+"""
+
+
+def encode_cursor(last_id):
+    raw = json.dumps({"after": last_id}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return int(json.loads(base64.urlsafe_b64decode(padded))["after"])
+
+
+def paginate(query, column, page=1, cursor=None, per_page=10, index=None):
+    """returns (items, next_cursor) for one page of query ordered by column
+
+    index is an optional sorted sequence of every value of column in query;
+    with it a page number becomes a keyset lookup instead of an OFFSET.
+    """
+    query = query.order_by(column)
+    offset = (max(page, 1) - 1) * per_page
+    if cursor:
+        query = query.filter(column > decode_cursor(cursor))
+    elif index is not None:
+        if offset >= len(index):
+            return [], None
+        query = query.filter(column >= index[offset])
+    else:
+        query = query.offset(offset)
+    items = query.limit(per_page).all()
+    next_cursor = None
+    if len(items) == per_page:
+        next_cursor = encode_cursor(getattr(items[-1], column.key))
+    return items, next_cursor
@@ -0,0 +1,132 @@
+import logging
+
+from sqlalchemy import text
+
+from models import db, Question
+from question_index import question_index
+
+DEFAULT_PARTITIONS = 8
+
+logger = logging.getLogger("trivia.partitions")
+
+"""
+Question partitions
+
+On PostgreSQL (11 or later) `flask db partition` turns the questions table
+into one hash partitioned on category_id. Every category then lives in
+exactly one partition with its own indexes, so category reads, quiz draws
+and writes in different categories stop competing for one table and one
+set of indexes. Listings and the IN queries behind search still read the
+parent table; PostgreSQL fans them out to the partitions and merges the
+rows in id order. A partition can also be a postgres_fdw foreign table on
+another server (CREATE FOREIGN TABLE ... PARTITION OF questions), which
+spreads questions over several nodes without changing the app.
+
+The partitioned table's primary key is (id, category_id), because
+PostgreSQL requires the partition key in it, so every question needs a
+category. Ids stay unique through the shared sequence.
+
+Lookups by id cannot be pruned by the database on their own: a question
+id says nothing about its partition. PartitionRouter.lookup adds the
+owning categories, taken from the in-memory question index, to those
+lookups so they only touch the owning partitions. Ids the index does not
+know fan out to every partition. The index can lag a move made by another
+worker, so a routed lookup that finds fewer rows than it asked for runs
+again over every partition; routing never hides a row. Batch writes are
+not routed. The router turns itself on at startup when the table is
+partitioned, so it costs nothing on SQLite or an unpartitioned database.
+"""
+
+
+def is_partitioned(engine, table="questions"):
+    if engine.dialect.name != "postgresql":
+        return False
+    with engine.connect() as connection:
+        return bool(connection.execute(text(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = "
+            "to_regclass(:table)"), table=table).scalar())
+
+
+def partition_statements(partitions, sequence):
+    """the SQL that rebuilds questions as a table hash partitioned on
+    category_id, keeping its rows and id sequence"""
+    statements = [
+        "LOCK TABLE questions IN ACCESS EXCLUSIVE MODE",
+        "ALTER SEQUENCE {} OWNED BY NONE".format(sequence),
+        "ALTER TABLE questions RENAME TO questions_unpartitioned",
+        "CREATE TABLE questions (LIKE questions_unpartitioned INCLUDING "
+        "DEFAULTS, PRIMARY KEY (id, category_id), FOREIGN KEY "
+        "(category_id) REFERENCES categories (id)) "
+        "PARTITION BY HASH (category_id)"]
+    statements.extend(
+        "CREATE TABLE questions_p{0} PARTITION OF questions FOR VALUES "
+        "WITH (MODULUS {1}, REMAINDER {0})".format(remainder, partitions)
+        for remainder in range(partitions))
+    statements.extend([
+        "INSERT INTO questions (id, question, answer, category, "
+        "category_id, difficulty) SELECT id, question, answer, category, "
+        "category_id, difficulty FROM questions_unpartitioned",
+        "DROP TABLE questions_unpartitioned",
+        "CREATE INDEX ix_questions_category_id ON questions (category_id)",
+        "CREATE INDEX ix_questions_category_id_id ON questions "
+        "(category_id, id)",
+        "ALTER SEQUENCE {} OWNED BY questions.id".format(sequence)])
+    return statements
+
+
+def partition_questions(engine, partitions=DEFAULT_PARTITIONS):
+    """converts questions in one transaction; writes wait until it
+    commits. Raises RuntimeError when it cannot run."""
+    if engine.dialect.name != "postgresql":
+        raise RuntimeError("partitioning needs PostgreSQL")
+    if is_partitioned(engine):
+        raise RuntimeError("questions is already partitioned")
+    with engine.begin() as connection:
+        missing = connection.execute(
+            "SELECT COUNT(*) FROM questions WHERE category_id IS NULL")\
+            .scalar()
+        if missing:
+            raise RuntimeError("{} questions have no category_id; fix them "
+                               "first".format(missing))
+        sequence = connection.execute(
+            "SELECT pg_get_serial_sequence('questions', 'id')").scalar()
+        if sequence is None:
+            raise RuntimeError("questions.id has no sequence")
+        for statement in partition_statements(partitions, sequence):
+            connection.execute(statement)
+
+
+class PartitionRouter:
+    def __init__(self, index):
+        self.index = index
+        self.enabled = False
+
+    def detect(self):
+        """startup step: routes lookups when questions is partitioned"""
+        self.enabled = is_partitioned(db.engine)
+        if self.enabled:
+            logger.info("questions is partitioned; routing id lookups")
+
+    def criteria(self, ids):
+        """filters that keep a lookup of these question ids in the
+        partitions that own them; none when that is not known"""
+        if not self.enabled:
+            return []
+        category_ids = self.index.categories_of(ids)
+        if not category_ids:
+            return []
+        return [Question.category_id.in_(sorted(category_ids))]
+
+    def lookup(self, query, ids):
+        """query.all() for a query filtered to these question ids, routed
+        to their partitions; unrouted again when rows are missing"""
+        criteria = self.criteria(ids)
+        if not criteria:
+            return query.all()
+        rows = query.filter(*criteria).all()
+        if len(rows) < len(set(ids)):
+            rows = query.all()
+        return rows
+
+
+partition_router = PartitionRouter(question_index)
@@ -0,0 +1,147 @@
+from array import array
+from bisect import bisect_left, insort
+
+from invalidation import VersionedIndex
+from sampling import sample_ids
+
+"""
+QuestionIndex
+    in-memory map of category id to a sorted array of question ids, plus
+    one array per (category id, difficulty) bucket and per difficulty, so
+    quiz draws at a given difficulty cost the same as unfiltered ones
+
+    Built once from a loader yielding (question_id, category_id,
+    difficulty) rows and kept current by the question write listener.
+    Writes published by other processes are patched in from the change
+    log on the next read (see VersionedIndex).
+"""
+
+
+class QuestionIndex(VersionedIndex):
+    def __init__(self):
+        super().__init__()
+        self._all = array("l")
+        self._by_category = {}
+        self._by_bucket = {}
+
+    def _build(self, rows):
+        all_ids = []
+        by_category = {}
+        by_bucket = {}
+        for question_id, category_id, difficulty in rows:
+            if category_id is None:
+                continue
+            category_id = int(category_id)
+            all_ids.append(question_id)
+            by_category.setdefault(category_id, []).append(question_id)
+            for key in ((category_id, difficulty), (None, difficulty)):
+                by_bucket.setdefault(key, []).append(question_id)
+        return {
+            "_all": array("l", sorted(all_ids)),
+            "_by_category": {key: array("l", sorted(ids))
+                             for key, ids in by_category.items()},
+            "_by_bucket": {key: array("l", sorted(ids))
+                           for key, ids in by_bucket.items()}
+            }
+
+    def _apply(self, action, question):
+        if action in ("delete", "update"):
+            self._remove(question.id)
+        if action in ("insert", "update"):
+            self._add(question.id, question.category_id,
+                      question.difficulty)
+        return action in ("insert", "delete", "update")
+
+    def _add(self, question_id, category_id, difficulty):
+        if category_id is None:
+            return
+        category_id = int(category_id)
+        for ids in (self._all,
+                    self._by_category.setdefault(category_id, array("l")),
+                    self._by_bucket.setdefault((category_id, difficulty),
+                                               array("l")),
+                    self._by_bucket.setdefault((None, difficulty),
+                                               array("l"))):
+            insort(ids, question_id)
+
+    def _remove(self, question_id):
+        for ids in [self._all] + list(self._by_category.values()) + \
+                list(self._by_bucket.values()):
+            position = bisect_left(ids, question_id)
+            if position < len(ids) and ids[position] == question_id:
+                del ids[position]
+
+    def ids(self, category_id=None, difficulty=None):
+        self.fresh()
+        return self._ids(category_id, difficulty)
+
+    def _ids(self, category_id=None, difficulty=None):
+        if category_id is not None:
+            category_id = int(category_id)
+        if difficulty is not None:
+            return self._by_bucket.get((category_id, difficulty),
+                                       array("l"))
+        if category_id is None:
+            return self._all
+        return self._by_category.get(category_id, array("l"))
+
+    def count(self, category_id=None, difficulty=None):
+        return len(self.ids(category_id, difficulty))
+
+    def categories_of(self, ids):
+        """the categories of these question ids, or None when one of them
+        is not in the index"""
+        self.fresh()
+        found = set()
+        for question_id in ids:
+            for category_id, category_ids in self._by_category.items():
+                position = bisect_left(category_ids, question_id)
+                if position < len(category_ids) and \
+                        category_ids[position] == question_id:
+                    found.add(category_id)
+                    break
+            else:
+                return None
+        return found
+
+    def counts(self):
+        self.fresh()
+        return {key: len(ids) for key, ids in self._by_category.items()}
+
+    def difficulties(self, category_id=None):
+        """the difficulties that have questions in category_id"""
+        self.fresh()
+        return self._difficulties(category_id)
+
+    def _difficulties(self, category_id=None):
+        if category_id is not None:
+            category_id = int(category_id)
+        return sorted(difficulty for (key, difficulty), ids
+                      in self._by_bucket.items()
+                      if key == category_id and ids and
+                      difficulty is not None)
+
+    def sample(self, category_id=None, exclude=(), count=1,
+               difficulty=None):
+        # catching up may read the database; only the draw holds the lock
+        self.fresh()
+        with self._lock:
+            return sample_ids(self._ids(category_id, difficulty), exclude,
+                              count)
+
+    def sample_near(self, category_id, difficulty, exclude=()):
+        """draws one id at difficulty, or at the closest difficulty that
+        still has an unseen question; returns (id, difficulty) or None"""
+        self.fresh()
+        with self._lock:
+            for candidate in sorted(self._difficulties(category_id),
+                                    key=lambda item: (abs(item - difficulty),
+                                                      item)):
+                picked = sample_ids(self._ids(category_id, candidate),
+                                    exclude)
+                if picked:
+                    return picked[0], candidate
+        return None
+
+
+question_index = QuestionIndex()
@@ -0,0 +1,160 @@
+import re
+import secrets
+import time
+
+DEFAULT_QUESTIONS = 5
+MAX_QUESTIONS = 50
+DEFAULT_DIFFICULTY = 3
+PUNCTUATION = re.compile(r"[.,/#!$%^&*;:{}=\-_`~()]")
+
+"""
+Quiz sessions
+
+A session is drawn once when the quiz starts: up to MAX_QUESTIONS random
+question ids from the category, kept in order with a position pointer.
+Fetching the next question and checking an answer touch only that session,
+so each step costs O(1) however long the quiz or large the category.
+
+An adaptive session draws one question at a time instead. It keeps a
+target difficulty that rises after two correct answers in a row and drops
+after a wrong one, and each next question comes from that (category,
+difficulty) bucket of the question index, or the nearest bucket with
+unseen questions, in O(1) without touching the database.
+
+Sessions are plain dicts kept in a cache backend (cache.LRUCache or
+cache.RedisCache). The backend bounds how many are held and evicts them
+once they have been idle for its TTL.
+"""
+
+
+def is_correct(answer, guess):
+    """same rule the quiz view used: every answer word is in the guess;
+    never right for a missing or empty answer"""
+    words = (answer or "").lower().split()
+    guess = PUNCTUATION.sub("", guess or "").lower()
+    return bool(words) and all(word in guess for word in words)
+
+
+def next_difficulty(difficulty, results):
+    """one step harder after two correct answers in a row, one step
+    easier after a wrong answer, otherwise unchanged"""
+    recent = [result["correct"] for result in results[-2:]]
+    if recent and not recent[-1]:
+        return difficulty - 1
+    if len(recent) == 2 and all(recent):
+        return difficulty + 1
+    return difficulty
+
+
+class QuizSessionStore:
+    def __init__(self, cache, index=None):
+        self.cache = cache
+        self.index = index
+
+    def start(self, category_id, question_ids, total=None,
+              difficulty=None):
+        """question_ids is the whole quiz, or just its first question
+        when difficulty is given (an adaptive session of total
+        questions)"""
+        session = {
+            "id": secrets.token_urlsafe(16),
+            "category": category_id,
+            "questions": list(question_ids),
+            "total": total or len(question_ids),
+            "adaptive": difficulty is not None,
+            "difficulty": difficulty,
+            "position": 0,
+            "answered": False,
+            "score": 0,
+            "results": [],
+            "started": time.time(),
+            "finished": None
+            }
+        self.save(session)
+        return session
+
+    def start_adaptive(self, category_id, total,
+                       difficulty=DEFAULT_DIFFICULTY):
+        """starts an adaptive session, or returns None when the category
+        has no questions"""
+        first = self.index.sample_near(category_id, difficulty)
+        if first is None:
+            return None
+        return self.start(category_id, [first[0]], total, first[1])
+
+    def get(self, session_id):
+        return self.cache.get(session_id)
+
+    def save(self, session):
+        self.cache.set(session["id"], session)
+
+    def current_id(self, session):
+        if session["position"] >= len(session["questions"]):
+            return None
+        return session["questions"][session["position"]]
+
+    def upcoming(self, session, count):
+        """ids of the current question and the ones after it, up to
+        count; an adaptive session only knows its current question"""
+        if session["adaptive"]:
+            count = min(count, 1)
+        position = session["position"]
+        return session["questions"][position:position + count]
+
+    def answer(self, session, question_answer, guess):
+        """scores the current question once; returns whether it was right"""
+        correct = is_correct(question_answer, guess)
+        if not session["answered"]:
+            session["answered"] = True
+            session["score"] += int(correct)
+            session["results"].append({
+                "id": self.current_id(session),
+                "correct": correct
+                })
+            if session["adaptive"]:
+                session["difficulty"] = next_difficulty(
+                    session["difficulty"], session["results"])
+            if session["position"] + 1 >= session["total"]:
+                session["finished"] = time.time()
+            self.save(session)
+        return correct
+
+    def _draw(self, session):
+        """appends the next adaptive question; ends the quiz early when no
+        unseen question is left"""
+        picked = self.index.sample_near(session["category"],
+                                        session["difficulty"],
+                                        set(session["questions"]))
+        if picked is None:
+            session["total"] = len(session["questions"])
+        else:
+            session["questions"].append(picked[0])
+            session["difficulty"] = picked[1]
+
+    def advance(self, session):
+        """moves to the next question; returns its id or None at the end"""
+        if session["adaptive"] and \
+                session["position"] + 1 == len(session["questions"]) < \
+                session["total"]:
+            self._draw(session)
+        if session["position"] < len(session["questions"]):
+            session["position"] += 1
+            session["answered"] = False
+        if session["position"] >= len(session["questions"]) and \
+                session["finished"] is None:
+            session["finished"] = time.time()
+        self.save(session)
+        return self.current_id(session)
+
+    def stats(self, session):
+        answered = len(session["results"])
+        return {
+            "score": session["score"],
+            "answered": answered,
+            "totalQuestions": session["total"],
+            "difficulty": session["difficulty"],
+            "accuracy": session["score"] / answered if answered else 0,
+            "finished": session["finished"] is not None,
+            "duration": (session["finished"] or time.time()) -
+            session["started"]
+            }
@@ -0,0 +1,31 @@
+import random
+
+"""
+Quiz question sampling
+
+Ids are drawn at random positions of a precomputed id array and rejected
+when already seen, so a draw costs O(count) no matter how large the
+category is. Only when the exclusions cover most of the array does it fall
+back to a single pass over the remaining ids.
+"""
+
+
+def sample_ids(ids, exclude=(), count=1):
+    """returns up to count distinct random ids of ids not in exclude"""
+    if not isinstance(exclude, (set, frozenset)):
+        exclude = set(exclude)
+    picked = []
+    seen = set()
+    attempts = 4 * count + 8
+    while ids and len(picked) < count and attempts:
+        attempts -= 1
+        candidate = ids[random.randrange(len(ids))]
+        if candidate not in exclude and candidate not in seen:
+            seen.add(candidate)
+            picked.append(candidate)
+    if len(picked) < count:
+        remaining = [item for item in ids
+                     if item not in exclude and item not in seen]
+        picked.extend(random.sample(remaining,
+                                    min(count - len(picked), len(remaining))))
+    return picked
@@ -0,0 +1,136 @@
+from bisect import bisect_left, insort
+import math
+import re
+
+from invalidation import VersionedIndex
+
+TOKEN = re.compile(r"\w+")
+FIELD_WEIGHTS = {"question": 2.0, "answer": 1.0}
+PREFIX_WEIGHT = 0.5
+
+"""
+SearchIndex
+    in-memory inverted index over question and answer text
+
+    Every search term must match a token of the document, either exactly
+    or as a prefix, so "clay" finds "Cassius Clay?" and "paint" finds
+    "painting". Matches are ranked by tf-idf, with question text weighted
+    above answer text and exact tokens above prefix matches. Prefixes
+    are looked up in a sorted vocabulary that writes keep current, so
+    a search never re-sorts it.
+"""
+
+
+def tokenize(text):
+    return TOKEN.findall((text or "").lower())
+
+
+class SearchIndex(VersionedIndex):
+    def __init__(self):
+        super().__init__()
+        self._postings = {field: {} for field in FIELD_WEIGHTS}
+        self._documents = {}
+        self._vocabulary = []
+
+    def _build(self, rows):
+        index = SearchIndex()
+        # sorted once at the end rather than kept sorted token by token
+        index._vocabulary = None
+        for question_id, question, answer in rows:
+            index._add(question_id, question, answer)
+        return {
+            "_postings": index._postings,
+            "_documents": index._documents,
+            "_vocabulary": sorted(set().union(
+                *(index._postings[field] for field in FIELD_WEIGHTS)))
+            }
+
+    def _apply(self, action, question):
+        if action in ("delete", "update"):
+            self._remove(question.id)
+        if action in ("insert", "update"):
+            self._add(question.id, question.question, question.answer)
+        return action in ("insert", "delete", "update")
+
+    def _known(self, token):
+        return any(token in self._postings[field] for field in FIELD_WEIGHTS)
+
+    def _add(self, question_id, question, answer):
+        fields = {"question": tokenize(question), "answer": tokenize(answer)}
+        self._documents[question_id] = fields
+        for field, tokens in fields.items():
+            postings = self._postings[field]
+            for token in tokens:
+                if self._vocabulary is not None and \
+                        not self._known(token):
+                    insort(self._vocabulary, token)
+                documents = postings.setdefault(token, {})
+                documents[question_id] = documents.get(question_id, 0) + 1
+
+    def _remove(self, question_id):
+        fields = self._documents.pop(question_id, None)
+        if fields is None:
+            return
+        for field, tokens in fields.items():
+            postings = self._postings[field]
+            for token in set(tokens):
+                documents = postings.get(token)
+                if documents is None:
+                    continue
+                documents.pop(question_id, None)
+                if not documents:
+                    del postings[token]
+                    if not self._known(token):
+                        self._forget(token)
+
+    def _forget(self, token):
+        position = bisect_left(self._vocabulary, token)
+        if position < len(self._vocabulary) and \
+                self._vocabulary[position] == token:
+            del self._vocabulary[position]
+
+    def _expand(self, term, fields):
+        position = bisect_left(self._vocabulary, term)
+        while position < len(self._vocabulary) and \
+                self._vocabulary[position].startswith(term):
+            token = self._vocabulary[position]
+            for field in fields:
+                if token in self._postings[field]:
+                    yield token, field
+            position += 1
+
+    def search(self, text, include_answers=False):
+        """returns the ids of documents matching every term, best first"""
+        terms = tokenize(text)
+        if not terms:
+            return []
+        fields = ["question", "answer"] if include_answers else ["question"]
+        self.fresh()
+        with self._lock:
+            total = max(len(self._documents), 1)
+            scores = None
+            for term in terms:
+                term_scores = {}
+                for token, field in self._expand(term, fields):
+                    documents = self._postings[field][token]
+                    weight = FIELD_WEIGHTS[field] * \
+                        math.log(1 + total / len(documents))
+                    if token != term:
+                        weight *= PREFIX_WEIGHT
+                    for question_id, frequency in documents.items():
+                        term_scores[question_id] = \
+                            term_scores.get(question_id, 0) + \
+                            weight * frequency
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {question_id: score + term_scores[question_id]
+                              for question_id, score in scores.items()
+                              if question_id in term_scores}
+                if not scores:
+                    return []
+        return sorted(scores, key=lambda question_id:
+                      (-scores[question_id], question_id))
+
+
+search_index = SearchIndex()
@@ -7,3 +7,47 @@ DB_NAME = os.environ.get("DB_NAME")
 TEST_DB_NAME = os.environ.get("TEST_DB_NAME")
 DB_USER = os.environ.get("DB_USER")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
+INVALIDATION_DIR = os.environ.get("INVALIDATION_DIR")
+INVALIDATION_INTERVAL = float(os.environ.get("INVALIDATION_INTERVAL", 1))
+CACHE_URL = os.environ.get("CACHE_URL")
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 512))
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 60))
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+DATABASE_URL = os.environ.get("DATABASE_URL") or \
+    "postgresql://{}:{}@{}:{}/{}".format(DB_USER, DB_PASSWORD, DB_HOST,
+                                         DB_PORT, DB_NAME)
+DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true") == "true"
+DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "false") == "true"
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+QUIZ_SESSION_MAX = int(os.environ.get("QUIZ_SESSION_MAX", 10000))
+QUIZ_SESSION_TTL = int(os.environ.get("QUIZ_SESSION_TTL", 1800))
+SLOW_REQUEST_MS = int(os.environ.get("SLOW_REQUEST_MS", 0))
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "true") == "true"
+INIT_RETRY_SECONDS = int(os.environ.get("INIT_RETRY_SECONDS", 1))
+INIT_RETRY_MAX_SECONDS = int(os.environ.get("INIT_RETRY_MAX_SECONDS", 30))
+INIT_IN_BACKGROUND = os.environ.get("INIT_IN_BACKGROUND", "true") == "true"
+INIT_WAIT_SECONDS = float(os.environ.get("INIT_WAIT_SECONDS", 10))
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL") or "sqlite://"
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH")
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 300))
+READ_BUDGET_MS = int(os.environ.get("READ_BUDGET_MS", 500))
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = int(os.environ.get("BREAKER_RESET_SECONDS", 30))
+QUIZ_BATCH_MAX = int(os.environ.get("QUIZ_BATCH_MAX", 20))
+JSON_BACKEND = os.environ.get("JSON_BACKEND", "auto")
+COMPRESSION = os.environ.get("COMPRESSION", "true") == "true"
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", 0))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 20))
+RATE_LIMIT_URL = os.environ.get("RATE_LIMIT_URL", CACHE_URL)
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 0))
+ROUTE_CONCURRENCY = int(os.environ.get("ROUTE_CONCURRENCY", 8))
+ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", 16))
+ADMISSION_QUEUE_TIMEOUT_MS = int(os.environ.get("ADMISSION_QUEUE_TIMEOUT_MS",
+                                                1000))
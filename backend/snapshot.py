@@ -0,0 +1,250 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b"TRIVSNP1"
+HEADER = struct.Struct("<8sQQ")
+RECORD_FIELDS = 4
+RECORD_SIZE = RECORD_FIELDS * array("q").itemsize
+NO_CATEGORY = -1
+RELOAD_CHECK_SECONDS = 1
+
+logger = logging.getLogger("trivia.snapshot")
+
+"""
+Local read snapshot
+
+A snapshot is one file holding every category and question as of the
+time it was written:
+
+    header     magic, header length, question count
+    metadata   JSON: when it was written and the categories
+    rows       one JSON array per question, in id order
+    index      (id, row offset, category id, difficulty) per question
+
+Readers mmap the file. Only the index is copied into memory, so every
+worker on a host shares the rows through the page cache and a question is
+decoded only when it is served. The index is written in native byte
+order; a snapshot belongs to the host that wrote it.
+
+Snapshots are written to a temporary file and renamed into place, so a
+reader always sees a complete one, and an exclusive lock file keeps
+workers from writing the same snapshot at once. SnapshotStore notices a
+new file within RELOAD_CHECK_SECONDS and maps it instead.
+"""
+
+
+def write_snapshot(path, categories, rows, created=None):
+    """writes categories, (id, type) pairs, and rows, (id, question,
+    answer, category, category_id, difficulty) tuples in id order, to
+    path; returns the number of questions"""
+    metadata = json.dumps({
+        "created": created or time.time(),
+        "categories": {str(category_id): category_type
+                       for category_id, category_type in categories}
+        }).encode("utf-8")
+    index = array("q")
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, len(metadata), 0))
+        snapshot_file.write(metadata)
+        offset = HEADER.size + len(metadata)
+        for id, question, answer, category, category_id, difficulty \
+                in rows:
+            data = json.dumps([id, question, answer, category,
+                               difficulty]).encode("utf-8")
+            index.extend((id, offset, NO_CATEGORY if category_id is None
+                          else category_id, difficulty or 0))
+            snapshot_file.write(data)
+            offset += len(data)
+        snapshot_file.write(index.tobytes())
+        snapshot_file.seek(0)
+        snapshot_file.write(HEADER.pack(MAGIC, len(metadata),
+                                        len(index) // RECORD_FIELDS))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary, path)
+    return len(index) // RECORD_FIELDS
+
+
+class Snapshot:
+    columns = ("id", "question", "answer", "category", "difficulty")
+
+    def __init__(self, path):
+        with open(path, "rb") as snapshot_file:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, metadata_length, count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError("not a trivia snapshot: {}".format(path))
+        metadata = json.loads(self._map[HEADER.size:
+                                        HEADER.size + metadata_length]
+                              .decode("utf-8"))
+        self.created = metadata["created"]
+        self.categories = {int(category_id): category_type for
+                           category_id, category_type in
+                           metadata["categories"].items()}
+        index_start = len(self._map) - count * RECORD_SIZE
+        index = array("q")
+        index.frombytes(self._map[index_start:])
+        self._ids = index[0::RECORD_FIELDS]
+        self._offsets = index[1::RECORD_FIELDS]
+        self._offsets.append(index_start)
+        self._by_category = {}
+        for position, category_id in enumerate(index[2::RECORD_FIELDS]):
+            self._by_category.setdefault(category_id, array("q")).append(
+                self._ids[position])
+        self._difficulties = index[3::RECORD_FIELDS]
+
+    def age(self):
+        return max(0, time.time() - self.created)
+
+    def close(self):
+        self._map.close()
+
+    def category_type(self, category_id):
+        try:
+            return self.categories.get(int(category_id))
+        except (TypeError, ValueError):
+            return None
+
+    def category_dict(self):
+        return {str(category_id): category_type for
+                category_id, category_type in self.categories.items()}
+
+    def find_category(self, category_type):
+        for category_id, known_type in self.categories.items():
+            if known_type == category_type:
+                return category_id
+        return None
+
+    def ids(self, category_id=None, difficulty=None):
+        """sorted ids of the questions in category_id (all of them for
+        None) and, when given, of that difficulty"""
+        ids = self._ids if category_id is None else \
+            self._by_category.get(category_id, array("q"))
+        if difficulty is None:
+            return ids
+        return [id for id in ids
+                if self._difficulties[bisect_left(self._ids, id)] ==
+                difficulty]
+
+    def count(self, category_id=None):
+        return len(self.ids(category_id))
+
+    def _row(self, position):
+        start, end = self._offsets[position], self._offsets[position + 1]
+        return dict(zip(self.columns,
+                        json.loads(self._map[start:end].decode("utf-8"))))
+
+    def rows(self, ids):
+        """the questions with these ids, in the same order; unknown ids
+        are skipped"""
+        rows = []
+        for id in ids:
+            position = bisect_left(self._ids, id)
+            if position < len(self._ids) and self._ids[position] == id:
+                rows.append(self._row(position))
+        return rows
+
+    def page(self, ids, page=1, after=None, per_page=10):
+        """one page of sorted ids, by page number or after a given id"""
+        if after is not None:
+            start = bisect_right(ids, after)
+        else:
+            start = (max(page, 1) - 1) * per_page
+        return self.rows(ids[start:start + per_page])
+
+
+class SnapshotStore:
+    """the current snapshot at path, rewritten from load_categories()
+    and load_rows() (see write_snapshot) every interval seconds"""
+    def __init__(self, path, load_categories, load_rows, interval=300):
+        self.path = path
+        self.load_categories = load_categories
+        self.load_rows = load_rows
+        self.interval = interval
+        self._snapshot = None
+        self._stat = None
+        self._checked = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def current(self):
+        """the newest snapshot on disk, or None when there is none"""
+        if not self.path:
+            return None
+        now = time.monotonic()
+        if self._snapshot is not None and \
+                now - self._checked < RELOAD_CHECK_SECONDS:
+            return self._snapshot
+        with self._lock:
+            self._checked = now
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return self._snapshot
+            if (stat.st_ino, stat.st_mtime_ns) != self._stat:
+                try:
+                    self._snapshot = Snapshot(self.path)
+                    self._stat = (stat.st_ino, stat.st_mtime_ns)
+                except (OSError, ValueError) as error:
+                    logger.warning("cannot read snapshot %s: %s",
+                                   self.path, error)
+            return self._snapshot
+
+    def stale(self):
+        if not self.path:
+            return False
+        try:
+            return time.time() - os.stat(self.path).st_mtime >= \
+                self.interval
+        except OSError:
+            return True
+
+    def refresh(self, force=False):
+        """writes a new snapshot if the current one is stale (or always
+        with force) and no other worker is writing one; returns whether
+        this call wrote it"""
+        with open(self.path + ".lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            try:
+                if not force and not self.stale():
+                    return False
+                count = write_snapshot(self.path, self.load_categories(),
+                                       self.load_rows())
+                logger.info("wrote snapshot of %d questions to %s", count,
+                            self.path)
+                return True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh_in_background(self, app):
+        """starts refresh() in a thread with an app context, unless one
+        is already running in this process"""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with app.app_context():
+                    self.refresh()
+            except Exception:
+                logger.exception("snapshot refresh failed")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="snapshot-refresh",
+                         daemon=True).start()
@@ -0,0 +1,52 @@
+from flask import Response, stream_with_context
+
+from encoding import json_backend
+from settings import JSON_BACKEND
+
+STREAM_THRESHOLD = 1000
+STREAM_BATCH_SIZE = 500
+
+dumps = json_backend(JSON_BACKEND)[1]
+
+"""
+Streaming JSON responses
+
+stream_json yields {"<key>": [...], <fields>} a few hundred rows at a
+time, so a listing fed from a yield_per query is written out in constant
+memory and the first bytes leave before the last row is read. A streamed
+listing or search carries every matching row; `page` does not apply.
+"""
+
+
+def wants_stream(count, requested=None):
+    """explicit ?stream=true/false wins, otherwise stream large results"""
+    if requested is not None:
+        return str(requested).lower() in ("1", "true", "yes")
+    return count > STREAM_THRESHOLD
+
+
+def stream_json(rows, key="questions", **fields):
+    yield '{{"{}": ['.format(key)
+    separator = ""
+    chunk = []
+    for row in rows:
+        chunk.append(dumps(row))
+        if len(chunk) >= STREAM_BATCH_SIZE:
+            yield separator + ", ".join(chunk)
+            separator = ", "
+            chunk = []
+    if chunk:
+        yield separator + ", ".join(chunk)
+    tail = "".join(', "{}": {}'.format(name, dumps(value))
+                   for name, value in fields.items())
+    yield "]" + tail + "}\n"
+
+
+def stream_json_response(rows, key="questions", **fields):
+    return Response(stream_with_context(stream_json(rows, key, **fields)),
+                    mimetype="application/json")
+
+
+def in_chunks(ids, size=STREAM_BATCH_SIZE):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
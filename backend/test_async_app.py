@@ -0,0 +1,246 @@
+import os
+import re
+import sqlite3
+import tempfile
+import unittest
+
+try:
+    import aiosqlite
+    import invalidation
+    from async_app import create_async_app, WSGI_ONLY_ROUTES
+except ImportError:
+    create_async_app = None
+
+SCHEMA = """
+CREATE TABLE categories (id INTEGER PRIMARY KEY, type TEXT);
+CREATE TABLE questions (id INTEGER PRIMARY KEY, question TEXT, answer TEXT,
+                        category TEXT, category_id INTEGER,
+                        difficulty INTEGER);
+INSERT INTO categories (id, type) VALUES (1, 'Science'), (4, 'History');
+INSERT INTO questions (id, question, answer, category, category_id,
+                       difficulty) VALUES
+    (9, 'What boxer''s original name is Cassius Clay?', 'Muhammad Ali',
+     '4', 4, 1),
+    (12, 'Who invented Peanut Butter?', 'George Washington Carver',
+     '4', 4, 2),
+    (20, 'What is the heaviest organ in the human body?', 'The Liver',
+     '1', 1, 4);
+CREATE TABLE category_stats (category_id INTEGER, difficulty INTEGER,
+                             count INTEGER NOT NULL,
+                             PRIMARY KEY (category_id, difficulty));
+INSERT INTO category_stats (category_id, difficulty, count) VALUES
+    (4, 1, 1), (4, 2, 1), (1, 4, 1);
+CREATE TABLE topic_versions (topic VARCHAR(32) PRIMARY KEY,
+                             version INTEGER NOT NULL);
+CREATE TABLE topic_changes (id INTEGER PRIMARY KEY,
+                            topic VARCHAR(32) NOT NULL,
+                            version INTEGER NOT NULL, item_id INTEGER);
+"""
+
+
+@unittest.skipIf(create_async_app is None, "requires quart and aiosqlite")
+class AsyncTriviaTestCase(unittest.IsolatedAsyncioTestCase):
+    """This class represents the ASGI trivia test case"""
+    async def asyncSetUp(self):
+        handle, self.database_path = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        with sqlite3.connect(self.database_path) as connection:
+            connection.executescript(SCHEMA)
+        self.app = create_async_app("sqlite:///" + self.database_path)
+        await self.app.startup()
+        self.client = self.app.test_client()
+
+    async def asyncTearDown(self):
+        await self.app.shutdown()
+        os.remove(self.database_path)
+
+    async def test_get_categories(self):
+        res = await self.client.get("/categories")
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["categories"]["4"], "History")
+
+    async def test_get_questions(self):
+        res = await self.client.get("/questions")
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["totalQuestions"], 3)
+        self.assertEqual(response_body["currentCategory"], "History")
+
+    async def test_404_questions_page_out_of_range(self):
+        res = await self.client.get("/questions?page=12")
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(response_body["message"], "resource not found")
+
+    async def test_post_search_and_delete_question(self):
+        res = await self.client.post("/questions", json={
+                                     "question": "Who painted Guernica?",
+                                     "answer": "Picasso",
+                                     "category": "1",
+                                     "difficulty": 2
+                                     })
+        self.assertEqual(res.status_code, 200)
+        res = await self.client.post("/questions",
+                                     json={"searchTerm": "guernica"})
+        response_body = await res.get_json()
+        self.assertEqual(response_body["totalQuestions"], 1)
+        question_id = response_body["questions"][0]["id"]
+        res = await self.client.delete("/questions/{}".format(question_id))
+        self.assertEqual(res.status_code, 200)
+        res = await self.client.post("/questions",
+                                     json={"searchTerm": "guernica"})
+        self.assertIn("no results", await res.get_json())
+
+    async def test_404_search_page_out_of_range(self):
+        res = await self.client.post("/questions", json={"searchTerm": "clay",
+                                                         "page": 2})
+        self.assertEqual(res.status_code, 404)
+
+    async def test_category_stats_follow_writes(self):
+        await self.client.post("/questions", json={
+                               "question": "Who painted Guernica?",
+                               "answer": "Picasso",
+                               "category": "1",
+                               "difficulty": 4
+                               })
+        res = await self.client.get("/categories/stats")
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["categories"]["1"]["difficulties"],
+                         {"4": 2})
+        self.assertEqual(response_body["totalQuestions"], 4)
+
+    async def test_writes_are_recorded_for_other_workers(self):
+        res = await self.client.post("/questions", json={
+                                     "question": "Who wrote Hamlet?",
+                                     "answer": "Shakespeare",
+                                     "category": "4",
+                                     "difficulty": 1
+                                     })
+        self.assertEqual(res.status_code, 200)
+        with sqlite3.connect(self.database_path) as connection:
+            changes = connection.execute(
+                "SELECT topic_changes.item_id, questions.question FROM "
+                "topic_changes JOIN questions ON questions.id = "
+                "topic_changes.item_id").fetchall()
+        self.assertEqual([question for _, question in changes],
+                         ["Who wrote Hamlet?"])
+
+    async def test_write_by_another_worker_is_patched_in(self):
+        with sqlite3.connect(self.database_path) as connection:
+            connection.executescript("""
+                INSERT INTO questions (id, question, answer, category,
+                                       category_id, difficulty)
+                VALUES (30, 'Who painted the Mona Lisa?', 'Da Vinci',
+                        '1', 1, 2);
+                INSERT INTO topic_versions (topic, version)
+                VALUES ('questions', 1);
+                INSERT INTO topic_changes (topic, version, item_id)
+                VALUES ('questions', 1, 30);
+                """)
+        invalidation.channel._checked = 0
+        res = await self.client.get("/questions")
+        self.assertEqual((await res.get_json())["totalQuestions"], 4)
+        res = await self.client.post("/questions",
+                                     json={"searchTerm": "mona"})
+        self.assertEqual((await res.get_json())["totalQuestions"], 1)
+
+    async def test_404_no_question_to_delete(self):
+        res = await self.client.delete("/questions/3333")
+        self.assertEqual(res.status_code, 404)
+
+    async def test_get_questions_by_category(self):
+        res = await self.client.get("/categories/4/questions")
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([item["id"] for item in response_body["questions"]],
+                         [9, 12])
+
+    async def test_get_next_question(self):
+        res = await self.client.post("/quizzes", json={
+                                     "quiz_category": "History",
+                                     "previous_questions": [9]
+                                     })
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["question"]["id"], 12)
+
+    async def test_get_next_question_batch_at_difficulty(self):
+        res = await self.client.post("/quizzes", json={
+                                     "quiz_category": {"type": "History"},
+                                     "previous_questions": [],
+                                     "difficulty": 2,
+                                     "count": 5,
+                                     "fields": "question"
+                                     })
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["questions"],
+                         [{"id": 12,
+                           "question": "Who invented Peanut Butter?"}])
+
+    async def test_listing_fields_and_categories_version(self):
+        res = await self.client.get("/questions?fields=question")
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(response_body["questions"][0]), {"id",
+                                                              "question"})
+        version = response_body["categoriesVersion"]
+        res = await self.client.get(
+            "/questions?categoriesVersion={}".format(version))
+        self.assertNotIn("categories", await res.get_json())
+        for url in ("/questions?fields=password",
+                    "/categories/4/questions?fields=password",
+                    "/questions/9?fields=password"):
+            res = await self.client.get(url)
+            self.assertEqual(res.status_code, 422)
+
+    async def test_quiz_session_rejects_answer_to_another_question(self):
+        res = await self.client.post("/quizzes/sessions", json={
+                                     "quiz_category": {"type": "History"},
+                                     "questions": 2
+                                     })
+        response_body = await res.get_json()
+        self.assertEqual(res.status_code, 200)
+        session_url = "/quizzes/sessions/{}".format(
+            response_body["sessionId"])
+        first_id = response_body["question"]["id"]
+        res = await self.client.post(session_url + "/next")
+        self.assertNotEqual((await res.get_json())["questionId"], first_id)
+        res = await self.client.post(session_url + "/answers", json={
+                                     "answer": "anything",
+                                     "questionId": first_id})
+        self.assertEqual(res.status_code, 409)
+        res = await self.client.post(session_url + "/answers",
+                                     json={"answer": "no idea"})
+        self.assertFalse((await res.get_json())["correct"])
+
+    async def test_serves_the_routes_of_the_wsgi_app(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "flaskr", "__init__.py")
+        with open(path) as source:
+            wsgi_routes = {
+                (re.sub(r"<\w+:?(\w+)>", r"<\1>", rule), method)
+                for rule, methods in re.findall(
+                    r'@app\.route\("([^"]+)", methods=\[([^\]]+)\]\)',
+                    source.read())
+                for method in re.findall(r'"(\w+)"', methods)}
+        asgi_routes = {
+            (re.sub(r"<\w+:?(\w+)>", r"<\1>", rule.rule), method)
+            for rule in self.app.url_map.iter_rules()
+            for method in rule.methods - {"HEAD", "OPTIONS"}
+            if rule.endpoint != "static"}
+        self.assertEqual(wsgi_routes - WSGI_ONLY_ROUTES, asgi_routes)
+
+    async def test_404_get_next_question(self):
+        res = await self.client.post("/quizzes", json={
+                                     "quiz_category": "wrong_category",
+                                     "previous_questions": [1, 2]
+                                     })
+        self.assertEqual(res.status_code, 404)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -1,30 +1,96 @@
+import gzip
 import os
+import re
+import tempfile
+import threading
+import time
 import unittest
+from types import SimpleNamespace
 import json
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Integer
+from sqlalchemy.exc import OperationalError
 
+import invalidation
+import migrations
+import streaming
+from admission import MemoryBucketStore, ConcurrencyLimiter
+from cache import create_cache
+from change_log import DatabaseChannel
+from database import LazyInit
+from degraded import CircuitBreaker, DegradedReads, STALE_HEADER
+from encoding import json_encoder
 from flaskr import create_app
-from models import setup_db, Question, Category
-from settings import TEST_DB_NAME, DB_USER, DB_PASSWORD
+from models import db, record_write, Question, Category
+from partitions import partition_router, partition_statements, \
+    partition_questions
+from question_index import QuestionIndex, question_index
+from search_index import SearchIndex
+from quiz_sessions import is_correct
+from settings import TEST_DATABASE_URL
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "trivia.psql")
+COPY_BLOCK = re.compile(r"^COPY public\.(\w+) \(([^)]*)\) FROM stdin;\n"
+                        r"(.*?)^\\\.$", re.M | re.S)
+
+app = None
+snapshot_dir = tempfile.TemporaryDirectory()
+
+
+def load_fixture(engine, path=FIXTURE):
+    """loads the COPY data of a pg_dump file with plain INSERTs"""
+    with open(path, encoding="utf-8") as source:
+        dump = source.read()
+    with engine.begin() as connection:
+        for name, columns, body in COPY_BLOCK.findall(dump):
+            table = db.metadata.tables[name]
+            columns = [column.strip() for column in columns.split(",")]
+            rows = []
+            for line in body.splitlines():
+                row = {}
+                for column, value in zip(columns, line.split("\t")):
+                    if value == "\\N":
+                        value = None
+                    elif isinstance(table.c[column].type, Integer):
+                        value = int(value)
+                    row[column] = value
+                rows.append(row)
+            connection.execute(table.insert(), rows)
+            if engine.dialect.name == "postgresql":
+                connection.execute(
+                    "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                    "(SELECT MAX(id) FROM {0}))".format(name))
+
+
+def setUpModule():
+    """creates the schema and loads trivia.psql once for every test, in an
+    in-memory SQLite database unless TEST_DATABASE_URL says otherwise"""
+    global app
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": TEST_DATABASE_URL,
+        "SNAPSHOT_PATH": os.path.join(snapshot_dir.name, "snapshot"),
+        "INIT_IN_BACKGROUND": False,
+        "TESTING": True
+        })
+    with app.app_context():
+        db.drop_all()
+        migrations.metadata.drop_all(db.engine)
+        db.create_all()
+        load_fixture(db.engine)
+        migrations.upgrade(db.engine)
+        app.extensions["degraded"].snapshots.refresh(force=True)
+
+
+def tearDownModule():
+    snapshot_dir.cleanup()
 
 
 class TriviaTestCase(unittest.TestCase):
     """This class represents the trivia test case"""
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
+        self.app = app
         self.client = self.app.test_client()
-        self.database_name = TEST_DB_NAME
-        self.database_path = 'postgresql://{}:{}@localhost:5432/{}'\
-            .format(DB_USER, DB_PASSWORD, TEST_DB_NAME)
-        setup_db(self.app, self.database_path)
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
 
     def tearDown(self):
         """Executed after reach test"""
@@ -36,10 +102,358 @@ class TriviaTestCase(unittest.TestCase):
     expected errors.
     """
 
+    def test_health_reports_pool_stats(self):
+        res = self.client.get("/health")
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("primary", response_body["pools"])
+
+    def test_health_reports_ready(self):
+        res = self.client.get("/health")
+        self.assertTrue(json.loads(res.data)["ready"])
+
+    def test_lazy_init_retries_after_database_errors(self):
+        attempts = []
+
+        def connect():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise OperationalError("SELECT 1", {}, Exception("down"))
+        startup = LazyInit([connect], retry_interval=0)
+        self.assertFalse(startup.ensure())
+        self.assertIsNotNone(startup.last_error)
+        self.assertTrue(startup.ensure())
+        self.assertTrue(startup.ensure())
+        self.assertEqual(len(attempts), 2)
+
+    def test_lazy_init_in_background(self):
+        loaded = threading.Event()
+        startup = LazyInit([loaded.wait], app=self.app)
+        self.assertFalse(startup.ensure())
+        self.assertGreater(startup.retry_after, 0)
+        loaded.set()
+        for _ in range(100):
+            if startup.ensure():
+                break
+            time.sleep(0.01)
+        self.assertTrue(startup.ready)
+
+    def test_lazy_init_waits_for_a_quick_load(self):
+        startup = LazyInit([lambda: time.sleep(0.05)], app=self.app, wait=5)
+        self.assertTrue(startup.ensure())
+
+    def test_database_channel_polls_at_most_every_interval(self):
+        with self.app.app_context():
+            other_worker = DatabaseChannel(lambda: db.engine, interval=60)
+            seen = other_worker.version("questions")
+            invalidation.publish("questions", [1])
+            self.assertEqual(other_worker.version("questions"), seen)
+            other_worker._checked = 0
+            self.assertEqual(other_worker.version("questions"), seen + 1)
+            self.assertEqual(other_worker.changes("questions", seen),
+                             (seen + 1, {1}))
+
+    def test_write_records_its_change_in_its_transaction(self):
+        with self.app.app_context():
+            other_worker = DatabaseChannel(lambda: db.engine, interval=0)
+            seen = other_worker.version("questions")
+            question = Question("rolled back?", "yes", "1", 1)
+            db.session.add(question)
+            db.session.flush()
+            record_write("insert", question)
+            db.session.rollback()
+            self.assertEqual(other_worker.version("questions"), seen)
+            question = Question("committed?", "yes", "1", 1)
+            question.insert()
+            self.assertEqual(other_worker.changes("questions", seen),
+                             (seen + 1, {question.id}))
+            question.delete()
+
+    def test_shared_cache_requires_shared_channel(self):
+        channel = invalidation.channel
+        invalidation.use_channel(invalidation.FileChannel(snapshot_dir.name))
+        try:
+            with self.assertRaisesRegex(RuntimeError, "INVALIDATION_DIR"):
+                create_cache("redis://localhost:6379/0", versioned=True)
+        finally:
+            invalidation.use_channel(channel)
+
+    def test_index_patches_writes_of_other_workers(self):
+        """a write published by another worker is re-read from the change
+        log; the index is not reloaded"""
+        def no_rebuild():
+            raise AssertionError("index reloaded")
+        other_worker = DatabaseChannel(lambda: db.engine)
+        questions = Question.__table__
+        with self.app.app_context():
+            question_index.fresh()
+            with db.engine.begin() as connection:
+                question_id = connection.execute(questions.insert().values(
+                    question="Which gas do plants take in?",
+                    answer="Carbon dioxide", category="1", category_id=1,
+                    difficulty=2)).inserted_primary_key[0]
+            other_worker.publish("questions", [question_id])
+            invalidation.channel._checked = 0
+            question_index.rebuild = no_rebuild
+            try:
+                self.assertIn(question_id, question_index.ids(1))
+                res = self.client.post("/questions",
+                                       json={"searchTerm": "plants take"})
+                self.assertEqual(json.loads(res.data)["questions"][0]["id"],
+                                 question_id)
+                with db.engine.begin() as connection:
+                    connection.execute(questions.delete().where(
+                        questions.c.id == question_id))
+                other_worker.publish("questions", [question_id])
+                invalidation.channel._checked = 0
+                self.assertNotIn(question_id, question_index.ids(1))
+            finally:
+                del question_index.rebuild
+
+    def test_circuit_breaker_opens_and_probes(self):
+        breaker = CircuitBreaker(failures=2, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        breaker.allow()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_reads_served_from_snapshot_when_breaker_open(self):
+        breaker = self.app.extensions["degraded"].breaker
+        breaker.trip()
+        try:
+            res = self.client.get("/questions?page=1&snapshot=1")
+            response_body = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn(STALE_HEADER, res.headers)
+            self.assertIn("no-store", res.headers["Cache-Control"])
+            self.assertEqual(len(response_body["questions"]), 10)
+            self.assertEqual(response_body["categories"]["1"], "Science")
+            res = self.client.get("/categories/4/questions?snapshot=1")
+            response_body = json.loads(res.data)
+            self.assertEqual(response_body["currentCategory"], "History")
+            self.assertIn(9, [item["id"] for item in
+                              response_body["questions"]])
+            res = self.client.post("/quizzes", json={
+                "quiz_category": {"type": "History"},
+                "previous_questions": [9]
+                })
+            self.assertIn(STALE_HEADER, res.headers)
+            self.assertNotEqual(json.loads(res.data)["question"]["id"], 9)
+        finally:
+            breaker.record_success()
+        res = self.client.get("/questions?page=1&snapshot=1")
+        self.assertNotIn(STALE_HEADER, res.headers)
+
+    def test_index_lock_not_held_while_loading(self):
+        index = QuestionIndex()
+        acquired = []
+
+        def probe():
+            acquired.append(index._lock.acquire(timeout=1))
+            if acquired[-1]:
+                index._lock.release()
+
+        def loader():
+            thread = threading.Thread(target=probe)
+            thread.start()
+            thread.join()
+            return [(1, 1, 1)]
+
+        index.build(loader, lazy=True)
+        self.assertEqual(index.sample(), [1])
+        self.assertEqual(acquired, [True])
+
+    def test_search_vocabulary_follows_writes(self):
+        index = SearchIndex()
+        index.build(lambda: [(1, "Who painted Guernica?", "Picasso")])
+        index.on_write("insert", SimpleNamespace(
+            id=2, question="Who painted Sunflowers?", answer="Van Gogh"),
+            None)
+        self.assertEqual(index.search("sunfl"), [2])
+        index.on_write("delete", SimpleNamespace(id=1), None)
+        self.assertEqual(index._vocabulary,
+                         ["gogh", "painted", "sunflowers", "van", "who"])
+        self.assertEqual(index.search("guern"), [])
+
+    def test_index_refresh_not_held_against_read_budget(self):
+        degraded = self.app.extensions["degraded"]
+        reads = DegradedReads(degraded.snapshots,
+                              CircuitBreaker(failures=1), budget_ms=5,
+                              prepare=lambda: time.sleep(0.02))
+        with self.app.test_request_context():
+            for _ in range(3):
+                reads.read(lambda: "fresh", lambda snapshot: "stale")
+        self.assertEqual(reads.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_json_backends_encode_the_same_data(self):
+        payload = {"questions": [{"id": 1, "difficulty": None,
+                                  "question": "Caf\u00e9 \"\u00fcber\"?"}],
+                   "ok": True}
+        standard = json_encoder("json")().encode(payload)
+        self.assertEqual(json.loads(json_encoder()().encode(payload)),
+                         json.loads(standard))
+
+    def test_compressed_listing(self):
+        headers = {"Accept-Encoding": "gzip"}
+        res = self.client.get("/categories/0/questions?page=2",
+                              headers=headers)
+        self.assertEqual(res.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", res.headers["Vary"])
+        self.assertTrue(res.headers["ETag"].startswith("W/"))
+        body = json.loads(gzip.decompress(res.data))
+        self.assertTrue(body["questions"])
+        again = self.client.get("/categories/0/questions?page=2",
+                                headers=headers)
+        self.assertEqual(again.data, res.data)
+        res = self.client.get("/categories/0/questions?page=2", headers={
+            "If-None-Match": res.headers["ETag"]})
+        self.assertEqual(res.status_code, 304)
+        res = self.client.get("/categories/0/questions?page=2")
+        self.assertNotIn("Content-Encoding", res.headers)
+        self.assertEqual(json.loads(res.data), body)
+
+    def test_partition_statements(self):
+        statements = partition_statements(4, "questions_id_seq")
+        self.assertIn("PARTITION BY HASH (category_id)", statements[3])
+        self.assertEqual(len([statement for statement in statements
+                              if "PARTITION OF questions" in statement]), 4)
+        self.assertEqual(statements[-1],
+                         "ALTER SEQUENCE questions_id_seq OWNED BY "
+                         "questions.id")
+        with self.assertRaises(RuntimeError):
+            partition_questions(db.engine)
+
+    def test_partition_router_routes_id_lookups(self):
+        question = Question.query.order_by(Question.id).first()
+        self.assertEqual(partition_router.criteria([question.id]), [])
+        partition_router.enabled = True
+        try:
+            criteria = partition_router.criteria([question.id])
+            self.assertIn("category_id IN", str(criteria[0]))
+            self.assertEqual(partition_router.criteria([question.id, -1]),
+                             [])
+            res = self.client.get("/questions/{}".format(question.id))
+            self.assertEqual(json.loads(res.data)["question"]["answer"],
+                             question.answer)
+            # another worker moved it; this index has not caught up yet
+            question_index.fresh()
+            question_index._remove(question.id)
+            question_index._add(question.id, question.category_id % 6 + 1,
+                                question.difficulty)
+            res = self.client.get("/questions/{}".format(question.id))
+            self.assertEqual(res.status_code, 200)
+        finally:
+            partition_router.enabled = False
+            question_index.rebuild()
+
+    def test_token_bucket(self):
+        buckets = MemoryBucketStore(rate=1, burst=2)
+        self.assertEqual(buckets.take("client"), 0)
+        self.assertEqual(buckets.take("client"), 0)
+        self.assertGreater(buckets.take("client"), 0)
+        self.assertEqual(buckets.take("other client"), 0)
+
+    def test_concurrency_limiter_sheds_when_queue_full(self):
+        limiter = ConcurrencyLimiter(1, max_queue=1, timeout=0)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    def test_429_rate_limited(self):
+        admission = self.app.extensions["admission"]
+        admission.buckets = MemoryBucketStore(rate=0.5, burst=1)
+        try:
+            res = self.client.get("/categories")
+            self.assertEqual(res.status_code, 200)
+            res = self.client.get("/categories")
+            self.assertEqual(res.status_code, 429)
+            self.assertEqual(res.headers["Retry-After"], "2")
+            self.assertEqual(json.loads(res.data)["error"], 429)
+            self.assertEqual(self.client.get("/health").status_code, 200)
+        finally:
+            admission.buckets = None
+
+    def test_503_route_at_capacity(self):
+        limiter = self.app.extensions["admission"].routes[
+            "get_next_question"]
+        limiter.active, limiter.waiting = limiter.limit, limiter.max_queue
+        try:
+            res = self.client.post("/quizzes", json={
+                                   "quiz_category": "History",
+                                   "previous_questions": [1, 2]})
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers["Retry-After"], "1")
+        finally:
+            limiter.active, limiter.waiting = 0, 0
+        res = self.client.post("/quizzes", json={
+                               "quiz_category": "History",
+                               "previous_questions": [1, 2]})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(limiter.active, 0)
+
+    def test_server_timing_and_metrics(self):
+        res = self.client.get("/questions?page=2")
+        self.assertIn("db;dur=", res.headers["Server-Timing"])
+        res = self.client.get("/metrics")
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_sql_queries_total{route="/questions",'
+                      'method="GET"}', res.get_data(as_text=True))
+        self.assertIn("# TYPE trivia_db_pool_checked_out gauge",
+                      res.get_data(as_text=True))
+
+    def test_get_category_stats(self):
+        res = self.client.get("/categories/stats")
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["totalQuestions"],
+                         Question.query.count())
+        science = response_body["categories"]["1"]
+        self.assertEqual(science["type"], "Science")
+        self.assertEqual(science["totalQuestions"],
+                         sum(science["difficulties"].values()))
+
+    def test_category_stats_follow_writes(self):
+        def art_stats():
+            return json.loads(self.client.get("/categories/stats").data)[
+                "categories"]["2"]["difficulties"].get("5", 0)
+        before = art_stats()
+        self.client.post("/questions", json={
+            "question": "Which painter cut off part of his ear?",
+            "answer": "Van Gogh",
+            "category": "2",
+            "difficulty": 5
+            })
+        self.assertEqual(art_stats(), before + 1)
+        with self.app.app_context():
+            question = Question.query.filter(
+                Question.answer == "Van Gogh").first()
+            question.difficulty = 4
+            question.update()
+        self.assertEqual(art_stats(), before)
+        with self.app.app_context():
+            Question.query.get(question.id).delete()
+
     def test_get_categories(self):
         res = self.client.get("/categories")
         self.assertEqual(res.status_code, 200)
 
+    def test_get_categories_lists_every_category(self):
+        res = self.client.get("/categories")
+        response_body = json.loads(res.data)
+        self.assertEqual(response_body["categories"]["4"], "History")
+        self.assertEqual(len(response_body["categories"]),
+                         Category.query.count())
+
     def test_405_get_categories_wrong_method(self):
         res = self.client.post("/categories", json={"id": 4})
         self.assertEqual(res.status_code, 405)
@@ -51,6 +465,87 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(len(response_body["questions"]))
 
+    def test_get_questions_sparse_fields(self):
+        res = self.client.get("/questions?fields=question,category")
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        for question in response_body["questions"]:
+            self.assertEqual(set(question), {"id", "question", "category"})
+        self.assertEqual(response_body["currentCategory"],
+                         response_body["categories"][
+                             response_body["questions"][0]["category"]])
+        version = response_body["categoriesVersion"]
+
+        res = self.client.get("/questions?fields=question&"
+                              "categoriesVersion={}".format(version))
+        response_body = json.loads(res.data)
+        self.assertNotIn("categories", response_body)
+        self.assertTrue(response_body["currentCategory"])
+        res = self.client.get("/questions?categoriesVersion={}&"
+                              "include=categories".format(version))
+        self.assertIn("categories", json.loads(res.data))
+
+    def test_422_questions_unknown_field(self):
+        res = self.client.get("/questions?fields=question,password")
+        self.assertEqual(res.status_code, 422)
+        res = self.client.get("/categories/1/questions?fields=password")
+        self.assertEqual(res.status_code, 422)
+        res = self.client.get("/questions/1?fields=password")
+        self.assertEqual(res.status_code, 422)
+
+    def test_get_question_fields(self):
+        question = Question.query.order_by(Question.id).first()
+        res = self.client.get("/questions/{}?fields=answer".format(
+            question.id))
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["question"],
+                         {"id": question.id, "answer": question.answer})
+
+    def test_format_rows_matches_format(self):
+        question = Question.query.order_by(Question.id).first()
+        rows = Question.rows().filter(Question.id == question.id)
+        self.assertEqual(Question.format_rows(rows), [question.format()])
+
+    def test_get_questions_with_cursor(self):
+        first_page = json.loads(self.client.get("/questions").data)
+        res = self.client.get("/questions?cursor={}"
+                              .format(first_page["nextCursor"]))
+        response_body = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(response_body["questions"][0]["id"],
+                           first_page["questions"][-1]["id"])
+        self.assertEqual(response_body["totalQuestions"],
+                         first_page["totalQuestions"])
+
+    def test_404_questions_invalid_cursor(self):
+        res = self.client.get("/questions?cursor=not-a-cursor")
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_questions_not_modified(self):
+        res = self.client.get("/questions")
+        etag = res.headers["ETag"]
+        res = self.client.get("/questions",
+                              headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b"")
+
+    def test_get_questions_new_etag_after_write(self):
+        etag = self.client.get("/questions").headers["ETag"]
+        self.client.post("/questions", json={
+                         "question": "does the cache notice writes?",
+                         "answer": "yes",
+                         "category": "2",
+                         "difficulty": 1
+                         })
+        res = self.client.get("/questions",
+                              headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
     def test_404_questions_page_out_of_range(self):
         res = self.client.get("/questions?page=12")
         response_body = json.loads(res.data)
@@ -69,6 +564,28 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(response_body["success"])
         self.assertEqual(res.status_code, 200)
 
+    def test_post_new_question_sets_category_id(self):
+        self.client.post("/questions", json={
+                         "question": "which column holds the category?",
+                         "answer": "category_id",
+                         "category": "2",
+                         "difficulty": 1
+                         })
+        question = Question.query.order_by(Question.id.desc()).first()
+        self.assertEqual(question.category_id, 2)
+
+    def test_post_new_question_updates_total_questions(self):
+        before = json.loads(self.client.get("/questions").data)
+        self.client.post("/questions", json={
+                         "question": "who keeps the question index?",
+                         "answer": "the app",
+                         "category": "2",
+                         "difficulty": 1
+                         })
+        after = json.loads(self.client.get("/questions").data)
+        self.assertEqual(after["totalQuestions"],
+                         before["totalQuestions"] + 1)
+
     def test_422_post_new_question_with_wrong_parameters(self):
         res = self.client.post("/questions", json={
                                "questio": "do you know me?",
@@ -80,12 +597,106 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response_body["success"], False)
         self.assertEqual(res.status_code, 422)
 
+    def test_import_questions(self):
+        before = Question.query.count()
+        lines = [json.dumps({"question": "bulk question {}".format(n),
+                             "answer": "bulk answer",
+                             "category": "3",
+                             "difficulty": 2}) for n in range(3)]
+        res = self.client.post("/questions/import?batch_size=2",
+                               data="\n".join(lines))
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["imported"], 3)
+        self.assertEqual(Question.query.count(), before + 3)
+
+    def test_import_questions_adjusts_stats_in_one_statement(self):
+        def n_plus_one():
+            text = self.client.get("/metrics").get_data(as_text=True)
+            found = re.search(r'trivia_n_plus_one_total\{route="/questions/'
+                              r'import",method="POST"\} (\S+)', text)
+            return float(found.group(1)) if found else 0
+
+        flagged = n_plus_one()
+        before = self.client.get("/categories/stats").get_json()
+        lines = [json.dumps({"question": "bucket question {}".format(n),
+                             "answer": "bucket answer",
+                             "category": "3",
+                             "difficulty": n}) for n in range(1, 6)]
+        res = self.client.post("/questions/import", data="\n".join(lines))
+        self.assertEqual(res.status_code, 200)
+        after = self.client.get("/categories/stats").get_json()
+        self.assertEqual(after["categories"]["3"]["totalQuestions"],
+                         before["categories"]["3"]["totalQuestions"] + 5)
+        self.assertEqual(n_plus_one(), flagged)
+
+    def test_422_import_questions_unknown_category(self):
+        before = Question.query.count()
+        lines = [json.dumps({"question": "kept?", "answer": "no",
+                             "category": "3", "difficulty": 2}),
+                 json.dumps({"question": "bad", "answer": "row",
+                             "category": "999", "difficulty": 2})]
+        res = self.client.post("/questions/import?batch_size=1",
+                               data="\n".join(lines))
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Question.query.count(), before)
+
+    def test_export_questions_csv(self):
+        res = self.client.get("/questions/export?format=csv")
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], "id,question,answer,category,difficulty")
+        self.assertEqual(len(lines) - 1, Question.query.count())
+
     def test_search_for_questions(self):
         res = self.client.post("/questions", json={"searchTerm": "clay"})
         response_body = json.loads(res.data)
         self.assertTrue(response_body["totalQuestions"])
         self.assertEqual(res.status_code, 200)
 
+    def test_search_ranks_and_paginates(self):
+        res = self.client.post("/questions", json={"searchTerm": "soccer",
+                                                   "page": 1})
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["totalQuestions"],
+                         len(response_body["questions"]))
+        for question in response_body["questions"]:
+            self.assertIn("soccer", question["question"].lower())
+
+    def test_404_search_page_out_of_range(self):
+        res = self.client.post("/questions", json={"searchTerm": "soccer",
+                                                   "page": 50})
+        self.assertEqual(res.status_code, 404)
+
+    def test_422_search_invalid_page(self):
+        for page in (0, -1, "2"):
+            res = self.client.post("/questions", json={"searchTerm": "soccer",
+                                                       "page": page})
+            self.assertEqual(res.status_code, 422)
+
+    def test_search_sparse_fields(self):
+        res = self.client.post("/questions", json={"searchTerm": "soccer",
+                                                   "fields": ["question"]})
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(response_body["currentCategory"])
+        for question in response_body["questions"]:
+            self.assertEqual(set(question), {"id", "question"})
+
+    def test_search_answers(self):
+        res = self.client.post("/questions", json={"searchTerm": "scarab",
+                                                   "searchAnswers": True})
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["questions"][0]["answer"], "Scarab")
+
+    def test_search_without_answers_skips_answer_text(self):
+        res = self.client.post("/questions", json={"searchTerm": "scarab"})
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("no results", response_body)
+
     def test_delete_question(self):
         deleted_question = Question.query.filter(Question.id == 37).first()
         res = self.client.delete("/questions/37")
@@ -99,12 +710,81 @@ class TriviaTestCase(unittest.TestCase):
         res = self.client.delete("/questions/3333")
         self.assertEqual(res.status_code, 404)
 
+    def test_batch_update_and_delete_questions(self):
+        for number in range(3):
+            self.client.post("/questions", json={
+                "question": "Batch question {}?".format(number),
+                "answer": "batch",
+                "category": "3",
+                "difficulty": 1
+                })
+        res = self.client.patch("/questions", json={
+            "filter": {"searchTerm": "Batch question"},
+            "set": {"difficulty": 5, "category": "6"}
+            })
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["updated"], 3)
+        res = self.client.post("/questions", json={
+            "searchTerm": "Batch question"})
+        response_body = json.loads(res.data)
+        self.assertEqual({question["category"] for question
+                          in response_body["questions"]}, {"6"})
+        res = self.client.delete("/questions", json={
+            "ids": [question["id"] for question
+                    in response_body["questions"]]})
+        self.assertEqual(json.loads(res.data)["deleted"], 3)
+        res = self.client.post("/questions", json={
+            "searchTerm": "Batch question"})
+        self.assertIn("no results", json.loads(res.data))
+
+    def test_422_batch_delete_without_criteria(self):
+        res = self.client.delete("/questions", json={"filter": {}})
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(response_body["success"], False)
+
     def test_get_questions_by_category(self):
         res = self.client.get("/categories/4/questions")
         response_body = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
         self.assertTrue(len(response_body["questions"]))
 
+    def test_get_questions_by_category_streamed(self):
+        res = self.client.get("/categories/4/questions?stream=true")
+        streamed = json.loads(res.get_data(as_text=True))
+        buffered = json.loads(self.client.get("/categories/4/questions").data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(streamed, buffered)
+
+    def test_search_streamed(self):
+        res = self.client.post("/questions", json={"searchTerm": "the",
+                                                   "stream": True,
+                                                   "page": 50})
+        response_body = json.loads(res.get_data(as_text=True))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(response_body["questions"]),
+                         response_body["totalQuestions"])
+        categories = json.loads(self.client.get("/categories").data)[
+            "categories"]
+        self.assertEqual(
+            response_body["currentCategory"],
+            categories[str(response_body["questions"][0]["category"])])
+
+    def test_search_streamed_above_threshold(self):
+        threshold = streaming.STREAM_THRESHOLD
+        streaming.STREAM_THRESHOLD = 1
+        try:
+            res = self.client.post("/questions", json={"searchTerm": "the",
+                                                       "page": 50})
+        finally:
+            streaming.STREAM_THRESHOLD = threshold
+        response_body = json.loads(res.get_data(as_text=True))
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(response_body["totalQuestions"], 1)
+        self.assertEqual(len(response_body["questions"]),
+                         response_body["totalQuestions"])
+
     def test_404_get_questions_by_non_existent_category(self):
         res = self.client.get("/categories/50000/questions")
         response_body = json.loads(res.data)
@@ -118,6 +798,154 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(response_body["question"])
 
+    def test_get_next_question_skips_previous_questions(self):
+        res = self.client.post("/quizzes", json={
+                               "quiz_category": {"type": "Art", "id": "2"},
+                               "previous_questions": [16, 17, 18]
+                               })
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(response_body["question"]["id"], [16, 17, 18])
+
+    def test_get_next_question_category_exhausted(self):
+        res = self.client.post("/quizzes", json={
+                               "quiz_category": {"type": "Science", "id": "1"},
+                               "previous_questions": [20, 21, 22]
+                               })
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(response_body["question"])
+
+    def test_get_next_question_any_category(self):
+        res = self.client.post("/quizzes", json={
+                               "quiz_category": {"type": "click", "id": 0},
+                               "previous_questions": []
+                               })
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(response_body["question"])
+
+    def test_get_next_question_batch(self):
+        res = self.client.post("/quizzes", json={
+                               "quiz_category": {"type": "Art", "id": "2"},
+                               "previous_questions": [16],
+                               "count": 100
+                               })
+        response_body = json.loads(res.data)
+        ids = [item["id"] for item in response_body["questions"]]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertNotIn(16, ids)
+        self.assertEqual(len(ids), Question.query.filter(
+            Question.category_id == 2).count() - 1)
+        self.assertEqual(response_body["question"]["id"], ids[0])
+
+    def test_quiz_session_prefetch(self):
+        res = self.client.post("/quizzes/sessions", json={
+                               "quiz_category": {"type": "Art", "id": "2"},
+                               "questions": 3,
+                               "count": 3
+                               })
+        response_body = json.loads(res.data)
+        prefetched = [item["id"] for item in response_body["questions"]]
+        self.assertEqual(len(prefetched), 3)
+        session_url = "/quizzes/sessions/{}".format(
+            response_body["sessionId"])
+        res = self.client.post(session_url + "/next", json={"count": 0})
+        response_body = json.loads(res.data)
+        self.assertEqual(response_body["questionId"], prefetched[1])
+        self.assertIsNone(response_body["question"])
+        res = self.client.post(session_url + "/next", json={"count": 5})
+        response_body = json.loads(res.data)
+        self.assertEqual([item["id"] for item in response_body["questions"]],
+                         prefetched[2:])
+
+    def test_quiz_session(self):
+        res = self.client.post("/quizzes/sessions", json={
+                               "quiz_category": {"type": "Science",
+                                                 "id": "1"},
+                               "questions": 2
+                               })
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["totalQuestions"], 2)
+        self.assertNotIn("answer", response_body["question"])
+        session_url = "/quizzes/sessions/{}".format(
+            response_body["sessionId"])
+        first_id = response_body["question"]["id"]
+        answer = Question.query.get(first_id).answer
+
+        res = self.client.post(session_url + "/answers",
+                               json={"answer": answer,
+                                     "questionId": first_id})
+        self.assertTrue(json.loads(res.data)["correct"])
+        res = self.client.post(session_url + "/next")
+        second = json.loads(res.data)["question"]
+        self.assertNotEqual(second["id"], first_id)
+        res = self.client.post(session_url + "/answers",
+                               json={"answer": answer,
+                                     "questionId": first_id})
+        self.assertEqual(res.status_code, 409)
+        res = self.client.post(session_url + "/answers",
+                               json={"answer": "no idea"})
+        self.assertFalse(json.loads(res.data)["correct"])
+        res = self.client.post(session_url + "/next")
+        response_body = json.loads(res.data)
+        self.assertIsNone(response_body["question"])
+        self.assertEqual(response_body["stats"]["score"], 1)
+        self.assertEqual(response_body["stats"]["answered"], 2)
+        self.assertTrue(response_body["stats"]["finished"])
+        res = self.client.post(session_url + "/answers",
+                               json={"answer": answer})
+        self.assertEqual(res.status_code, 404)
+        stats = json.loads(self.client.get(session_url).data)["stats"]
+        self.assertEqual((stats["score"], stats["answered"]), (1, 2))
+
+    def test_empty_answer_is_never_correct(self):
+        self.assertFalse(is_correct(None, "anything"))
+        self.assertFalse(is_correct("", ""))
+        self.assertTrue(is_correct("The  Liver", "the liver!"))
+
+    def test_adaptive_quiz_session(self):
+        res = self.client.post("/quizzes/sessions", json={
+                               "quiz_category": {"type": "Science",
+                                                 "id": "1"},
+                               "questions": 3,
+                               "adaptive": True,
+                               "difficulty": 4
+                               })
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_body["totalQuestions"], 3)
+        self.assertEqual(response_body["question"]["difficulty"], 4)
+        session_url = "/quizzes/sessions/{}".format(
+            response_body["sessionId"])
+        res = self.client.post(session_url + "/answers",
+                               json={"answer": "no idea"})
+        self.assertEqual(json.loads(res.data)["stats"]["difficulty"], 3)
+        res = self.client.post(session_url + "/next")
+        self.assertEqual(json.loads(res.data)["question"]["difficulty"], 3)
+
+    def test_get_next_question_at_difficulty(self):
+        res = self.client.post("/quizzes", json={
+                               "quiz_category": {"type": "Science",
+                                                 "id": "1"},
+                               "previous_questions": [],
+                               "difficulty": 4
+                               })
+        response_body = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(response_body["question"]["id"], [20, 22])
+
+    def test_404_quiz_session_not_found(self):
+        res = self.client.post("/quizzes/sessions/unknown/next")
+        self.assertEqual(res.status_code, 404)
+
+    def test_404_quiz_session_wrong_category(self):
+        res = self.client.post("/quizzes/sessions", json={
+                               "quiz_category": "wrong_category"})
+        self.assertEqual(res.status_code, 404)
+
     def test_404_get_next_question(self):
         res = self.client.post("/quizzes", json={
                                "quiz_category": "wrong_category",
@@ -1,20 +1,42 @@
 import React, { Component } from 'react';
 import '../stylesheets/Question.css';
+import $ from 'jquery';
 
 class Question extends Component {
   constructor() {
     super();
     this.state = {
       visibleAnswer: false,
+      answer: undefined,
     };
   }
 
   flipVisibility() {
     this.setState({ visibleAnswer: !this.state.visibleAnswer });
+    if (this.props.answer === undefined && this.state.answer === undefined) {
+      this.getAnswer();
+    }
   }
 
+  getAnswer = () => {
+    $.ajax({
+      url: `/questions/${this.props.id}?fields=answer`,
+      type: 'GET',
+      success: (result) => {
+        this.setState({ answer: result.question.answer });
+        return;
+      },
+      error: (error) => {
+        alert('Unable to load the answer. Please try your request again');
+        return;
+      },
+    });
+  };
+
   render() {
-    const { question, answer, category, difficulty } = this.props;
+    const { question, category, difficulty } = this.props;
+    const answer =
+      this.props.answer === undefined ? this.state.answer : this.props.answer;
     return (
       <div className='Question-holder'>
         <div className='Question'>{question}</div>
@@ -4,6 +4,9 @@ import Question from './Question';
 import Search from './Search';
 import $ from 'jquery';
 
+// answers are fetched by Question when they are first shown
+const listFields = 'id,question,category,difficulty';
+
 class QuestionView extends Component {
   constructor() {
     super();
@@ -12,6 +15,7 @@ class QuestionView extends Component {
       page: 1,
       totalQuestions: 0,
       categories: {},
+      categoriesVersion: '',
       currentCategory: null,
     };
   }
@@ -22,15 +26,20 @@ class QuestionView extends Component {
 
   getQuestions = () => {
     $.ajax({
-      url: `/questions?page=${this.state.page}`, //TODO: update request URL
+      url: `/questions?page=${this.state.page}&fields=${listFields}&categoriesVersion=${this.state.categoriesVersion}`, //TODO: update request URL
       type: 'GET',
       success: (result) => {
         this.setState({
           questions: result.questions,
           totalQuestions: result.total_questions,
-          categories: result.categories,
           currentCategory: result.current_category,
         });
+        if (result.categories) {
+          this.setState({
+            categories: result.categories,
+            categoriesVersion: result.categoriesVersion,
+          });
+        }
         return;
       },
       error: (error) => {
@@ -65,7 +74,7 @@ class QuestionView extends Component {
 
   getByCategory = (id) => {
     $.ajax({
-      url: `/categories/${id}/questions`, //TODO: update request URL
+      url: `/categories/${id}/questions?fields=${listFields}`, //TODO: update request URL
       type: 'GET',
       success: (result) => {
         this.setState({
@@ -88,7 +97,7 @@ class QuestionView extends Component {
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
-      data: JSON.stringify({ searchTerm: searchTerm }),
+      data: JSON.stringify({ searchTerm: searchTerm, fields: listFields }),
       xhrFields: {
         withCredentials: true,
       },
@@ -161,6 +170,7 @@ class QuestionView extends Component {
           {this.state.questions.map((q, ind) => (
             <Question
               key={q.id}
+              id={q.id}
               question={q.question}
               answer={q.answer}
               category={this.state.categories[q.category]}
@@ -3,17 +3,21 @@ import $ from 'jquery';
 import '../stylesheets/QuizView.css';
 
 const questionsPerPlay = 5;
+// questions fetched per request; the rest wait in state.upcoming
+const prefetchSize = 5;
 
 class QuizView extends Component {
   constructor(props) {
     super();
     this.state = {
       quizCategory: null,
-      previousQuestions: [],
+      sessionId: null,
       showAnswer: false,
       categories: {},
       numCorrect: 0,
       currentQuestion: {},
+      upcoming: [],
+      lastResult: {},
       guess: '',
       forceEnd: false,
     };
@@ -35,27 +39,23 @@ class QuizView extends Component {
   }
 
   selectCategory = ({ type, id = 0 }) => {
-    this.setState({ quizCategory: { type, id } }, this.getNextQuestion);
+    this.setState({ quizCategory: { type, id } }, this.startSession);
   };
 
   handleChange = (event) => {
     this.setState({ [event.target.name]: event.target.value });
   };
 
-  getNextQuestion = () => {
-    const previousQuestions = [...this.state.previousQuestions];
-    if (this.state.currentQuestion.id) {
-      previousQuestions.push(this.state.currentQuestion.id);
-    }
-
+  startSession = () => {
     $.ajax({
-      url: '/quizzes', //TODO: update request URL
+      url: '/quizzes/sessions',
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
       data: JSON.stringify({
-        previous_questions: previousQuestions,
         quiz_category: this.state.quizCategory,
+        questions: questionsPerPlay,
+        count: prefetchSize,
       }),
       xhrFields: {
         withCredentials: true,
@@ -63,14 +63,67 @@ class QuizView extends Component {
       crossDomain: true,
       success: (result) => {
         this.setState({
+          sessionId: result.sessionId,
           showAnswer: false,
-          previousQuestions: previousQuestions,
           currentQuestion: result.question,
+          upcoming: result.questions.slice(1),
           guess: '',
-          forceEnd: result.question ? false : true,
+          forceEnd: false,
         });
         return;
       },
+      error: (error) => {
+        alert('Unable to start the quiz. Please try your request again');
+        return;
+      },
+    });
+  };
+
+  getNextQuestion = () => {
+    const [nextQuestion, ...rest] = this.state.upcoming;
+    if (nextQuestion) {
+      this.setState({
+        showAnswer: false,
+        currentQuestion: nextQuestion,
+        upcoming: rest,
+        guess: '',
+      });
+    }
+    // the session still has to move on; questions are only sent back
+    // when the prefetched ones have run out
+    this.advanceSession(nextQuestion, rest.length ? 0 : prefetchSize);
+  };
+
+  advanceSession = (shownQuestion, count) => {
+    // answers wait for this, so they are scored against the question the
+    // session has moved on to
+    this.pendingNext = $.ajax({
+      url: `/quizzes/sessions/${this.state.sessionId}/next`,
+      type: 'POST',
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({ count }),
+      xhrFields: {
+        withCredentials: true,
+      },
+      crossDomain: true,
+      success: (result) => {
+        if (result.questionId === null) {
+          this.setState({ showAnswer: false, forceEnd: true });
+        } else if (shownQuestion && shownQuestion.id === result.questionId) {
+          if (result.questions.length) {
+            this.setState({ upcoming: result.questions.slice(1) });
+          }
+        } else if (result.question) {
+          this.setState({
+            showAnswer: false,
+            currentQuestion: result.question,
+            upcoming: result.questions.slice(1),
+            guess: '',
+          });
+        }
+        return;
+      },
       error: (error) => {
         alert('Unable to load question. Please try your request again');
         return;
@@ -80,20 +133,44 @@ class QuizView extends Component {
 
   submitGuess = (event) => {
     event.preventDefault();
-    let evaluate = this.evaluateAnswer();
-    this.setState({
-      numCorrect: !evaluate ? this.state.numCorrect : this.state.numCorrect + 1,
-      showAnswer: true,
+    // the server answers 409 if the session is on another question
+    const questionId = this.state.currentQuestion.id;
+    $.when(this.pendingNext).always(() => {
+      $.ajax({
+        url: `/quizzes/sessions/${this.state.sessionId}/answers`,
+        type: 'POST',
+        dataType: 'json',
+        contentType: 'application/json',
+        data: JSON.stringify({ answer: this.state.guess, questionId }),
+        xhrFields: {
+          withCredentials: true,
+        },
+        crossDomain: true,
+        success: (result) => {
+          this.setState({
+            numCorrect: result.score,
+            lastResult: result,
+            showAnswer: true,
+          });
+          return;
+        },
+        error: (error) => {
+          alert('Unable to check your answer. Please try your request again');
+          return;
+        },
+      });
     });
   };
 
   restartGame = () => {
     this.setState({
       quizCategory: null,
-      previousQuestions: [],
+      sessionId: null,
       showAnswer: false,
       numCorrect: 0,
       currentQuestion: {},
+      upcoming: [],
+      lastResult: {},
       guess: '',
       forceEnd: false,
     });
@@ -139,19 +216,8 @@ class QuizView extends Component {
     );
   }
 
-  evaluateAnswer = () => {
-    const formatGuess = this.state.guess
-      // eslint-disable-next-line
-      .replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g, '')
-      .toLowerCase();
-    const answerArray = this.state.currentQuestion.answer
-      .toLowerCase()
-      .split(' ');
-    return answerArray.every((el) => formatGuess.includes(el));
-  };
-
   renderCorrectAnswer() {
-    let evaluate = this.evaluateAnswer();
+    let evaluate = this.state.lastResult.correct;
     return (
       <div className='quiz-play-holder'>
         <div className='quiz-question'>
@@ -160,7 +226,7 @@ class QuizView extends Component {
         <div className={`${evaluate ? 'correct' : 'wrong'}`}>
           {evaluate ? 'You were correct!' : 'You were incorrect'}
         </div>
-        <div className='quiz-answer'>{this.state.currentQuestion.answer}</div>
+        <div className='quiz-answer'>{this.state.lastResult.answer}</div>
         <div className='next-question button' onClick={this.getNextQuestion}>
           {' '}
           Next Question{' '}
@@ -170,8 +236,7 @@ class QuizView extends Component {
   }
 
   renderPlay() {
-    return this.state.previousQuestions.length === questionsPerPlay ||
-      this.state.forceEnd ? (
+    return this.state.forceEnd ? (
       this.renderFinalScore()
     ) : this.state.showAnswer ? (
       this.renderCorrectAnswer()